@@ -0,0 +1,264 @@
+#!/usr/bin/python
+"""bigfilm.py: single-file media mode, every clip in one big film played
+by one long-lived player that seeks instead of starting a new process
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+Build the big film and its offset index from the catalog with:
+    python bigfilm.py [--reencode]
+This concatenates every transition and content file with ffmpeg into
+MEDIA_BASE/BIG_FILM_FILE and writes where each one starts to
+MEDIA_BASE/BIG_FILM_INDEX_FILE. Loops still play from their own files.
+
+With -c copy (the default) the clips must all have the same codec and
+size, as they do when they come from the same export. --reencode works
+for any mix, and puts a keyframe at the start of every clip."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import threading
+import subprocess
+import json
+import sys
+import os
+
+# local imports
+from common import *
+import videothread
+import playerpool
+import metacache
+import procmgr
+import scheduler
+import ffprobe
+
+#
+# Constants
+#
+
+# bump this if the layout of the index changes
+INDEX_VERSION = 1
+BIG_FILM_DBUS_NAME = 'org.mpris.MediaPlayer2.omxplayer.big'
+FFMPEG_CMD = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0']
+REENCODE_ARGS = ['-c:v', 'libx264', '-preset', 'fast', '-crf', '18', '-c:a', 'aac']
+# how far the big film's length can be from the sum of its clips
+DURATION_SLOP = 0.5
+
+
+def file_stamp(filename):
+    """(size, mtime) of a file, or None if it's missing"""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+
+class BigFilmIndex(object):
+    """Where each source file starts in the big film"""
+
+    def __init__(self, data):
+        self.file = data['file']
+        self.duration = data['duration']
+        # source file -> {'offset', 'duration', 'stamp'}
+        self.sources = data['sources']
+
+    def stale(self, media_dir=MEDIA_BASE):
+        """Return the first file that changed since we were built, or None"""
+        if not os.path.isfile(media_dir + '/' + self.file):
+            return self.file
+        for name, source in self.sources.iteritems():
+            if file_stamp(media_dir + '/' + name) != source['stamp']:
+                return name
+        return None
+
+    def locate(self, video):
+        """Return (start, length) of a video in the big film, or None if
+        its file isn't in it"""
+        source = self.sources.get(video['file'])
+        if source is None:
+            return None
+        start, length = videothread.clip_bounds(video, source['duration'])
+        return (source['offset'] + start, length)
+
+
+def load_index(media_dir=MEDIA_BASE):
+    """Read the offset index, or return None if there isn't a good one"""
+    try:
+        with open(media_dir + '/' + BIG_FILM_INDEX_FILE, 'r') as fp:
+            data = json.load(fp)
+    except (IOError, ValueError):
+        return None
+    if data.get('version') != INDEX_VERSION:
+        return None
+    # json gives us unicode, the catalog has byte strings
+    data['file'] = data['file'].encode('utf-8')
+    data['sources'] = dict((name.encode('utf-8'), source)
+                           for name, source in data['sources'].items())
+    return BigFilmIndex(data)
+
+
+def source_files(catalog):
+    """The distinct files of every film the big film plays, in order"""
+    names = []
+    for film in catalog.films:
+        if film.type != 'loop' and film.file not in names:
+            names.append(film.file)
+    return names
+
+
+def build(catalog, media_dir=MEDIA_BASE, reencode=False):
+    """Concatenate the catalog's clips into the big film and write the
+    offset index. Returns the index, or None if ffmpeg failed."""
+    list_file = media_dir + '/' + BIG_FILM_FILE + '.txt'
+    tmp_file = media_dir + '/' + BIG_FILM_FILE + '.tmp'
+    sources = {}
+    offset = 0.0
+    with open(list_file, 'w') as fp:
+        for name in source_files(catalog):
+            filename = media_dir + '/' + name
+            duration = metacache.duration(filename)
+            if not duration:
+                report("WARNING: No duration for %s, left out" % filename)
+                continue
+            sources[name] = {'offset': offset, 'duration': duration,
+                             'stamp': file_stamp(filename)}
+            offset += duration
+            fp.write("file '%s'\n" % os.path.abspath(filename).replace("'", "'\\''"))
+    cmd = FFMPEG_CMD + ['-i', list_file]
+    if reencode:
+        # a keyframe where each clip starts, so every seek lands on one
+        keyframes = sorted(source['offset'] for source in sources.values())
+        cmd += REENCODE_ARGS + ['-force_key_frames',
+                                ",".join("%.3f" % t for t in keyframes)]
+    else:
+        cmd += ['-c', 'copy']
+    cmd += ['-f', 'mp4', tmp_file]
+    report("Building %s from %i clips, %.1fs" % (BIG_FILM_FILE, len(sources), offset))
+    debug("cmd:", " ".join(cmd), level=2)
+    try:
+        failed = subprocess.call(cmd, stdin=procmgr.nullin)
+    except OSError as e:
+        failed = e
+    os.remove(list_file)
+    if failed:
+        report("WARNING: ffmpeg failed: %s" % failed)
+        # whatever it wrote before it failed
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        return None
+    os.rename(tmp_file, media_dir + '/' + BIG_FILM_FILE)
+    try:
+        duration = ffprobe.duration_from_probe(ffprobe.probe(media_dir + '/' + BIG_FILM_FILE))
+    except (OSError, ValueError):
+        duration = None
+    if duration is None or abs(duration - offset) > DURATION_SLOP:
+        report("WARNING: %s is %ss long, but its clips add up to %.1fs. "
+               "The offsets may be off, try --reencode" % (BIG_FILM_FILE, duration, offset))
+    data = {'version': INDEX_VERSION, 'file': BIG_FILM_FILE,
+            'duration': duration or offset, 'sources': sources}
+    with open(media_dir + '/' + BIG_FILM_INDEX_FILE, 'w') as fp:
+        json.dump(data, fp, indent=1, sort_keys=True)
+    return BigFilmIndex(data)
+
+
+class BigFilmPlayer(object):
+    """One player kept warm on the big film, hidden and paused between
+    clips. A clip is started by seeking, playing and showing it.
+    Each show() gets a token, and only the latest one can hide the
+    player again, so a playlist that was cut short can't hide the next."""
+
+    def __init__(self, index, media_dir=MEDIA_BASE, display=None):
+        self.index = index
+        self.media_dir = media_dir
+        self.display = display
+        self._lock = threading.Lock()
+        self._token = 0
+        self._player = None
+        self.start()
+
+    def start(self):
+        """Launch the player in the background, hidden and paused"""
+        video = {'file': self.index.file, 'type': 'content'}
+        self._player = playerpool.WarmPlayer(video, self.media_dir + '/' + self.index.file, 0.0,
+                                             self.display)
+        self._player.dbus_name = BIG_FILM_DBUS_NAME
+        if self.display is not None:
+            self._player.dbus_name += '.display%i' % self.display
+        self._player.task = scheduler.submit_background(self._player.spawn)
+
+    def covers(self, video):
+        return self.index.locate(video) is not None
+
+    def show(self, video):
+        """Seek to a video and play it. Returns (token, length), or None
+        if the video isn't in the big film or the player isn't answering"""
+        where = self.index.locate(video)
+        if where is None:
+            return None
+        start, length = where
+        player = self._player
+        if not player.ready.is_set():
+            return None
+        if player.failed or not procmgr.is_running(player.pgid):
+            report("WARNING: Big film player is gone, restarting it")
+            self.start()
+            return None
+        env = playerpool.dbus_env()
+        with self._lock:
+            self._token += 1
+            token = self._token
+            player.unmute(env)
+            if not (playerpool.dbus_call(player.dbus_name, 'SetPosition', 'objpath:/not/used',
+                                         'int64:%i' % int(start * 1000000), env=env) and
+                    playerpool.dbus_call(player.dbus_name, 'Play', env=env)):
+                return None
+            playerpool.dbus_call(player.dbus_name, 'SetAlpha', 'objpath:/not/used',
+                                 'int64:255', env=env)
+        return (token, length)
+
+    def hide(self, token):
+        """Pause and hide the player, unless someone has shown it since"""
+        env = playerpool.dbus_env()
+        with self._lock:
+            if token != self._token:
+                return
+            playerpool.dbus_call(self._player.dbus_name, 'Pause', env=env)
+            playerpool.dbus_call(self._player.dbus_name, 'SetAlpha', 'objpath:/not/used',
+                                 'int64:0', env=env)
+
+    def close(self):
+        self._player.kill()
+
+
+def open_big_film(media_dir=MEDIA_BASE, display=None):
+    """Start a player on the big film, or return None if it hasn't been
+    built or is out of date"""
+    index = load_index(media_dir)
+    if index is None:
+        report("WARNING: No %s, run bigfilm.py to build it" % BIG_FILM_INDEX_FILE)
+        return None
+    changed = index.stale(media_dir)
+    if changed:
+        report("WARNING: %s changed since %s was built, run bigfilm.py" %
+               (changed, BIG_FILM_FILE))
+        return None
+    return BigFilmPlayer(index, media_dir, display)
+
+
+def main():
+    import video
+    catalog = video.load_catalog()
+    index = build(catalog, MEDIA_BASE, reencode='--reencode' in sys.argv[1:])
+    metacache.get_cache().save()
+    if index is None:
+        sys.exit(1)
+    for name in source_files(catalog):
+        if name in index.sources:
+            report("%8.2fs  %s" % (index.sources[name]['offset'], name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/python
+"""catalog.py: the film database, indexed every way we look it up
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT"""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import json
+import copy
+
+# local imports
+from common import *
+
+#
+# Constants
+#
+
+# the fields every film record has room for, anything else goes in extra
+FILM_FIELDS = ('file', 'type', 'name', 'start', 'length', 'trigger', 'rfid', 'disabled')
+
+
+def record_key(record):
+    """A key that is the same for two records with the same contents,
+    so we can tell which records changed when the database is reloaded"""
+    return json.dumps(record, sort_keys=True)
+
+
+class Film(object):
+    """One film record. It is read like the dict it came from, so
+    film['file'] and 'start' in film work, but it takes a fraction of
+    the memory. A field that wasn't in the record is None."""
+
+    __slots__ = FILM_FIELDS + ('extra',)
+
+    def __init__(self, record):
+        extra = None
+        for field in FILM_FIELDS:
+            setattr(self, field, None)
+        for key, value in record.items():
+            if key in FILM_FIELDS:
+                # we look these up a lot, so we share one copy of each
+                if isinstance(value, str):
+                    value = intern(value)
+                setattr(self, key, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        self.extra = extra
+
+    def __getitem__(self, key):
+        if key in FILM_FIELDS:
+            value = getattr(self, key)
+        elif self.extra is not None:
+            value = self.extra.get(key)
+        else:
+            value = None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in FILM_FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def as_dict(self):
+        """The record as a plain dict, as it would be in the JSON"""
+        record = dict((field, getattr(self, field)) for field in FILM_FIELDS
+                      if getattr(self, field) is not None)
+        if self.extra:
+            record.update(self.extra)
+        return record
+
+    def __repr__(self):
+        return "Film(%r)" % self.as_dict()
+
+
+class Catalog(object):
+    """All of our playable films, with an index for each way we look
+    them up. Built in one pass over the film records.
+    A catalog isn't changed once it's built, updated() makes a new one
+    that shares everything that didn't change, so the old one can still
+    be used while the new one is built."""
+
+    def __init__(self, film_list, lengths, media_dir=MEDIA_BASE):
+        """film_list is the list of film records from the database.
+        lengths is a dictionary of file lengths indexed by full filename,
+        None for files that are missing, as from scan_media_files()."""
+        self.media_dir = media_dir
+        self.films = []
+        self.by_type = {}
+        self.by_trigger = {}
+        self.by_file = {}
+        # RFID -> trigger
+        self.by_rfid = {'default': 'default'}
+        # record_key() -> list of the films we made from that record
+        self.by_record = {}
+        for record in film_list:
+            self._add(Film(record), lengths, record_key(record))
+
+    def _add(self, film, lengths, key):
+        """Check a film and add it to the indexes"""
+        name = film.name or film.file
+        filename = self.media_dir + '/' + film.file
+        if film.disabled:
+            debug(name, "disabled. Removed from database")
+            return
+        if lengths.get(filename) is None:
+            debug("File", filename, "not found. Removed from database")
+            return
+        # first let's fill in necessary but missing fields
+        if not film.length:
+            film.length = lengths[filename]
+            debug("Getting duration for", name + ":", film.length)
+        self.films.append(film)
+        self.by_record.setdefault(key, []).append(film)
+        self.by_file.setdefault(film.file, []).append(film)
+        # Note, that this means a film can be in several lists
+        if film.type:
+            self.by_type.setdefault(film.type, []).append(film)
+        if film.type == 'content' and film.trigger:
+            self.by_trigger.setdefault(film.trigger, []).append(film)
+            if film.rfid:
+                self.by_rfid[film.rfid] = film.trigger
+
+    def changes(self, film_list):
+        """Compare a new film list with the one we were built from.
+        Returns (removed, added): the films that are no longer in the
+        list and the records that are new. Records we skipped last time
+        are tried again, their files may be there now."""
+        new_records = {}
+        for record in film_list:
+            new_records.setdefault(record_key(record), []).append(record)
+        removed = []
+        for key, films in self.by_record.items():
+            count = len(new_records.get(key, ()))
+            removed.extend(films[count:])
+        added = []
+        for key, records in new_records.items():
+            # disabled records would only be skipped again
+            added.extend(record for record in records[len(self.by_record.get(key, ())):]
+                         if not record.get('disabled'))
+        return removed, added
+
+    def updated(self, removed, added, lengths):
+        """Return a new catalog without the removed films and with the
+        added records, as from changes(). Only the index entries the
+        changes touch are copied, everything else is shared with us."""
+        new = copy.copy(self)
+        indexes = []
+        for name in ('by_record', 'by_file', 'by_type', 'by_trigger', 'by_rfid'):
+            setattr(new, name, dict(getattr(self, name)))
+            indexes.append(getattr(new, name))
+        by_record, by_file, by_type, by_trigger, by_rfid = indexes
+        # out with the old
+        gone = set(id(film) for film in removed)
+        if gone:
+            new.films = [film for film in self.films if id(film) not in gone]
+            touched = [(by_record, key) for key, films in self.by_record.items()
+                       if [film for film in films if id(film) in gone]]
+            for film in removed:
+                touched += [(by_file, film.file), (by_type, film.type),
+                            (by_trigger, film.trigger)]
+            for index, key in touched:
+                if key in index:
+                    films = [film for film in index[key] if id(film) not in gone]
+                    if films:
+                        index[key] = films
+                    else:
+                        del index[key]
+        else:
+            new.films = list(self.films)
+        # in with the new, copying any list we add to so ours stay as they are
+        for record in added:
+            film = Film(record)
+            key = record_key(record)
+            for index, old_index, index_key in ((by_record, self.by_record, key),
+                                                (by_file, self.by_file, film.file),
+                                                (by_type, self.by_type, film.type),
+                                                (by_trigger, self.by_trigger, film.trigger)):
+                if index_key in index and index[index_key] is old_index.get(index_key):
+                    index[index_key] = list(index[index_key])
+            new._add(film, lengths, key)
+        # an RFID goes to the trigger of the last film that has it
+        rfids = set(film.rfid for film in removed if film.rfid)
+        for rfid in rfids:
+            by_rfid.pop(rfid, None)
+        if rfids:
+            for film in new.of_type('content'):
+                if film.rfid in rfids and film.trigger:
+                    by_rfid[film.rfid] = film.trigger
+        return new
+
+    def of_type(self, type):
+        """List of films of a type, eg 'loop' or 'transition'"""
+        return self.by_type.get(type, [])
+
+    def content_for(self, trigger):
+        """List of content films for a trigger, or None"""
+        return self.by_trigger.get(trigger)
+
+    def trigger_for_rfid(self, rfid):
+        """The trigger an RFID is associated with, or None"""
+        return self.by_rfid.get(rfid)
+
+    def films_for_rfid(self, rfid):
+        """List of content films an RFID can play, or None"""
+        trigger = self.by_rfid.get(rfid)
+        if trigger is None:
+            return None
+        return self.by_trigger.get(trigger)
+
+    def triggers(self):
+        return self.by_trigger.keys()
+
+    def __len__(self):
+        return len(self.films)
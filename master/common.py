@@ -7,7 +7,13 @@ Copyright: 2017, MIT"""
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 
 from time import sleep, time
+from collections import OrderedDict
+import threading
+import atexit
+import Queue
+import json
 import sys
+import os
 
 #
 # Constants
@@ -15,59 +21,208 @@ import sys
 DEBUG = 2
 MEDIA_BASE = 'media'
 FILMDB_FILE = 'OBJECT_FILM_DB.json'
+METACACHE_FILE = '.metacache.json'
+SNAPSHOT_FILE = '.catalog.snapshot'
+# every transition and content clip in one file, see bigfilm.py
+BIG_FILM_FILE = 'one_big_film.mp4'
+BIG_FILM_INDEX_FILE = 'one_big_film.json'
+# every message also goes here as a line of JSON, for later analysis.
+# None turns that off
+LOG_FILE = '/tmp/truth-machine.jsonl'
+# when the log gets this big we start a new one, keeping one old one
+LOG_FILE_MAX = 10 * 1024 * 1024
+# how many messages can wait for the writer before we start dropping them
+LOG_QUEUE_SIZE = 1000
+# how many distinct messages we remember for rate limiting
+RATE_LIMIT_SIZE = 256
+# how long we wait for the writer to catch up when we exit
+LOG_FLUSH_TIMEOUT = 2.0
 
 #
 # Globals
 #
 
-# we only report each error periodically,
-# so we keep a record of last report time
-last_report_time = {}
 # report interval in seconds
 report_interval = 5
-
-# we only report each DEBUG msg periodically,
-# so we keep a record of last debug time
-last_debug_time = {}
 # report interval in seconds
 debug_interval = 1
-# last function that called debug
-debug_last_caller = ""
+
+
+class RateLimiter(object):
+    """Remembers when we last let each message through, for the most
+    recent few hundred messages, so a flood of different messages can't
+    use up memory"""
+
+    def __init__(self, interval, size=RATE_LIMIT_SIZE):
+        self.interval = interval
+        self.size = size
+        self._last = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """Should a message go out now. Messages that are held back still
+        count as recently used."""
+        now = time()
+        with self._lock:
+            last = self._last.pop(key, None)
+            if last is not None and now < last + self.interval:
+                self._last[key] = last
+                return False
+            self._last[key] = now
+            if len(self._last) > self.size:
+                self._last.popitem(last=False)
+            return True
+
+
+class LogWriter(threading.Thread):
+    """Formats and writes messages on its own thread, so the threads
+    that log never wait on the console or the disk"""
+
+    def __init__(self, log_file=None):
+        super(LogWriter, self).__init__(name="log")
+        self.daemon = True
+        self.queue = Queue.Queue(LOG_QUEUE_SIZE)
+        self.dropped = 0
+        self.log_file = log_file
+        self._fp = None
+        self._last_caller = None
+
+    def put(self, record):
+        """Queue a message without ever blocking"""
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=LOG_FLUSH_TIMEOUT):
+        """Wait until everything queued so far has been written"""
+        done = threading.Event()
+        try:
+            self.queue.put(('flush', done), timeout=timeout)
+        except Queue.Full:
+            return
+        done.wait(timeout)
+
+    def _open(self):
+        if self.log_file and not self._fp:
+            try:
+                if os.path.getsize(self.log_file) > LOG_FILE_MAX:
+                    os.rename(self.log_file, self.log_file + '.old')
+            except OSError:
+                pass
+            try:
+                self._fp = open(self.log_file, 'a')
+            except IOError as e:
+                sys.stdout.write("WARNING: Can't open log %s: %s\n" % (self.log_file, e))
+                self.log_file = None
+
+    def _write(self, record):
+        when, kind, level, caller, thread, args = record
+        # plain values are formatted here, off the caller's thread, see _log()
+        text = " ".join(map(str, args))
+        if kind == 'debug':
+            if caller == self._last_caller:
+                line = "    debug: %s: %s" % (caller, text)
+            else:
+                line = "debug: %s: %s" % (caller, text)
+            self._last_caller = caller
+        else:
+            line = text
+        sys.stdout.write(line + "\n")
+        self._open()
+        if self._fp:
+            entry = {'t': round(when, 6), 'kind': kind, 'thread': thread, 'msg': text}
+            if kind == 'debug':
+                entry['level'] = level
+                entry['caller'] = caller
+            self._fp.write(json.dumps(entry) + "\n")
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record[0] == 'flush':
+                record[1].set()
+            else:
+                try:
+                    self._write(record)
+                except Exception as e:
+                    sys.stdout.write("WARNING: Can't log %r: %s\n" % (record, e))
+            # write out a burst of messages all at once
+            if self.queue.empty():
+                if self.dropped:
+                    sys.stdout.write("WARNING: %i log messages dropped\n" % self.dropped)
+                    self.dropped = 0
+                sys.stdout.flush()
+                if self._fp:
+                    self._fp.flush()
+
+
+# started on first use
+_log_writer = None
+_log_writer_lock = threading.Lock()
+report_limiter = RateLimiter(report_interval)
+debug_limiter = RateLimiter(debug_interval)
+
+
+# arguments we can leave to the writer to format, as they can't change
+_IMMUTABLE = (str, unicode, int, long, float, bool, type(None))
+
+
+def _log(kind, level, caller, args):
+    global _log_writer
+    # anything else, like a film or a device dict, we format now, or the
+    # line could show it as it is by the time the writer gets to it
+    for arg in args:
+        if not isinstance(arg, _IMMUTABLE):
+            args = (" ".join(map(str, args)),)
+            break
+    if _log_writer is None:
+        with _log_writer_lock:
+            if _log_writer is None:
+                writer = LogWriter(LOG_FILE)
+                writer.start()
+                atexit.register(writer.flush)
+                _log_writer = writer
+    _log_writer.put((time(), kind, level, caller,
+                     threading.current_thread().name, args))
+
+
+def flush_log():
+    """Wait until everything logged so far has been written"""
+    if _log_writer:
+        _log_writer.flush()
+
+
+def _limit_key(args):
+    """What makes two messages the same. Usually the arguments themselves,
+    which is cheaper than formatting them. Anything else, like an
+    exception, hashes by identity, so we go by its text."""
+    for arg in args:
+        if not isinstance(arg, _IMMUTABLE):
+            return " ".join(map(str, args))
+    return args
+
 
 def report(*args):
-    """immediately report information.
+    """report information. It is queued for the log writer, so it comes
+    out shortly, in order with everything else we log.
     Note: Accepts multiple arguments"""
-    text = " ".join(list(map(str, args)))
-    print text
+    _log('report', 0, None, args)
 
 
 def debug(*args, **kargs):
-    """Produce debug message, indenting if from same calling function"""
-    global debug_last_caller
-    if 'level' in kargs:
-        level = kargs['level']
-    else:
-        level = 1
-    if (level <= DEBUG):
-        text = " ".join(list(map(str, args)))
-        caller = sys._getframe(1).f_code.co_name
-        # if now is greater than our last debug time + an interval
-        if (text not in last_debug_time or
-                time() > last_debug_time[text] + debug_interval):
-            if (caller == debug_last_caller):
-                report("    debug: %s: %s" % (caller, text))
-            else:
-                report("debug: %s: %s" % (caller, text))
-            last_debug_time[text] = time()
-        debug_last_caller = caller
+    """Produce debug message, indenting if from same calling function.
+    Nothing is looked at or formatted unless level is on."""
+    level = kargs.get('level', 1)
+    if level > DEBUG:
+        return
+    caller = sys._getframe(1).f_code.co_name
+    if debug_limiter.allow((caller, _limit_key(args))):
+        _log('debug', level, caller, args)
 
 
 def update(*args):
     """periodically report information at report_interval seconds.
     Note: Accepts multiple arguments"""
-    text = " ".join(list(map(str, args)))
-    # if now is greater than our last report time + an interval
-    if (text not in last_report_time or
-            time() > last_report_time[text] + report_interval):
-        report(text)
-        last_report_time[text] = time()
+    if report_limiter.allow(_limit_key(args)):
+        _log('update', 0, None, args)
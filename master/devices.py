@@ -11,11 +11,19 @@ import os
 import subprocess
 from time import sleep, time
 import threading
+import collections
+import errno
+import fcntl
 from evdev import InputDevice
 from select import select
 
 # local imports
 from common import *
+import hotplug
+import scheduler
+import reactor
+import metrics
+from rfid_decoder import RFIDDecoder
 
 # Constants
 #
@@ -23,9 +31,16 @@ USB_PORT_PREFIX = "/dev/ttyUSB"
 MAX_USB_PORTS = 12
 RFID_SEND_COUNT = 3
 RFID_LENGTH = 29
+# seconds a tag must be off the reader before it triggers again
+RFID_HOLDOFF = 3.0
 MAX_RETRIES = 20
 RETRY_DELAY = 0.5
 SERIAL_TIMEOUT = 0.5
+# masters on the same machine lock the ports they use with these files
+PORT_LOCK_PREFIX = "/tmp/truth-machine-port."
+# while a device we'd warn about is missing, how often we look again
+# without a hotplug event
+DEVICE_RECHECK_INTERVAL = 5.0
 
 # communication protocols
 REQ_ID = "id"
@@ -85,11 +100,34 @@ devices = {'rfid': {'key':      'rfid',
 
 assigned_ports = []
 
-# a place to store our rfid as we receive it
-rfid_in = ""
+# ports we hold the lock for, indexed by port: lock file fd, see lock_port()
+port_locks = {}
+
+# ID responses indexed by port: (port stamp, response)
+# Kept until the port's device node changes, see port_stamp()
+port_id_cache = {}
+
+# builds RFIDs from the reader's key presses, and ignores a tag
+# left sitting on the reader
+rfid_decoder = RFIDDecoder(digits=(RFID_LENGTH + 1) / 3, holdoff=RFID_HOLDOFF)
+# a decoder for each reader, indexed by device key, see decoder_for()
+rfid_decoders = {'rfid': rfid_decoder}
 
 # timers
-chart_timer = ""
+chart_timer = None
+
+# hotplug monitoring
+hotplug_watcher = None
+# the result of the last check_devices(), so the main loop can check
+# device health without going to the filesystem
+devices_live_flag = False
+# functions called with (device, old_status, new_status) on a change
+device_listeners = []
+_check_lock = threading.Lock()
+_recheck_event = None
+# keys of the devices that failed on us since the last check_devices()
+_lost_devices = set()
+_lost_lock = threading.Lock()
 
 
 #
@@ -101,6 +139,23 @@ def sorted_devices():
     return sorted(devices.values(), key=lambda x: x['sort'])
 
 
+def keep_devices(keys):
+    """Forget every device but these, so a master running only some of
+    the stations doesn't take the others' devices"""
+    for key in devices.keys():
+        if key not in keys:
+            del devices[key]
+
+
+def decoder_for(key):
+    """The RFID decoder for a reader, made on first use"""
+    decoder = rfid_decoders.get(key)
+    if decoder is None:
+        decoder = rfid_decoders[key] = RFIDDecoder(digits=rfid_decoder.digits,
+                                                   holdoff=RFID_HOLDOFF)
+    return decoder
+
+
 def is_port_active(port):
     """Check if given port is active.
     Note if no part is passed, it returns False"""
@@ -121,30 +176,99 @@ def get_active_usb_ports():
     return usb_list
 
 
+def lock_port(port):
+    """Take a port for ourselves, so another master on this machine
+    leaves it alone. We lock a file beside it rather than the port, as
+    just opening the port resets the board on it. Raises IOError if
+    another master has it."""
+    if port in port_locks:
+        return
+    fd = os.open(PORT_LOCK_PREFIX + os.path.basename(port), os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        os.close(fd)
+        raise IOError(errno.EBUSY, "%s is held by another master" % port)
+    port_locks[port] = fd
+
+
+def unlock_port(port):
+    fd = port_locks.pop(port, None)
+    if fd is not None:
+        os.close(fd)
+
+
 def request_id_from_device(port):
     """Send an ID request to a serial port and return the ID we get"""
     # we only want to check port if it is still active
     if (is_port_active(port)):
+        # we don't touch a port another master is using, this raises for
+        # those. setup_devices() lets go of the ones it doesn't keep
+        lock_port(port)
         # set up a serial port temporarily
         ser = serial.Serial(port, 9600, timeout=SERIAL_TIMEOUT)
         # clear the buffers - TODO: Does this actually do it?
         ser.reset_input_buffer()
         ser.reset_output_buffer()
-        # we ask several times until we get an answer
-        for i in range(MAX_RETRIES):
-            ser.write(REQ_ID)
-            sleep(RETRY_DELAY)
-            waiting = ser.inWaiting()
-            response = ser.readline().strip()
-            # report("Serial Try", i, "=", response, "waiting:", waiting)
-            if response:
-                break
-            sleep(RETRY_DELAY)
+        # we ask several times until we get an answer.
+        # readline waits up to SERIAL_TIMEOUT for it to arrive
+        response = ""
+        try:
+            for i in range(MAX_RETRIES):
+                ser.write(REQ_ID)
+                response = ser.readline().strip()
+                # report("Serial Try", i, "=", response)
+                if response:
+                    break
+                sleep(RETRY_DELAY)
+        finally:
+            ser.close()
         return response
     # otherwise return empty string
     return ""
 
 
+def port_stamp(port):
+    """Something that changes whenever udev recreates a port's device node,
+    or None if the port is gone"""
+    try:
+        st = os.stat(port)
+    except OSError:
+        return None
+    return (st.st_rdev, st.st_ino, st.st_ctime)
+
+
+@metrics.timed('probe_port')
+def probe_port(port):
+    """Get the ID of whatever is on a port, asking it only if we haven't
+    already asked since the port last changed. Returns (port, response)."""
+    stamp = port_stamp(port)
+    if stamp is None:
+        port_id_cache.pop(port, None)
+        return (port, "")
+    cached = port_id_cache.get(port)
+    if cached and cached[0] == stamp:
+        return (port, cached[1])
+    try:
+        response = request_id_from_device(port)
+    except IOError as e:
+        debug("Can't probe", port + ":", e)
+        response = ""
+    # a device that didn't answer may still be booting, so we ask again next time
+    if response:
+        port_id_cache[port] = (stamp, response)
+    return (port, response)
+
+
+def probe_ports(ports):
+    """Ask all of the ports for their IDs at the same time.
+    Returns a list of (port, response) in the same order as ports."""
+    if not ports:
+        return []
+    return scheduler.map_background(probe_port, ports)
+
+
+@metrics.timed('setup_devices')
 def setup_devices():
     """Set up all of our serial ports connected to our devices"""
     # report("Checking for active ports")
@@ -165,37 +289,49 @@ def setup_devices():
                 # mark is as currently live
                 device['status'] = 'live'
         # Now we assign all of our variable port devices
-        for port in usb_ports:
-            debug("Active ports:", str(usb_ports), level=3)
-            debug("Registered ports:", str(assigned_ports), level=3)
-            # if this port isn't already assigned
-            if (port not in assigned_ports):
-                debug("Unassigned port:", port)
-                #
-                # look through our list of expected devices
-                for device in sorted_devices():
-                    # if the device is not fixed port and not already live
-                    if (device['port-status'] != 'fixed' and not is_port_active(device['port'])):
-                        debug("Unassigned device:", device['name'])
-                        # if device IDs as this device
-                        response = request_id_from_device(port)
-                        debug("Response: ", response)
-                        if (device['id'] in response):
-                            report("Setting up %s, ID: %s, Port: %s" % (device['name'],
-                                                                        response, port))
-                            # asign a serial handle
-                            device['handle'] = serial.Serial(port, 9600, timeout=.5)
-                            # assign the port name
-                            device['port'] = port
-                            # add port to our assigned port list
-                            if port not in assigned_ports:
-                                assigned_ports.append(port)
-                            # mark is as currently live
-                            device['status'] = 'live'
-                            # we don't need to look through the rest of the
-                            # devices
+        debug("Active ports:", str(usb_ports), level=3)
+        debug("Registered ports:", str(assigned_ports), level=3)
+        wanted = [device for device in sorted_devices()
+                  if (device['port-status'] != 'fixed' and
+                      not is_port_active(device['port']))]
+        unassigned = [port for port in usb_ports if port not in assigned_ports]
+        if wanted and unassigned:
+            debug("Unassigned devices:", [device['name'] for device in wanted])
+            debug("Unassigned ports:", unassigned)
+            # we ask each port once, all at once, and match each answer
+            # against every device we are still looking for
+            for port, response in probe_ports(unassigned):
+                debug("Response: ", port, response)
+                for device in wanted:
+                    # if device IDs as this device
+                    if response and device['id'] in response:
+                        # the port is ours until we lose the device, unless
+                        # another master took it since we asked
+                        try:
+                            lock_port(port)
+                        except IOError as e:
+                            debug("Can't set up", device['name'] + ":", e)
                             break
-            # we continue looking through the active ports
+                        report("Setting up %s, ID: %s, Port: %s" % (device['name'],
+                                                                    response, port))
+                        # asign a serial handle
+                        device['handle'] = serial.Serial(port, 9600, timeout=.5)
+                        # and a channel to talk to it
+                        start_serial_channel(device)
+                        # assign the port name
+                        device['port'] = port
+                        # add port to our assigned port list
+                        if port not in assigned_ports:
+                            assigned_ports.append(port)
+                        # mark is as currently live
+                        device['status'] = 'live'
+                        # this device is taken, and so is the port
+                        wanted.remove(device)
+                        break
+        # let the other masters have the ports we only asked
+        for port in port_locks.keys():
+            if port not in assigned_ports:
+                unlock_port(port)
     except IOError:
         report("WARNING: Setup error, retrying")
         sleep(1)
@@ -210,6 +346,9 @@ def all_devices_live():
     devices_ok = True
     # we iterate over the list of possible devices
     for device in sorted_devices():
+        # one that failed on us may still have its port
+        if device['status'] != 'live':
+            devices_ok = False
         # check if port is active. Note if we lost the port previously and it is empty
         # is_port_active() returns False
         if not is_port_active(device['port']):
@@ -221,17 +360,97 @@ def all_devices_live():
                 # at intervals we report this
                 update("WARNING: %s disconnected." % device['name'])
             # set status for this device
-            device['status'] == 'missing'
+            device['status'] = 'missing'
             # unassign port
             if device['port-status'] != "fixed":
-                device['port'] == ''
                 # remove port from our assigned port list
                 if device['port'] in assigned_ports:
                     assigned_ports.remove(device['port'])
+                unlock_port(device['port'])
+                device['port'] = ''
             devices_ok = False
     return devices_ok
 
 
+def check_devices():
+    """Check all devices, set up any that are missing, and publish any
+    changes in status. Probing can take seconds, so once the monitor is
+    started this only runs on the hotplug thread."""
+    global devices_live_flag, _recheck_event
+    with _check_lock:
+        _recheck_event = None
+        with _lost_lock:
+            lost = list(_lost_devices)
+            _lost_devices.clear()
+        for key in lost:
+            if key in devices:
+                close_device(devices[key])
+        # a lost device we set up again right away is a change too, its
+        # listeners have a new handle to take up
+        before = dict((device['key'], device['status']) for device in sorted_devices())
+        if all_devices_live():
+            devices_live_flag = True
+        else:
+            setup_devices()
+            devices_live_flag = all_devices_live()
+        for device in sorted_devices():
+            old_status = before[device['key']]
+            if device['status'] != old_status:
+                debug(device['name'] + ":", old_status, "->", device['status'])
+                for listener in device_listeners:
+                    listener(device, old_status, device['status'])
+        # a board that was still booting won't cause another hotplug event,
+        # so while anything we'd miss is missing we look again now and then.
+        # A silent device, like a second chart recorder we may not have,
+        # only gets set up when something is plugged in
+        missing = [device for device in sorted_devices()
+                   if device['status'] != 'live' and device['fault'] != 'silent']
+        if missing and not _recheck_event:
+            _recheck_event = scheduler.call_later(DEVICE_RECHECK_INTERVAL, _recheck)
+
+
+def _recheck():
+    """Runs on the scheduler thread, which mustn't wait on probes, so we
+    have the hotplug thread check the devices"""
+    global _recheck_event
+    if hotplug_watcher:
+        hotplug_watcher.wake()
+    else:
+        _recheck_event = None
+
+
+def close_device(device):
+    """Let go of a device's handle, so setup_devices() opens it again.
+    Called with _check_lock held."""
+    handle = device.get('handle')
+    device['handle'] = None
+    device['status'] = 'missing'
+    if handle:
+        try:
+            handle.close()
+        except (IOError, OSError):
+            pass
+
+
+def device_lost(key):
+    """A device failed on us. The hotplug thread closes it and sets it up
+    again, it's the only one that changes devices once it's running."""
+    with _lost_lock:
+        _lost_devices.add(key)
+    if hotplug_watcher:
+        hotplug_watcher.wake()
+
+
+def start_device_monitor():
+    """Set up our devices, then keep them set up from a background thread
+    that wakes up when devices are plugged in or removed"""
+    global hotplug_watcher
+    check_devices()
+    if not hotplug_watcher:
+        hotplug_watcher = hotplug.HotplugWatcher(check_devices)
+        hotplug_watcher.start()
+
+
 def all_critical_devices_live():
     """Quick check if critical devices are live relies on side effects of check_if_all_devices_live()"""
     critical_ok = True
@@ -246,29 +465,161 @@ def all_critical_devices_live():
 #
 
 
+class SerialCommand(object):
+    """A command queued for a serial device. Works like a future: wait()
+    blocks until the device answers or gives up, and callback(command) is
+    called from the reactor thread when it does."""
+
+    def __init__(self, device, text, callback=None):
+        self.device = device
+        self.text = text
+        self.callback = callback
+        self.response = None
+        self.queued_time = time()
+        self.done_time = None
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the device to answer and return its response"""
+        self._done.wait(timeout)
+        return self.response
+
+    def latency(self):
+        """Seconds from queueing the command to getting an answer"""
+        if self.done_time is None:
+            return None
+        return self.done_time - self.queued_time
+
+    def finish(self, response):
+        self.response = response
+        self.done_time = time()
+        metrics.observe('tell_device', self.done_time - self.queued_time)
+        if response is None:
+            metrics.count('tell_device.no_answer')
+        self._done.set()
+        if self.callback:
+            try:
+                self.callback(self)
+            except Exception as e:
+                report("WARNING: Callback for %s failed: %s" % (self.device, e))
+
+
+class SerialChannel(object):
+    """Talks to one serial device from the reactor. Commands go out one at
+    a time, and the next line the device sends back answers the command
+    we are waiting on, or SERIAL_TIMEOUT passes and it gets None."""
+
+    def __init__(self, key, ser, reactor):
+        self.key = key
+        self.ser = ser
+        self.reactor = reactor
+        self.queue = collections.deque()
+        self.current = None
+        self._timeout_event = None
+        self._buffer = ""
+        self.closed = False
+        reactor.add_reader(ser, self._readable)
+
+    def submit(self, command):
+        """Queue a command. Safe to call from any thread."""
+        self.reactor.call_soon(self._submit, command)
+        return command
+
+    def _submit(self, command):
+        if self.closed:
+            command.finish(None)
+            return
+        self.queue.append(command)
+        self._send_next()
+
+    def _send_next(self):
+        if self.current or not self.queue:
+            return
+        command = self.queue.popleft()
+        try:
+            # anything still waiting is left over from before
+            self.ser.reset_input_buffer()
+            self._buffer = ""
+            self.ser.write(command.text)
+        except Exception as e:
+            debug("Can't write to", self.key + ":", e)
+            command.finish(None)
+            self._send_next()
+            return
+        self.current = command
+        self._timeout_event = self.reactor.call_later(SERIAL_TIMEOUT, self._timed_out, command)
+
+    def _answer(self, response):
+        command = self.current
+        self.current = None
+        if self._timeout_event:
+            self._timeout_event.cancel()
+            self._timeout_event = None
+        command.finish(response)
+        self._send_next()
+
+    def _timed_out(self, command):
+        if command is self.current:
+            self._answer(None)
+
+    def _readable(self):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except Exception:
+            data = ""
+        if not data:
+            # readable but nothing there means the device has gone
+            self.close()
+            return
+        self._buffer += data
+        while "\n" in self._buffer:
+            line, self._buffer = self._buffer.split("\n", 1)
+            line = line.strip()
+            if line and self.current:
+                self._answer(line)
+
+    def close(self):
+        """Stop listening, and fail anything still waiting"""
+        if self.closed:
+            return
+        self.closed = True
+        self.reactor.remove_reader(self.ser)
+        try:
+            self.ser.close()
+        except Exception:
+            pass
+        if self.current:
+            self._answer(None)
+        while self.queue:
+            self.queue.popleft().finish(None)
+
+
+def start_serial_channel(device):
+    """Start (or restart) talking to a serial device through the reactor"""
+    if device.get('channel'):
+        device['channel'].reactor.call_soon(device['channel'].close)
+    device['channel'] = SerialChannel(device['key'], device['handle'], reactor.get_reactor())
+
+
+def tell_device_async(device, text, callback=None):
+    """Queue text for a device and return a SerialCommand right away"""
+    command = SerialCommand(device, text, callback)
+    channel = devices[device].get('channel')
+    if channel and not channel.closed:
+        channel.submit(command)
+    else:
+        command.finish(None)
+    return command
+
+
+@metrics.timed('tell_device.wait')
 def tell_device(device, text):
-    ser = devices[device]['handle']
-    try:
-        ser.reset_input_buffer()
-        ser.reset_output_buffer()
-        ser.write(text)
-        sleep(RETRY_DELAY)
-        response = ser.readline().strip()
-    except:
-        response = None
-    return response
-    # for i in range(MAX_RETRIES):
-    #     ser.write(text)
-    #     sleep(RETRY_DELAY)
-    #     try:
-    #         waiting = ser.inWaiting()
-    #         response = ser.readline().strip()
-    #     except:
-    #         pass
-    #     # report("Serial Try", i, "=", response, "waiting:", waiting)
-    #     if response in locals() and RSP_ACK in response:
-    #         return response
-    #     sleep(RETRY_DELAY)
+    """Send text to a device and wait for its response.
+    Don't call this from the reactor thread, it would wait forever."""
+    return tell_device_async(device, text).wait()
 
 
 #
@@ -284,106 +635,129 @@ def display_found_object(data):
     # browser.get(url)
 
 
+def report_chart_response(command):
+    """Callback reporting what a chart recorder said, and how quickly"""
+    device = devices[command.device]
+    report("%s %s responds: %s (%.3fs)" % (command.text.capitalize(), device['name'],
+                                          command.response, command.latency()))
+
+
+def tell_charts(text, keys=None):
+    """Queue text for the connected chart recorders among keys, or all of
+    them. Returns the list of queued commands."""
+    commands = []
+    for device in sorted_devices():
+        if keys is not None and device['key'] not in keys:
+            continue
+        if 'chart' in device['key'] and is_port_active(device['port']):
+            commands.append(tell_device_async(device['key'], text,
+                                              report_chart_response))
+    return commands
+
+
 def start_chart(time):
-    """Start chart recorders and set callback timer to turn it off"""
+    """Start chart recorders and set callback timer to turn it off.
+    Returns the list of queued commands without waiting for answers."""
     global chart_timer
     # first we cancel any timer we've set before
-    if (chart_timer):
-        chart_timer.cancel()
+    if chart_timer and chart_timer.cancel():
         report("Canceling old timer")
     # tell every connected chart recorder to start
-    for device in sorted_devices():
-        if 'chart' in device['key'] and is_port_active(device['port']):
-            results = tell_device(device['key'], REQ_START)
-            report("Starting %s. It responds: %s" % (device['name'], results))
-    chart_timer = threading.Timer(time, stop_chart).start()
+    commands = tell_charts(REQ_START)
+    chart_timer = scheduler.call_later(time, stop_chart)
+    return commands
 
 
 def stop_chart():
-    """Stops chart recorders"""
-    for device in sorted_devices():
-        if 'chart' in device['key'] and is_port_active(device['port']):
-            results = tell_device(device['key'], REQ_STOP)
-            report("Stopping %s. It responds: %s" % (device['name'], results))
-
-
+    """Stops chart recorders. Returns the list of queued commands."""
+    return tell_charts(REQ_STOP)
+
+
+@metrics.timed('rfid.decode')
+def decode_rfid_events(events, decoder=None):
+    """Build up the RFID from the reader's key events.
+    Returns the last new RFID completed by these events, or None"""
+    decoder = decoder or rfid_decoder
+    bad_reads = decoder.bad_reads
+    rfid_good = decoder.feed(events)
+    if DEBUG >= 3:
+        debug("ID so far:", decoder.partial(), level=3)
+    if decoder.bad_reads != bad_reads:
+        report("    Received bad RFID")
+        metrics.count('rfid.bad')
+    if rfid_good:
+        report("RFID found:", rfid_good)
+        metrics.count('rfid.good')
+    return rfid_good
+
+
+@metrics.timed('listen_and_report')
 def listen_and_report():
-    """Do our main loop actions, particularly listening to the
-    RFID reader and triggering actions"""
-    global rfid_in
-    result = None 
-    rfid_good = None   
+    """Wait for the RFID reader and return the RFID it sends, or None.
+    This blocks, the main loop uses watch_rfid_reader() instead."""
+    rfid_good = None
     try:
         update("Listening for RFID")
         rfid_device = devices['rfid']['handle']
         r,w,x = select([rfid_device], [], [])
-        for event in rfid_device.read():
-            if event.type == 1 and event.value == 1:
-                key = scancodes[event.code]
-                if key != 'CRLF':
-                    if key.isdigit():
-                        rfid_in += "%02d:" % int(key)
-                    debug("Key: %s ID: %s" % (key, rfid_in), level=2)
-                else:
-                    rfid_in = rfid_in[0:-1]
-                    debug("Full id received: %s" % (rfid_in))
-                    # if the rfid has the proper length,
-                    # we can trust it
-                    if len(rfid_in) == RFID_LENGTH:
-                        rfid_good = rfid_in
-                        report("    Received good RFID:", rfid_in)
-                    else:
-                        report("    Received bad RFID:", rfid_in)
-                    rfid_in = ""
-        if rfid_good:
-            report("RFID found:", rfid_good)
-        # clear incoming buffer in case we have stuff waiting
-        # rfid_device.reset_input_buffer()
-        # rfid_device.flushInput()
-        #report("Continue listening for RFID")
-        # # do we have data on the input buffer waiting
-        # if rfid_device.in_waiting > 0:
-        #     # if we send the same rfid multiple times
-        #     #   in theory they should all be the same,
-        #     #   but in practice we are sometimes missing bytes.
-        #     #   Thus we send it multiple times to guard against data loss
-        #     rfid_good = ""
-        #     count = 0
-        #     # we keep looking if we have something waiting
-        #     #   AND we haven't exceeded our count
-        #     #   AND we haven't already rec'd a good rfid
-        #     while (rfid_device.in_waiting > 0 and count < RFID_SEND_COUNT and
-        #            not rfid_good):
-        #         rfid_in = rfid_device.readline().strip()
-        #         # if the rfid has the proper length,
-        #         # we can trust it
-        #         if len(rfid_in) == RFID_LENGTH:
-        #             rfid_good = rfid_in
-        #             report("    Received good RFID:", rfid_in)
-        #         else:
-        #             report("    Received bad RFID:", rfid_in)
-        #     if rfid_good:
-        #         report("RFID found:", rfid_good)
-        #         result = get_rfid_data(rfid_good)
-        #     # clear incoming buffer in case we have stuff waiting
-        #     rfid_device.reset_input_buffer()
-        #     rfid_device.flushInput()
-        #     report("Continue listening for RFID")
+        rfid_good = decode_rfid_events(rfid_device.read())
     except IOError:
         update("WARNING: Lost RFID device")
+        device_lost('rfid')
     return(rfid_good)
 
 
+# the reader handles we have registered with the reactor, by device key
+rfid_watched = {}
+
+
+def rfid_readable(reactor, on_rfid, key='rfid'):
+    """Reactor handler for an RFID reader"""
+    device = devices[key]
+    handle = rfid_watched[key]
+    try:
+        rfid_good = decode_rfid_events(handle.read(), decoder_for(key))
+    except IOError as e:
+        if e.errno == errno.EAGAIN:
+            return
+        update("WARNING: Lost %s" % device['name'])
+        # stop listening to the dead handle, but leave it as the one we
+        # watch, so we don't take it up again before the hotplug thread
+        # has closed it. Its status change brings us back here.
+        reactor.remove_reader(handle)
+        device_lost(key)
+        return
+    if rfid_good:
+        on_rfid(rfid_good)
+
+
+def watch_rfid_reader(reactor, on_rfid, key='rfid'):
+    """Make sure the reactor is listening to an RFID reader if it is live,
+    and not listening to an old handle if it isn't. on_rfid(rfid) is called
+    with each good RFID. Call this from the reactor thread."""
+    device = devices[key]
+    handle = device.get('handle') if device['status'] == 'live' else None
+    watched = rfid_watched.get(key)
+    if handle is watched:
+        return
+    if watched:
+        reactor.remove_reader(watched)
+    rfid_watched[key] = handle
+    decoder_for(key).reset()
+    if handle:
+        report("Listening for RFID on %s" % device['name'])
+        reactor.add_reader(handle, rfid_readable, reactor, on_rfid, key)
+
+
 def main():
-    setup_devices()
+    loop = reactor.get_reactor()
+    # follow the RFID reader as it comes and goes
+    device_listeners.append(lambda device, old_status, new_status:
+                            loop.call_soon(watch_rfid_reader, loop, report))
+    start_device_monitor()
+    watch_rfid_reader(loop, report)
     # This is our main loop that listens and responds
-    while 1:
-        # check if all of our devices are active
-        if not all_devices_live():
-            setup_devices()
-        # let's take actions if we can
-        if all_critical_devices_live():
-            listen_and_report()
+    loop.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+"""bench-catalog-scan.py: time create_catalog on a synthetic catalog
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+Run from the master directory:
+    python experiments/bench-catalog-scan.py [clips] [probe-seconds]
+Builds a temporary media dir of empty clips and a stub ffprobe that sleeps
+for probe-seconds, then scans it serially and through the pool, and
+loads it from a catalog snapshot."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import sys
+import os
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import common
+common.DEBUG = 0
+import video
+import metacache
+import scheduler
+
+
+def make_catalog(base, clips, probe_seconds):
+    os.mkdir(base + '/bin')
+    os.mkdir(base + '/media')
+    with open(base + '/bin/ffprobe', 'w') as fp:
+        fp.write('#!/bin/sh\nsleep %f\necho \'{"format": {"duration": "30.0"}}\'\n' %
+                 probe_seconds)
+    os.chmod(base + '/bin/ffprobe', 0755)
+    films = []
+    for i in range(clips):
+        filename = 'clip-%04i.mp4' % i
+        open(base + '/media/' + filename, 'w').close()
+        films.append({'file': filename, 'type': 'content', 'trigger': 'bench'})
+    return films
+
+
+def timed_scan(base, films, workers):
+    # a pool of our own, all of it free for background work
+    if scheduler._workers:
+        scheduler._workers.shutdown()
+    scheduler._workers = scheduler.WorkerPool(size=workers, reserved=0)
+    # start from a cold cache each time
+    cache_file = base + '/media/' + common.METACACHE_FILE
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+    metacache._cache = metacache.MetaCache(base + '/media/' + common.METACACHE_FILE)
+    start_time = time.time()
+    video.create_catalog(films)
+    return time.time() - start_time
+
+
+def timed_snapshot(base, films):
+    """Build the catalog with a snapshot, then time starting from it"""
+    catalog = video.create_catalog(films)
+    video.save_snapshot(catalog, video.snapshot_stamps('media/' + common.FILMDB_FILE, films))
+    start_time = time.time()
+    catalog = video.load_snapshot()
+    assert catalog is not None, "snapshot wasn't used"
+    return time.time() - start_time
+
+
+def main():
+    clips = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    probe_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    base = tempfile.mkdtemp()
+    old_cwd = os.getcwd()
+    try:
+        films = make_catalog(base, clips, probe_seconds)
+        os.environ['PATH'] = base + '/bin:' + os.environ['PATH']
+        os.chdir(base)
+        video.MEDIA_BASE = 'media'
+        workers = scheduler.WORKERS - scheduler.RESERVED_WORKERS
+        serial = timed_scan(base, films, 1)
+        pooled = timed_scan(base, films, workers)
+        snapshot = timed_snapshot(base, films)
+        print "%i clips, serial: %.2fs, %i workers: %.2fs (%.0f%%), snapshot: %.3fs" % (
+            clips, serial, workers, pooled, 100.0 * pooled / serial, snapshot)
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(base)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+"""bench-film-loader.py: compare the streaming film database loader with
+the old parse-then-byteify one
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+Run from the master directory:
+    python experiments/bench-film-loader.py [records ...]
+Writes a synthetic database of each size (10000 and 100000 records by
+default) to a temporary directory and loads it both ways."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import sys
+import os
+import time
+import json
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import video
+import filmdb
+
+TYPES = ['loop', 'transition', 'content', 'content', 'content']
+TRIGGERS = ['phone', 'hair', 'remote', 'cuba', 'radio', 'letter']
+
+
+def make_records(count):
+    random.seed(1)
+    records = []
+    for i in range(count):
+        record = {
+            'file': 'film-%06i.mp4' % i,
+            'type': random.choice(TYPES),
+            'length': round(random.uniform(1, 120), 1),
+        }
+        if record['type'] == 'content':
+            record['trigger'] = random.choice(TRIGGERS)
+            record['name'] = u'Film n\xba %i' % i
+            record['rfid'] = ":".join("%02d" % random.randint(0, 9) for d in range(10))
+            record['start'] = random.randint(0, 30)
+        if i % 25 == 0:
+            record['disabled'] = True
+        records.append(record)
+    return records
+
+
+def timed(func, *args):
+    start_time = time.time()
+    start_cpu = time.clock()
+    result = func(*args)
+    return result, time.time() - start_time, time.clock() - start_cpu
+
+
+def old_load(filename):
+    with open(filename, 'r') as fp:
+        return video.json_load_byteified(fp)
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for count in sizes:
+            filename = os.path.join(tmp_dir, 'films-%i.json' % count)
+            with open(filename, 'w') as fp:
+                json.dump(make_records(count), fp, indent=2)
+            size = os.path.getsize(filename)
+            old, old_time, old_cpu = timed(old_load, filename)
+            new, new_time, new_cpu = timed(filmdb.load_film_file, filename)
+            assert old == new, "loaders disagree"
+            print "%i records, %.1fMB" % (count, size / 1e6)
+            print "  old: %.3fs (%.3fs cpu), %.2fus/record" % (
+                old_time, old_cpu, 1e6 * old_time / count)
+            print "  new: %.3fs (%.3fs cpu), %.2fus/record, checked" % (
+                new_time, new_cpu, 1e6 * new_time / count)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+"""bench-idle-cpu.py: measure CPU used while VideoThread waits out a clip
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+Run from the master directory:
+    python experiments/bench-idle-cpu.py [seconds]
+The player is replaced with 'true' so only our own waiting is measured."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import videothread
+import scheduler
+
+STUB_CMD = ['true']
+videothread.CONTENT_CMD = STUB_CMD
+videothread.TRANSITION_CMD = STUB_CMD
+videothread.LOOP_CMD = STUB_CMD
+# skip ffprobe, we only care about the wait
+videothread.VideoThread._get_length = lambda self, filename: 1000.0
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+    film = {'file': 'stub.mp4', 'type': 'content', 'length': seconds}
+    cpu_before = scheduler.cpu_time()
+    wall_before = time.time()
+    thread = videothread.VideoThread([film], media_dir='.', debug=0)
+    thread.start()
+    thread.join()
+    # let the scheduled kill fire
+    time.sleep(videothread.INTER_VIDEO_DELAY + 0.1)
+    wall = time.time() - wall_before
+    cpu = scheduler.cpu_time() - cpu_before
+    print "wall: %.2fs  cpu: %.3fs  (%.2f%% of one core)" % (wall, cpu, 100.0 * cpu / wall)
+    print "scheduler wakeups: %i  events fired: %i" % (
+        scheduler.get_scheduler().wakeups, scheduler.get_scheduler().fired)
+    scheduler.get_scheduler().stop()
+    scheduler.get_scheduler().join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+"""bench-remote-latency.py: round trips between a master and a remote.py
+worker over loopback
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+Run from the master directory, with pyserial and evdev installed:
+    python experiments/bench-remote-latency.py [commands] [interval]
+Starts a worker on a free port with stub-player.py as omxplayer, connects
+a RemoteStation to it, and sends it commands pings, prepares and plays,
+one every interval seconds. It reports the p50/p95/p99 round trip of each
+kind of command, and how long after each play was sent the worker's
+player put up its first frame."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import sys
+import os
+import time
+import socket
+import signal
+import shutil
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+
+MASTER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, MASTER_DIR)
+
+import common
+common.DEBUG = 0
+import metacache
+import reactor
+import remote
+
+STUB_PLAYER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub-player.py')
+FILMS = [{'file': 'loop.mp4', 'type': 'loop'},
+         {'file': 'trans1.mp4', 'type': 'transition', 'length': 1.0},
+         {'file': 'content.mp4', 'type': 'content', 'length': 5.0},
+         {'file': 'trans2.mp4', 'type': 'transition', 'length': 1.0}]
+# how long we wait for the worker to start listening
+WORKER_START_TIMEOUT = 10.0
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def make_media(base):
+    """Empty clips, with their durations in the cache so nothing is probed,
+    and an 'omxplayer' on the PATH that runs the stub player"""
+    media_dir = base + '/media'
+    os.mkdir(media_dir)
+    cache = metacache.MetaCache(media_dir + '/' + common.METACACHE_FILE)
+    for film in FILMS:
+        filename = media_dir + '/' + film['file']
+        open(filename, 'w').close()
+        cache.put(filename, duration=60.0)
+    cache.save()
+    os.mkdir(base + '/bin')
+    with open(base + '/bin/omxplayer', 'w') as fp:
+        fp.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, STUB_PLAYER))
+    os.chmod(base + '/bin/omxplayer', 0755)
+    env = dict(os.environ)
+    env['PATH'] = base + '/bin:' + env['PATH']
+    env['STUB_LOG'] = base + '/players.log'
+    return media_dir, env
+
+
+def start_worker(port, media_dir, env):
+    worker = subprocess.Popen([sys.executable, os.path.join(MASTER_DIR, 'remote.py'),
+                               '--port=%i' % port, '--media=%s' % media_dir],
+                              cwd=MASTER_DIR, env=env, stdout=open(os.devnull, 'w'),
+                              stderr=subprocess.STDOUT)
+    deadline = time.time() + WORKER_START_TIMEOUT
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return worker
+        except socket.error:
+            time.sleep(0.05)
+    worker.kill()
+    raise RuntimeError("worker didn't start listening")
+
+
+def first_frames(log_file):
+    """Times the players logged a first frame"""
+    frames = []
+    try:
+        with open(log_file, 'r') as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) >= 5 and fields[3] == 'visible':
+                    frames.append(float(fields[0]))
+    except IOError:
+        pass
+    return sorted(frames)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    base = tempfile.mkdtemp()
+    worker = None
+    loop = reactor.get_reactor()
+    try:
+        media_dir, env = make_media(base)
+        port = free_port()
+        worker = start_worker(port, media_dir, env)
+        kiosk = remote.RemoteStation('bench', '127.0.0.1:%i' % port, reader=None,
+                                     media_dir=media_dir)
+        kiosk.start_players(FILMS[0], pool_size=0)
+        play_times = []
+
+        def play():
+            play_times.append(time.time())
+            kiosk.play(FILMS[1:])
+
+        def replay():
+            for i in range(count):
+                for command in (kiosk.ping, lambda: kiosk.prepare(FILMS[2]), play):
+                    loop.call_soon(command)
+                    time.sleep(interval)
+            # let the last answers and frames come in
+            time.sleep(1.0)
+            loop.call_soon(loop.stop)
+        sender = threading.Thread(target=replay, name="replay")
+        sender.daemon = True
+        print "Sending %i of each command, one every %.1fs" % (count, interval)
+        sender.start()
+        loop.run()
+        kiosk.close()
+
+        trips = defaultdict(list)
+        for op, seconds in kiosk.round_trips:
+            trips[op].append(seconds)
+        frames = first_frames(base + '/players.log')
+        for sent in play_times:
+            shown = [when for when in frames if when >= sent]
+            if shown:
+                trips['first frame'].append(shown[0] - sent)
+        print "%-12s %5s %9s %9s %9s" % ("command", "n", "p50 ms", "p95 ms", "p99 ms")
+        for op in ('ping', 'prepare', 'play', 'first frame'):
+            times = trips.get(op)
+            if not times:
+                print "%-12s %5i" % (op, 0)
+                continue
+            print "%-12s %5i %9.2f %9.2f %9.2f" % (
+                op, len(times), 1000 * percentile(times, 0.5),
+                1000 * percentile(times, 0.95), 1000 * percentile(times, 0.99))
+    finally:
+        if worker:
+            # like ^C, so the worker kills its players
+            worker.send_signal(signal.SIGINT)
+            worker.wait()
+        shutil.rmtree(base)
+
+
+if __name__ == "__main__":
+    main()
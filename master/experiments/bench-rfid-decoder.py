@@ -0,0 +1,101 @@
+#!/usr/bin/python
+"""bench-rfid-decoder.py: compare RFIDDecoder with the old string building
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+Run from the master directory:
+    python experiments/bench-rfid-decoder.py [reads]
+Feeds synthetic evdev key events for a tag held on the reader, the way
+the reader repeats it, with an occasional garbled read."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import sys
+import os
+import time
+import random
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from rfid_decoder import RFIDDecoder, KEY_ENTER
+
+Event = namedtuple('Event', 'type code value')
+
+# scancodes for the digits 0-9
+DIGIT_CODES = [11, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+SCANCODES = {11: u'0', 2: u'1', 3: u'2', 4: u'3', 5: u'4', 6: u'5', 7: u'6',
+             8: u'7', 9: u'8', 10: u'9', 28: u'CRLF'}
+RFID_LENGTH = 29
+
+
+def tag_events(tag):
+    """Key down and key up events for a tag and Enter"""
+    events = []
+    for code in [DIGIT_CODES[int(digit)] for digit in tag] + [KEY_ENTER]:
+        events.append(Event(1, code, 1))
+        events.append(Event(1, code, 0))
+    return events
+
+
+def make_events(reads):
+    random.seed(1)
+    tags = ["%010i" % random.randint(0, 0xFFFFFFFF) for i in range(5)]
+    events = []
+    for i in range(reads):
+        tag = tags[(i / 20) % len(tags)]
+        if i % 50 == 49:
+            # a dropped digit
+            tag = tag[1:]
+        events.extend(tag_events(tag))
+    return events
+
+
+def old_decode(events):
+    """What listen_and_report used to do, without the debug output"""
+    rfid_in = ""
+    found = 0
+    for event in events:
+        if event.type == 1 and event.value == 1:
+            key = SCANCODES[event.code]
+            if key != 'CRLF':
+                if key.isdigit():
+                    rfid_in += "%02d:" % int(key)
+            else:
+                rfid_in = rfid_in[0:-1]
+                if len(rfid_in) == RFID_LENGTH:
+                    found += 1
+                rfid_in = ""
+    return found
+
+
+def new_decode(events):
+    decoder = RFIDDecoder(holdoff=3.0, clock=lambda: 0.0)
+    found = 0
+    for event in events:
+        if event.type == 1 and event.value == 1:
+            if decoder.key(event.code):
+                found += 1
+    return found, decoder
+
+
+def main():
+    reads = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    events = make_events(reads)
+    start_time = time.time()
+    old_found = old_decode(events)
+    old_time = time.time() - start_time
+    start_time = time.time()
+    new_found, decoder = new_decode(events)
+    new_time = time.time() - start_time
+    print "%i reads, %i events" % (reads, len(events))
+    print "old: %.3fs, %.2fus/read, %i triggers" % (
+        old_time, 1e6 * old_time / reads, old_found)
+    print "new: %.3fs, %.2fus/read, %i triggers (%i good, %i bad, %i held)" % (
+        new_time, 1e6 * new_time / reads, new_found,
+        decoder.good_reads, decoder.bad_reads, decoder.repeats)
+
+
+if __name__ == "__main__":
+    main()
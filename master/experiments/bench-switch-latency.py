@@ -0,0 +1,136 @@
+#!/usr/bin/python
+"""bench-switch-latency.py: how long it takes to switch to a clip by
+starting a player for it, against seeking the big film to it
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+Run from the master directory, on the Pi or with stub-player.py as
+omxplayer (see its docstring):
+    python experiments/bench-switch-latency.py [switches]
+Without a session bus, or omxplayer's, we start a bus of our own.
+For spawning we time from launch until the player answers on D-Bus, which
+is as soon as we could unpause it. For seeking we time the SetPosition,
+Play and SetAlpha calls on a big film player that is already warm."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import sys
+import os
+import time
+import shutil
+import signal
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import common
+common.DEBUG = 0
+import videothread
+import playerpool
+import procmgr
+import bigfilm
+
+CLIPS = 10
+CLIP_LENGTH = 5.0
+
+
+def percentile(times, fraction):
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * fraction))]
+
+
+def summary(name, times):
+    print "%-6s n=%i  p50 %6.1fms  p95 %6.1fms  max %6.1fms" % (
+        name, len(times), 1000 * percentile(times, 0.5),
+        1000 * percentile(times, 0.95), 1000 * max(times))
+
+
+def make_media(media_dir):
+    """Empty clips, a big film and its index. The stub player doesn't
+    care what's in them."""
+    sources = {}
+    for i in range(CLIPS):
+        name = 'clip-%02i.mp4' % i
+        open(media_dir + '/' + name, 'w').close()
+        sources[name] = {'offset': i * CLIP_LENGTH, 'duration': CLIP_LENGTH,
+                         'stamp': bigfilm.file_stamp(media_dir + '/' + name)}
+    open(media_dir + '/' + common.BIG_FILM_FILE, 'w').close()
+    return bigfilm.BigFilmIndex({'file': common.BIG_FILM_FILE,
+                                 'duration': CLIPS * CLIP_LENGTH, 'sources': sources})
+
+
+def session_bus():
+    """Start a D-Bus session bus if the players wouldn't find one.
+    Returns its pid, or None if we didn't start one."""
+    if playerpool.dbus_env().get('DBUS_SESSION_BUS_ADDRESS'):
+        return None
+    try:
+        output = subprocess.check_output(['dbus-daemon', '--session', '--fork',
+                                          '--print-address=1', '--print-pid=1'])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    address, pid = output.split()[:2]
+    os.environ['DBUS_SESSION_BUS_ADDRESS'] = address
+    return int(pid)
+
+
+def time_spawn(media_dir, switches):
+    env = playerpool.dbus_env()
+    times = []
+    for i in range(switches):
+        video = {'file': 'clip-%02i.mp4' % (i % CLIPS), 'type': 'content', 'start': 1.0}
+        dbus_name = playerpool.DBUS_NAME_PREFIX + 'bench%i' % i
+        cmd = videothread.player_cmd(video, media_dir + '/' + video['file'], 1.0,
+                                     dbus_name=dbus_name)
+        start_time = time.time()
+        pgid = procmgr.spawn(cmd, video['file'])
+        deadline = start_time + playerpool.READY_TIMEOUT
+        while time.time() < deadline:
+            if playerpool.dbus_call(dbus_name, 'Play', env=env):
+                times.append(time.time() - start_time)
+                break
+            time.sleep(playerpool.READY_POLL)
+        procmgr.kill(pgid)
+    return times
+
+
+def time_seek(index, media_dir, switches):
+    player = bigfilm.BigFilmPlayer(index, media_dir)
+    player._player.ready.wait(playerpool.READY_TIMEOUT)
+    times = []
+    for i in range(switches):
+        video = {'file': 'clip-%02i.mp4' % (i % CLIPS), 'type': 'content', 'start': 1.0}
+        start_time = time.time()
+        shown = player.show(video)
+        if shown:
+            times.append(time.time() - start_time)
+    player.close()
+    return times
+
+
+def main():
+    switches = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    media_dir = tempfile.mkdtemp()
+    bus_pid = session_bus()
+    try:
+        index = make_media(media_dir)
+        seek = time_seek(index, media_dir, switches)
+        if not seek:
+            print "The big film player never answered. Is there a D-Bus session bus,"
+            print "and an omxplayer (or stub-player.py) on the PATH?"
+            return
+        spawn = time_spawn(media_dir, switches)
+        if spawn:
+            summary("spawn", spawn)
+        summary("seek", seek)
+    finally:
+        procmgr.shutdown()
+        shutil.rmtree(media_dir)
+        if bus_pid:
+            os.kill(bus_pid, signal.SIGTERM)
+
+
+if __name__ == "__main__":
+    main()
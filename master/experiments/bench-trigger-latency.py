@@ -0,0 +1,390 @@
+#!/usr/bin/python
+"""bench-trigger-latency.py: time from an RFID tag being read to its
+content being on screen, stage by stage
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+Run from the master directory, with pyserial and evdev installed:
+    python experiments/bench-trigger-latency.py [tags] [interval] [chart-delay]
+Runs the real main loop from master.py against stand-ins:
+  - an RFID reader that types tags as evdev key events down a pipe,
+  - two chart recorders on ptys that answer start and stop with OK after
+    chart-delay seconds,
+  - stub-player.py as omxplayer, logging when it puts up its first frame.
+It replays a sequence of tags, one every interval seconds, then reports
+p50/p95/p99 latency and the CPU we used for each stage, measured from the
+moment the reader sent the Enter that ends each tag:
+    decode      until the main loop has the RFID
+    start_chart queueing the chart recorder commands
+    teardown    stopping the playlist that was playing
+    spawn       launching the first player
+    trigger     all of trigger_actions
+    chart_ok    until a chart recorder said OK
+    first_frame until a player showed its first frame, usually a transition
+    content     until the content clip showed its first frame
+CPU is the main process's time while in each stage. The players' CPU is
+reported in total, since it's spent in other processes."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import sys
+import os
+import time
+import random
+import struct
+import fcntl
+import termios
+import tty
+import shutil
+import resource
+import tempfile
+import threading
+from collections import namedtuple, defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import common
+common.DEBUG = 0
+import master
+import devices
+import videothread
+import playerpool
+import station
+import metacache
+import procmgr
+import reactor
+from catalog import Catalog
+
+STUB_PLAYER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub-player.py')
+TRIGGERS = ['phone', 'hair', 'remote', 'cuba']
+CONTENT_LENGTH = 10.0
+TRANSITION_LENGTH = 1.0
+# scancodes for the digits 0-9
+DIGIT_CODES = [11, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+KEY_ENTER = 28
+EV_KEY = 1
+# how evdev events come off the pipe: type, code, value
+EVENT = struct.Struct('HHi')
+STAGES = ['decode', 'start_chart', 'teardown', 'spawn', 'trigger', 'chart_ok',
+          'first_frame', 'content']
+
+InputEvent = namedtuple('InputEvent', 'type code value')
+
+
+#
+# Stand-in devices
+#
+
+class FakeReader(object):
+    """Reads like evdev's InputDevice, types like the RFID reader"""
+
+    def __init__(self):
+        self._r, self._w = os.pipe()
+        reactor.set_nonblocking(self._r)
+        self._buffer = ""
+
+    def fileno(self):
+        return self._r
+
+    def read(self):
+        try:
+            self._buffer += os.read(self._r, 4096)
+        except OSError:
+            raise IOError(11, "no events")
+        count = len(self._buffer) / EVENT.size
+        events = [InputEvent(*EVENT.unpack_from(self._buffer, i * EVENT.size))
+                  for i in range(count)]
+        self._buffer = self._buffer[count * EVENT.size:]
+        return events
+
+    def type_tag(self, tag):
+        """Type a tag's digits then Enter. Returns when Enter was sent."""
+        data = ""
+        for digit in tag:
+            code = DIGIT_CODES[int(digit)]
+            data += EVENT.pack(EV_KEY, code, 1) + EVENT.pack(EV_KEY, code, 0)
+        os.write(self._w, data)
+        enter_time = time.time()
+        os.write(self._w, EVENT.pack(EV_KEY, KEY_ENTER, 1) + EVENT.pack(EV_KEY, KEY_ENTER, 0))
+        return enter_time
+
+
+class PtySerial(object):
+    """Our end of a pty, read and written like a pyserial port"""
+
+    def __init__(self, fd, name):
+        self.fd = fd
+        self.name = name
+        reactor.set_nonblocking(fd)
+
+    def fileno(self):
+        return self.fd
+
+    @property
+    def in_waiting(self):
+        return struct.unpack('i', fcntl.ioctl(self.fd, termios.FIONREAD, '\0' * 4))[0]
+
+    def reset_input_buffer(self):
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+
+    def read(self, size=1):
+        try:
+            return os.read(self.fd, size)
+        except OSError:
+            return ""
+
+    def write(self, data):
+        return os.write(self.fd, data)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FakeChart(threading.Thread):
+    """A chart recorder on the other end of a pty"""
+
+    def __init__(self, delay):
+        super(FakeChart, self).__init__(name="fakechart")
+        self.daemon = True
+        self.delay = delay
+        self.fd, slave_fd = os.openpty()
+        tty.setraw(self.fd)
+        tty.setraw(slave_fd)
+        self.port = PtySerial(slave_fd, os.ttyname(slave_fd))
+
+    def run(self):
+        buf = ""
+        while True:
+            try:
+                data = os.read(self.fd, 1024)
+            except OSError:
+                return
+            if not data:
+                return
+            # the recorder doesn't wait for a newline, commands come bare
+            buf += data
+            for command in (devices.REQ_START, devices.REQ_STOP):
+                while command in buf:
+                    buf = buf.replace(command, "", 1)
+                    time.sleep(self.delay)
+                    os.write(self.fd, devices.RSP_ACK + "\r\n")
+
+
+#
+# Measuring
+#
+
+class Stages(object):
+    """Wall and CPU time per stage for the trigger in progress. Stages
+    are stamped with the time they finished, and only once the trigger is
+    over are they measured from the Enter, which is filled in by the
+    replay thread once it has been sent. Called from the reactor thread."""
+
+    def __init__(self):
+        self.wall = defaultdict(list)
+        self.cpu = defaultdict(list)
+        self.current = None
+
+    def begin(self):
+        self.current = {'enter': None, 'at': {}, 'cpu': defaultdict(float)}
+
+    def timed(self, stage, func):
+        """Wrap func so time spent in it counts toward stage"""
+        def wrapper(*args, **kwargs):
+            start_cpu = time.clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if self.current:
+                    # the first call is the one that matters for latency
+                    self.current['at'].setdefault(stage, time.time())
+                    self.current['cpu'][stage] += time.clock() - start_cpu
+        return wrapper
+
+    def mark(self, stage, when=None):
+        if self.current and stage not in self.current['at']:
+            self.current['at'][stage] = when or time.time()
+
+    def end(self):
+        if self.current and self.current['enter']:
+            for stage, when in self.current['at'].items():
+                self.wall[stage].append(when - self.current['enter'])
+            for stage, seconds in self.current['cpu'].items():
+                self.cpu[stage].append(seconds)
+        self.current = None
+
+
+def percentile(times, fraction):
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * fraction))]
+
+
+def read_player_log(log_file):
+    """List of (time, file) for every first frame the players showed"""
+    frames = []
+    try:
+        with open(log_file, 'r') as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) >= 5 and fields[3] == 'visible':
+                    frames.append((float(fields[0]), os.path.basename(fields[4])))
+    except IOError:
+        pass
+    return frames
+
+
+#
+# Setup
+#
+
+def make_catalog(media_dir):
+    """A catalog of empty clips, with their durations in the cache so
+    nothing has to be probed"""
+    films = [{'file': 'loop.mp4', 'type': 'loop'},
+             {'file': 'trans1.mp4', 'type': 'transition', 'length': TRANSITION_LENGTH},
+             {'file': 'trans2.mp4', 'type': 'transition', 'length': TRANSITION_LENGTH}]
+    tags = {}
+    for i, trigger in enumerate(TRIGGERS):
+        tag = "%010i" % (1153028400 + i)
+        tags[tag] = trigger
+        films.append({'file': 'content-%s.mp4' % trigger, 'type': 'content',
+                      'trigger': trigger, 'length': CONTENT_LENGTH,
+                      'rfid': ":".join("%02d" % int(digit) for digit in tag)})
+    metacache._cache = metacache.MetaCache(media_dir + '/' + common.METACACHE_FILE)
+    lengths = {}
+    for film in films:
+        filename = media_dir + '/' + film['file']
+        open(filename, 'w').close()
+        metacache.get_cache().put(filename, duration=60.0)
+        lengths[filename] = 60.0
+    return Catalog(films, lengths, media_dir=media_dir), tags
+
+
+def make_stub_player(base):
+    """An 'omxplayer' on the PATH that runs the stub player"""
+    os.mkdir(base + '/bin')
+    with open(base + '/bin/omxplayer', 'w') as fp:
+        fp.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, STUB_PLAYER))
+    os.chmod(base + '/bin/omxplayer', 0755)
+    os.environ['PATH'] = base + '/bin:' + os.environ['PATH']
+    os.environ['STUB_LOG'] = base + '/players.log'
+    os.environ['STUB_LENGTH'] = str(CONTENT_LENGTH * 2)
+    return base + '/players.log'
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else 1.5
+    chart_delay = float(sys.argv[3]) if len(sys.argv) > 3 else 0.01
+    base = tempfile.mkdtemp()
+    stages = Stages()
+    loop = reactor.get_reactor()
+    try:
+        media_dir = base + '/media'
+        os.mkdir(media_dir)
+        catalog, tags = make_catalog(media_dir)
+        log_file = make_stub_player(base)
+        master.catalog = catalog
+        kiosk = station.Station('bench', charts=['chart1', 'chart2'], media_dir=media_dir)
+        # spawn every clip, that's the path we want to time
+        kiosk.player_pool = playerpool.PlayerPool(size=0)
+        master.stations[:] = [kiosk]
+        procmgr.watch_child_exits(loop)
+
+        # stand-ins for the devices
+        reader = FakeReader()
+        devices.devices['rfid'].update(status='live', handle=reader)
+        for key in ('chart1', 'chart2'):
+            chart = FakeChart(chart_delay)
+            chart.start()
+            devices.devices[key].update(status='live', port=chart.port.name,
+                                        handle=chart.port)
+            devices.start_serial_channel(devices.devices[key])
+
+        # time the stages
+        chart_answers = []
+
+        def on_chart_response(command):
+            if command.text == devices.REQ_START and command.response:
+                chart_answers.append(command.done_time)
+                stages.mark('chart_ok', command.done_time)
+        devices.report_chart_response = on_chart_response
+        kiosk.start_chart = stages.timed('start_chart', kiosk.start_chart)
+        videothread.VideoThread.stop = stages.timed('teardown', videothread.VideoThread.stop)
+        procmgr.spawn = stages.timed('spawn', procmgr.spawn)
+        trigger_actions = stages.timed('trigger', master.trigger_actions)
+
+        def on_rfid(rfid):
+            stages.mark('decode')
+            trigger_actions(master.get_object_trigger(rfid, master.catalog), master.catalog)
+        devices.watch_rfid_reader(loop, on_rfid)
+
+        # replay the tags, never the same one twice running so the reader's
+        # hold-off doesn't swallow any
+        random.seed(1)
+        sequence = []
+        for i in range(count):
+            choices = [tag for tag in sorted(tags) if not sequence or tag != sequence[-1]]
+            sequence.append(random.choice(choices))
+        enter_times = []
+
+        def next_trigger(ready):
+            stages.end()
+            stages.begin()
+            ready.set()
+
+        def replay():
+            for tag in sequence:
+                ready = threading.Event()
+                loop.call_soon(next_trigger, ready)
+                ready.wait()
+                stages.current['enter'] = reader.type_tag(tag)
+                enter_times.append(stages.current['enter'])
+                time.sleep(interval)
+            loop.call_soon(stages.end)
+            loop.call_soon(loop.stop)
+        player = threading.Thread(target=replay, name="replay")
+        player.daemon = True
+        print "Replaying %i tags, one every %.1fs" % (count, interval)
+        start_cpu = time.clock()
+        player.start()
+        loop.run()
+        total_cpu = time.clock() - start_cpu
+
+        # first frames come from the players' log
+        frames = read_player_log(log_file)
+        for i, (tag, enter_time) in enumerate(zip(sequence, enter_times)):
+            next_time = enter_times[i + 1] if i + 1 < len(enter_times) else float('inf')
+            shown = [(when, name) for when, name in frames if enter_time <= when < next_time]
+            if shown:
+                stages.wall['first_frame'].append(shown[0][0] - enter_time)
+            content = [when for when, name in shown
+                       if name == 'content-%s.mp4' % tags[tag]]
+            if content:
+                stages.wall['content'].append(content[0] - enter_time)
+
+        print "%-12s %5s %9s %9s %9s %10s" % ("stage", "n", "p50 ms", "p95 ms", "p99 ms", "cpu ms")
+        for stage in STAGES:
+            times = stages.wall.get(stage)
+            if not times:
+                print "%-12s %5i" % (stage, 0)
+                continue
+            cpu = stages.cpu.get(stage)
+            print "%-12s %5i %9.1f %9.1f %9.1f %10s" % (
+                stage, len(times), 1000 * percentile(times, 0.5),
+                1000 * percentile(times, 0.95), 1000 * percentile(times, 0.99),
+                "%.2f" % (1000 * sum(cpu) / len(cpu)) if cpu else "")
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        print "main process cpu: %.1fms per tag" % (1000 * total_cpu / count)
+        print "player cpu: %.1fms per tag" % (
+            1000 * (children.ru_utime + children.ru_stime) / count)
+    finally:
+        for kiosk in master.stations:
+            kiosk.close()
+        procmgr.shutdown()
+        shutil.rmtree(base)
+
+
+if __name__ == "__main__":
+    main()
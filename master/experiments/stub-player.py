@@ -0,0 +1,181 @@
+#!/usr/bin/python
+"""stub-player.py: stand-in for omxplayer for testing without a screen
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+Takes the same arguments we give omxplayer and "plays" for STUB_LENGTH
+seconds (default 60) from --pos. If the python dbus bindings are installed
+it answers the same MPRIS calls on --dbus_name that playerpool.py sends:
+Play, Pause, PlayPause, Stop, SetPosition, SetAlpha, Volume and Quit.
+
+To use it, link it as 'omxplayer' in a directory at the front of PATH:
+    mkdir -p /tmp/stub && ln -s $PWD/experiments/stub-player.py /tmp/stub/omxplayer
+    PATH=/tmp/stub:$PATH python master.py
+Every state change is printed with a timestamp so latency can be measured,
+and appended to the file named by STUB_LOG if it is set. A "visible" line
+is logged whenever the player starts showing frames: playing with its
+alpha above 0."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import sys
+import os
+import time
+
+try:
+    import dbus
+    import dbus.service
+    from dbus.mainloop.glib import DBusGMainLoop
+    import gobject
+except ImportError:
+    dbus = None
+
+MPRIS_PATH = '/org/mpris/MediaPlayer2'
+MPRIS_ROOT = 'org.mpris.MediaPlayer2'
+MPRIS_PLAYER = 'org.mpris.MediaPlayer2.Player'
+
+
+def log(*args):
+    line = "%.6f stub-player %i: %s" % (time.time(), os.getpid(), " ".join(map(str, args)))
+    print line
+    sys.stdout.flush()
+    if os.environ.get('STUB_LOG'):
+        # one write per line, so lines from several players don't mix
+        with open(os.environ['STUB_LOG'], 'a') as fp:
+            fp.write(line + "\n")
+
+
+def parse_args(argv):
+    """Pull out the omxplayer options we care about"""
+    options = {'pos': 0.0, 'dbus_name': None, 'alpha': 255, 'loop': False, 'file': None}
+    args = list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg == '--pos':
+            options['pos'] = float(args.pop(0))
+        elif arg == '--dbus_name':
+            options['dbus_name'] = args.pop(0)
+        elif arg == '--alpha':
+            options['alpha'] = int(args.pop(0))
+        elif arg == '--loop':
+            options['loop'] = True
+        elif arg in ('--layer', '--aspect-mode', '--orientation', '--win', '--display', '--vol'):
+            args.pop(0)
+        elif not arg.startswith('--'):
+            options['file'] = arg
+    return options
+
+
+class Player(object):
+    """Keeps track of where we are in the 'clip'"""
+
+    def __init__(self, options, length):
+        self.options = options
+        self.length = length
+        self.position = options['pos']
+        self.playing = True
+        self.last_tick = time.time()
+        self.visible = False
+
+    def check_visible(self):
+        visible = self.playing and self.options['alpha'] > 0
+        if visible and not self.visible:
+            log("visible", self.options['file'])
+        self.visible = visible
+
+    def tick(self):
+        now = time.time()
+        if self.playing:
+            self.position += now - self.last_tick
+        self.last_tick = now
+        if self.options['loop']:
+            return True
+        return self.position < self.length
+
+    def set_playing(self, playing):
+        self.tick()
+        if playing != self.playing:
+            self.playing = playing
+            log("playing" if playing else "paused", "at %.3f" % self.position)
+            self.check_visible()
+
+
+if dbus:
+    class MprisPlayer(dbus.service.Object):
+        """Just enough of omxplayer's MPRIS interface"""
+
+        def __init__(self, bus, player, loop):
+            dbus.service.Object.__init__(self, bus, MPRIS_PATH)
+            self.player = player
+            self.loop = loop
+
+        @dbus.service.method(MPRIS_PLAYER)
+        def Play(self):
+            self.player.set_playing(True)
+
+        @dbus.service.method(MPRIS_PLAYER)
+        def Pause(self):
+            self.player.set_playing(False)
+
+        @dbus.service.method(MPRIS_PLAYER)
+        def PlayPause(self):
+            self.player.set_playing(not self.player.playing)
+
+        @dbus.service.method(MPRIS_PLAYER)
+        def Stop(self):
+            log("stopped")
+            self.loop.quit()
+
+        @dbus.service.method(MPRIS_PLAYER, in_signature='ox')
+        def SetPosition(self, path, position):
+            self.player.tick()
+            self.player.position = position / 1000000.0
+            log("position", "%.3f" % self.player.position)
+
+        @dbus.service.method(MPRIS_PLAYER, in_signature='ox')
+        def SetAlpha(self, path, alpha):
+            self.player.options['alpha'] = alpha
+            log("alpha", alpha)
+            self.player.check_visible()
+
+        @dbus.service.method('org.freedesktop.DBus.Properties', in_signature='d')
+        def Volume(self, volume):
+            log("volume", volume)
+
+        @dbus.service.method(MPRIS_ROOT)
+        def Quit(self):
+            log("quit")
+            self.loop.quit()
+
+
+def main():
+    options = parse_args(sys.argv[1:])
+    length = float(os.environ.get('STUB_LENGTH', 60))
+    player = Player(options, length)
+    log("started", options['file'], "pos %.3f alpha %i" % (options['pos'], options['alpha']))
+    player.check_visible()
+    if dbus and options['dbus_name']:
+        DBusGMainLoop(set_as_default=True)
+        loop = gobject.MainLoop()
+        bus = dbus.SessionBus()
+        name = dbus.service.BusName(options['dbus_name'], bus)
+        mpris = MprisPlayer(bus, player, loop)
+
+        def check():
+            if not player.tick():
+                loop.quit()
+            return True
+        gobject.timeout_add(50, check)
+        loop.run()
+    else:
+        while player.tick():
+            time.sleep(0.05)
+    log("exited at %.3f" % player.position)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
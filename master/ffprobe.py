@@ -11,8 +11,10 @@
 import subprocess as sp
 import json
 from common import *
+import metrics
 
 
+@metrics.timed('ffprobe.probe')
 def probe(vid_file_path):
     ''' Give a json from ffprobe command line
 
@@ -39,6 +41,17 @@ def duration(vid_file_path):
     ''' Video's duration in seconds, return a float number
     '''
     _json = probe(vid_file_path)
+    length = duration_from_probe(_json)
+    if length is None:
+        debug(vid_file_path, 'I found no duration')
+    return length
+
+
+def duration_from_probe(_json):
+    ''' Duration in seconds from the json returned by probe(), or None
+    '''
+    if not _json:
+        return None
 
     if 'format' in _json:
         if 'duration' in _json['format']:
@@ -52,11 +65,46 @@ def duration(vid_file_path):
 
     # if everything didn't happen,
     # we got here because no single 'return' in the above happen.
-    debug(vid_file_path, 'I found no duration')
-    #return None
+    return None
+
+
+@metrics.timed('ffprobe.probe_keyframes')
+def probe_keyframes(vid_file_path):
+    ''' Give a json of the video's keyframes from ffprobe. Only the
+    keyframes are decoded, but the whole file is read, so this is slow.
+    '''
+    command = ["ffprobe",
+            "-loglevel",  "quiet",
+            "-print_format", "json",
+            "-select_streams", "v:0",
+            "-skip_frame", "nokey",
+            "-show_entries", "frame=pkt_pts_time,pts_time,best_effort_timestamp_time",
+            vid_file_path
+            ]
+
+    pipe = sp.Popen(command, stdout=sp.PIPE, stderr=sp.STDOUT)
+    out, err = pipe.communicate()
+    return json.loads(out)
+
+
+def keyframes_from_probe(_json):
+    ''' Sorted list of keyframe times in seconds from the json returned
+    by probe_keyframes(), or None
+    '''
+    if not _json or 'frames' not in _json:
+        return None
+    times = []
+    for frame in _json['frames']:
+        # which of these we get depends on the version of ffprobe
+        for field in ('pts_time', 'pkt_pts_time', 'best_effort_timestamp_time'):
+            if field in frame and frame[field] != 'N/A':
+                times.append(float(frame[field]))
+                break
+    return sorted(times)
 
 
 if __name__ == "__main__":
     video_file_path = "./test-loop.mp4"
     print "file:", video_file_path
-    print "duration:", duration(video_file_path) # 10.008
\ No newline at end of file
+    print "duration:", duration(video_file_path) # 10.008
+    print "keyframes:", keyframes_from_probe(probe_keyframes(video_file_path))
\ No newline at end of file
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+"""filmdb.py: read the film database one record at a time
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+The database is a JSON list of film records. Rather than parse the whole
+file and then walk the result again to turn unicode into byte strings,
+we read it in chunks and decode one record at a time, turning strings
+into bytes as each record is built and checking it as we go. A bad
+record is reported with its number, before anything is used."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import json
+import re
+
+#
+# Constants
+#
+
+# how much of the file we read at a time
+CHUNK_SIZE = 65536
+# the types each field can have, any other fields can be anything
+FIELD_TYPES = {
+    'file': (str,),
+    'type': (str,),
+    'name': (str,),
+    'start': (int, long, float),
+    'length': (int, long, float),
+    'trigger': (str,),
+    'rfid': (str,),
+    'disabled': (bool,),
+}
+REQUIRED_FIELDS = ('file',)
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def _byteify_list(items):
+    """Byte strings for unicode in a list. Dicts are done already."""
+    return [item.encode('utf-8') if item.__class__ is unicode
+            else _byteify_list(item) if item.__class__ is list
+            else item for item in items]
+
+
+def _byteify_pairs(pairs):
+    """object_pairs_hook that builds each dict with byte strings.
+    Most values are strings, so we check for those first."""
+    record = {}
+    for key, value in pairs:
+        if value.__class__ is unicode:
+            value = value.encode('utf-8')
+        elif value.__class__ is list:
+            value = _byteify_list(value)
+        # every record has the same few keys, so we only encode them once
+        byte_key = _keys.get(key)
+        if byte_key is None:
+            byte_key = _keys[key] = intern(key.encode('utf-8'))
+        record[byte_key] = value
+    return record
+
+
+_keys = {}
+# the decoder's own scanner, without the error formatting raw_decode
+# does, which we'd pay for every time a record runs off the end of a chunk
+_scan = json.JSONDecoder(object_pairs_hook=_byteify_pairs).scan_once
+
+
+def check_record(record, number):
+    """Raise ValueError if a film record doesn't fit the schema"""
+    if not isinstance(record, dict):
+        raise ValueError("Film record %i is not an object" % number)
+    for field in REQUIRED_FIELDS:
+        if field not in record:
+            raise ValueError("Film record %i has no '%s'" % (number, field))
+    for field, value in record.iteritems():
+        types = FIELD_TYPES.get(field)
+        if types and value is not None and not isinstance(value, types):
+            raise ValueError("Film record %i: '%s' should be %s, not %r" %
+                             (number, field, types[0].__name__, value))
+
+
+def iter_film_records(fp, chunk_size=CHUNK_SIZE):
+    """Yield each film record in an open database file, checked and with
+    byte strings. Raises ValueError if the file isn't a list of records."""
+    buf = fp.read(chunk_size)
+    eof = not buf
+    pos = _whitespace.match(buf).end()
+    if buf[pos:pos + 1] != '[':
+        raise ValueError("Film database is not a list")
+    pos += 1
+    number = 0
+    expect_comma = False
+    while True:
+        pos = _whitespace.match(buf, pos).end()
+        if pos >= len(buf) - 1 and not eof:
+            # keep only what we haven't used, and top up
+            buf = buf[pos:]
+            pos = 0
+            chunk = fp.read(chunk_size)
+            eof = not chunk
+            buf += chunk
+            continue
+        char = buf[pos:pos + 1]
+        if char == ']':
+            return
+        if not char:
+            raise ValueError("Film database ends after record %i" % number)
+        if expect_comma:
+            if char != ',':
+                raise ValueError("Expected ',' after film record %i" % number)
+            pos += 1
+            expect_comma = False
+            continue
+        try:
+            record, end = _scan(buf, pos)
+        except (StopIteration, ValueError):
+            if eof:
+                raise ValueError("Film record %i is not valid JSON" % (number + 1))
+            # the record runs past the end of what we've read
+            buf = buf[pos:]
+            pos = 0
+            chunk = fp.read(chunk_size)
+            eof = not chunk
+            buf += chunk
+            continue
+        number += 1
+        check_record(record, number)
+        yield record
+        pos = end
+        expect_comma = True
+
+
+def load_film_file(filename):
+    """Read the film database into a list of records"""
+    with open(filename, 'rb') as fp:
+        return list(iter_film_records(fp))
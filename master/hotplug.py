@@ -0,0 +1,205 @@
+#!/usr/bin/python
+"""hotplug.py: watch /dev for devices coming and going, or any other
+directory for files changing
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+Uses inotify (through ctypes, so there is nothing to install) to hear
+about device nodes being created and removed. If inotify isn't available
+we fall back to listing the directories every POLL_INTERVAL seconds."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import threading
+import ctypes
+import ctypes.util
+import struct
+import select
+import errno
+import os
+
+# local imports
+from common import *
+
+#
+# Constants
+#
+
+WATCH_DIRS = ['/dev', '/dev/input', '/dev/input/by-id']
+# how often we look if we have to poll
+POLL_INTERVAL = 2.0
+# udev makes several changes for one plug, so we wait for it to settle
+SETTLE_DELAY = 0.25
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+WATCH_MASK = (IN_ATTRIB | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVED_FROM | IN_MOVED_TO)
+# for files that are edited in place or replaced
+FILE_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """Just enough of inotify to watch a few directories"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """Watch a directory, returns False if it doesn't exist (yet)"""
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0:
+            return False
+        self.watches[wd] = path
+        return True
+
+    def read(self):
+        """Return a list of (path, mask, name) for the waiting events"""
+        try:
+            data = os.read(self.fd, 4096)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            path = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            events.append((path, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class HotplugWatcher(threading.Thread):
+    """Background thread that calls callback() whenever something changes
+    in the watched directories, once things have settled.
+    If names is given, only changes to files with those names count."""
+
+    def __init__(self, callback, watch_dirs=WATCH_DIRS, names=None, mask=WATCH_MASK,
+                 name="hotplug"):
+        super(HotplugWatcher, self).__init__(name=name)
+        self.daemon = True
+        self.callback = callback
+        self.watch_dirs = watch_dirs
+        self.names = names
+        self.mask = mask
+        self._stop = threading.Event()
+        # set by wake(), for a callback nothing changed for
+        self._wake = threading.Event()
+        try:
+            self.inotify = Inotify()
+        except (OSError, AttributeError) as e:
+            report("WARNING: No inotify (%s), polling %s" % (e, ", ".join(watch_dirs)))
+            self.inotify = None
+
+    def stop(self):
+        self._stop.set()
+
+    def wake(self):
+        """Have the thread call callback() within POLL_INTERVAL even if
+        nothing changes, for work that mustn't hold up the caller"""
+        self._wake.set()
+
+    def _woken(self):
+        if not self._wake.is_set():
+            return False
+        self._wake.clear()
+        return True
+
+    def _add_watches(self):
+        """Watch any of our directories that we aren't watching yet"""
+        watched = self.inotify.watches.values()
+        for path in self.watch_dirs:
+            if path not in watched:
+                self.inotify.add_watch(path, self.mask)
+
+    def _snapshot(self):
+        """What's in the watched directories, for when we have to poll"""
+        listing = []
+        for path in self.watch_dirs:
+            if self.names:
+                # we care about these files changing, not just appearing
+                for name in self.names:
+                    try:
+                        st = os.stat(os.path.join(path, name))
+                        listing.append((path, name, st.st_mtime, st.st_size))
+                    except OSError:
+                        listing.append((path, name, None, None))
+                continue
+            try:
+                listing.append((path, sorted(os.listdir(path))))
+            except OSError:
+                listing.append((path, None))
+        return listing
+
+    def _changed(self):
+        try:
+            self.callback()
+        except Exception as e:
+            report("WARNING: %s handler failed: %s" % (self.name, e))
+
+    def run(self):
+        if self.inotify:
+            self._run_inotify()
+        else:
+            self._run_polling()
+
+    def _run_inotify(self):
+        self._add_watches()
+        while not self._stop.is_set():
+            readable, w, x = select.select([self.inotify], [], [], POLL_INTERVAL)
+            if not readable:
+                if self._woken():
+                    self._changed()
+                continue
+            events = self.inotify.read()
+            # let udev finish, and gather up the rest of this plug's events
+            sleep(SETTLE_DELAY)
+            events += self.inotify.read()
+            debug("Hotplug events:", events, level=3)
+            # by-id may have just been created, or removed
+            self._add_watches()
+            if self.names and not [name for path, mask, name in events
+                                   if name in self.names] and not self._woken():
+                continue
+            self._wake.clear()
+            self._changed()
+        self.inotify.close()
+
+    def _run_polling(self):
+        last = self._snapshot()
+        while not self._stop.wait(POLL_INTERVAL):
+            current = self._snapshot()
+            if current != last or self._woken():
+                last = current
+                self._wake.clear()
+                self._changed()
@@ -1,3 +1,15 @@
 echo "Killing."
-killall omxplayer omxplayer.bin 2> /dev/null
-killall -9 omxplayer omxplayer.bin 2> /dev/null
+# the players master.py started are listed as "pgid program" in these
+# files, one for each master or worker running on this machine
+for REGISTRY in /tmp/truth-machine-players.pids /tmp/truth-machine-players.pids.*; do
+    [ -f $REGISTRY ] || continue
+    case $REGISTRY in *.tmp) continue;; esac
+    while read pgid program; do
+        grep -q "$program" /proc/$pgid/cmdline 2> /dev/null && kill -TERM -- -$pgid 2> /dev/null
+    done < $REGISTRY
+    sleep 1
+    while read pgid program; do
+        grep -q "$program" /proc/$pgid/cmdline 2> /dev/null && kill -KILL -- -$pgid 2> /dev/null
+    done < $REGISTRY
+    rm -f $REGISTRY
+done
@@ -11,79 +11,85 @@ import sys
 
 # local modules
 from common import *
+import common
 from devices import *
 from video import *
+import procmgr
+import reactor
+import hotplug
+import metrics
+import station
+import pagecache
 
 #
 # Constants
 #
 
+# play transitions and content by seeking in one big film, see bigfilm.py
+SINGLE_FILE_MODE = False
+# measure the hot paths, serve the numbers on metrics.METRICS_PORT and
+# log a summary every metrics.SUMMARY_INTERVAL seconds
+METRICS_ENABLED = False
+# keep the loops, transitions and recent content in the page cache, see
+# pagecache.py
+MEDIA_WARMING = True
 
 #
 # Globals
 #
-old_video_threads = []
-# A list of film records 
-# (each record of which is a film dict)
-film_list = []
-# A dictionary of lists of films, indexed by type 
-# (each record of which is a film dict)
-film_dict = {}
-# A dictionary of content types, indexed by trigger
-# (each record of which is a film dict)
-content_dict = {}
-# A dictionary of RFID -> trigger associations
-onject_dict = {}
-
-
-def create_object_dict(object_list):
-    """Iterate through content db and create dict keyed by trigger"""
-    # look through all films in the content list
-    object_dict = {'default': 'default'}
-    for obj in object_list:
-        # if a film has a trigger key
-        if 'trigger' in obj and 'rfid' in obj:
-            # get the object's trigger and rfid values
-            trigger_value = obj['trigger']
-            rfid_value = obj['rfid']
-            # create an entry of triggers indexed by rfid
-            object_dict[rfid_value] = trigger_value
-    return object_dict
-
-
-def trigger_actions(trigger, transition_list, content_dict):
-    """Trigger all of the actions specified by the database"""
-    global old_content_thread
-    if trigger in content_dict:
-        content_film = choice(content_dict[trigger])
-        debug('Content:', content_film)
-        duration = content_film['length']
-        # start chart recorder
-        debug("Starting chart recorder")
-        start_chart(duration)
-        debug("Chart recorder started")
-        # kill old film if necessary
-        # try:
-        while old_video_threads:
-            thread = old_video_threads.pop()
-            thread.stop()
-        # except:
-        #     pass
-        # start films
-        trans1_film = choice(transition_list)
-        trans2_film = choice(transition_list)
-        content_thread = videothread.VideoThread([trans1_film, content_film, trans2_film],
-                                                 media_dir=MEDIA_BASE, debug=DEBUG)
-        content_thread.start()
-        old_video_threads.append(content_thread)
-
-
-def get_object_trigger(rfid, object_dict):
-    if rfid not in object_dict:
+
+# the stations we run, see station.py
+stations = []
+# All of our films, indexed by type, trigger, rfid and file
+catalog = None
+# the newest catalog, which may not be in use yet. Only the database
+# watcher thread touches it
+loaded_catalog = None
+
+
+def trigger_actions(trigger, catalog, kiosk=None):
+    """Trigger all of the actions specified by the database, on the
+    first station unless we're told which"""
+    (kiosk or stations[0]).trigger(trigger, catalog)
+
+
+def reload_catalog(loop):
+    """The database file changed. Build a new catalog from the changes,
+    then have the reactor swap it in between triggers. Runs on the
+    database watcher thread, so the idle loop plays on undisturbed."""
+    global loaded_catalog
+    report("Reloading film database")
+    try:
+        film_list = read_film_file(MEDIA_BASE + '/' + FILMDB_FILE)
+        new_catalog = update_catalog(loaded_catalog, film_list)
+    except (IOError, ValueError, KeyError, TypeError, AttributeError) as e:
+        # probably caught halfway through being saved, we'll hear again
+        report("WARNING: Can't reload film database, keeping the old one: %s" % e)
+        return
+    if new_catalog is None:
+        debug("Film database unchanged")
+        return
+    loaded_catalog = new_catalog
+    loop.call_soon(swap_catalog, new_catalog)
+
+
+def swap_catalog(new_catalog):
+    """Start using a reloaded catalog. Runs on the reactor thread"""
+    global catalog
+    catalog = new_catalog
+    report("Film database reloaded: %i films" % len(catalog))
+    for kiosk in stations:
+        kiosk.use_catalog(catalog)
+    pagecache.use_catalog(catalog)
+
+
+def get_object_trigger(rfid, catalog):
+    trigger = catalog.trigger_for_rfid(rfid)
+    if trigger is None:
         debug("RFID", rfid, "not in object database")
         # rfid = "default"
         return None
-    return object_dict[rfid]
+    return trigger
 
 
 #
@@ -91,44 +97,104 @@ def get_object_trigger(rfid, object_dict):
 #
 
 def main():
+    global catalog, loaded_catalog
+    # with --station=NAME we only run that station, and leave the
+    # others' devices to their own masters
+    names = [arg.split('=', 1)[1] for arg in sys.argv[1:] if arg.startswith('--station=')]
+    if names and common.LOG_FILE:
+        # the log is opened and rotated by the first thing we log, so we
+        # pick our own before that
+        base, ext = os.path.splitext(common.LOG_FILE)
+        common.LOG_FILE = base + '.' + '.'.join(names) + ext
+    stations[:] = station.configured_stations(names)
+    if names:
+        keep_devices(sum([kiosk.device_keys() for kiosk in stations], []))
+        # and their players, so we don't kill each other's at startup.
+        # Each master locks the serial ports it uses, and the others
+        # don't probe those
+        procmgr.REGISTRY_FILE += '.' + '.'.join(names)
     # setup everything
+    if METRICS_ENABLED:
+        # masters running different stations each need their own port
+        first = [config['name'] for config in station.STATIONS].index(stations[0].name)
+        metrics.enable(port=metrics.METRICS_PORT + first)
+    procmgr.cleanup_stale()
     report("Reading film database")
-    film_list = read_film_file(MEDIA_BASE + '/' + FILMDB_FILE)
-    debug("\nfilm_list = \n", pformat(film_list), level=2)
-    film_dict = create_film_lists_dict(film_list)
-    debug("\nfilm_dict = \n", pformat(film_dict), level=2)
-    content_dict = create_content_dict(film_dict['content'])
-    debug("\ncontent_dict = \n", pformat(content_dict), level=2)
-    object_dict = create_object_dict(film_dict["content"])
-    debug("\nobject_dict = \n", pformat(object_dict), level=2)
-
-    report("starting idle video")
-    loop_film = choice(film_dict['loop'])
-    loop_thread = videothread.VideoThread([loop_film], media_dir=MEDIA_BASE, debug=DEBUG)
-    loop_thread.start()
+    catalog = loaded_catalog = load_catalog()
+    debug("\ncatalog.films = \n", pformat(catalog.films), level=2)
+    debug("\ncatalog.by_type = \n", pformat(catalog.by_type), level=2)
+    debug("\ncatalog.by_rfid = \n", pformat(catalog.by_rfid), level=2)
+
+    if MEDIA_WARMING:
+        report("Warming media")
+        pagecache.start(catalog)
+
+    report("Starting %s" % ", ".join(kiosk.name for kiosk in stations))
+    for kiosk in stations:
+        kiosk.start(catalog, single_file=SINGLE_FILE_MODE)
+
+    loop = reactor.get_reactor()
+    # reap players as soon as they exit
+    procmgr.watch_child_exits(loop)
+
+    # the catalog can be swapped under us, so we always use the global
+    def on_trigger(trigger, kiosk):
+        if trigger:
+            kiosk.trigger(trigger, catalog)
+
+    def rfid_handler(kiosk):
+        return lambda rfid: on_trigger(get_object_trigger(rfid, catalog), kiosk)
+
+    def watch_readers():
+        for kiosk in stations:
+            kiosk.watch_reader(loop, handlers[kiosk.name])
+
+    def on_console():
+        """Without an RFID reader, in debug mode we take triggers from stdin,
+        as "trigger" for the first station or "station trigger" """
+        line = sys.stdin.readline()
+        if not line:
+            # end of input, stop listening
+            loop.remove_reader(sys.stdin)
+            return
+        words = line.split()
+        kiosk = stations[0]
+        if len(words) > 1:
+            named = [each for each in stations if each.name == words[0]]
+            if named:
+                kiosk = named[0]
+                words = words[1:]
+        if kiosk.reader_live():
+            report("RFID reader is live, ignoring typed trigger")
+            return
+        on_trigger(" ".join(words), kiosk)
+        # through the log, so it comes after what the trigger reported
+        report("Enter trigger: ")
+
+    def on_device_change(device, old_status, new_status):
+        # this comes from the hotplug thread, the reactor does the work
+        loop.call_soon(watch_readers)
+        if 'rfid' in device['key'] and new_status != 'live' and interactive:
+            loop.call_soon(report, "Enter trigger: ")
+
+    # can we do interactive input
+    interactive = DEBUG and sys.stdin.isatty()
+    handlers = dict((kiosk.name, rfid_handler(kiosk)) for kiosk in stations)
 
     report("Setting up serial devices")
-    setup_devices()
+    device_listeners.append(on_device_change)
+    start_device_monitor()
+    watch_readers()
+    report("Watching film database for changes")
+    hotplug.HotplugWatcher(lambda: reload_catalog(loop), watch_dirs=[MEDIA_BASE],
+                           names=[FILMDB_FILE], mask=hotplug.FILE_MASK,
+                           name="filmdb").start()
+    if interactive:
+        loop.add_reader(sys.stdin, on_console)
+        if not all(kiosk.reader_live() for kiosk in stations):
+            report("Enter trigger: ")
     # This is our main loop that listens and responds
-    while 1:
-        # can we do interactive input
-        if debug and devices['rfid']['status'] != 'live' and sys.stdin.isatty():
-            interactive = True
-        else:
-            interactive = False
-        # check if all of our devices are active
-        if not all_devices_live():
-            setup_devices()
-        # let's take actions if we can
-        if all_critical_devices_live() or interactive:
-            if interactive:
-                trigger = raw_input("Enter trigger: ")
-            else:
-                rfid = listen_and_report()
-                trigger = get_object_trigger(rfid, object_dict)
-            if trigger:
-                trigger_actions(trigger, film_dict['transition'], content_dict)
-                trigger = ''
+    loop.run()
 
 
 if __name__ == '__main__':
@@ -136,10 +202,8 @@ if __name__ == '__main__':
         # Enter the main loop
         main()
     except KeyboardInterrupt:
-        nullin = open(os.devnull, 'r')
-        nullout = open(os.devnull, 'w')
-        call(["killall", "-9", "omxplayer", "omxplayer.bin"], stdout=nullout, stderr=nullout)
-        nullin.close()
-        nullout.close()
+        for kiosk in stations:
+            kiosk.close()
+        procmgr.shutdown()
         report("")
         report("Exiting.")
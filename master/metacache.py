@@ -0,0 +1,177 @@
+#!/usr/bin/python
+"""metacache.py: persistent cache of media metadata so we don't fork ffprobe
+on every clip start
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT"""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import threading
+import json
+import os
+
+# local imports
+from common import *
+import ffprobe
+import scheduler
+
+#
+# Constants
+#
+
+# bump this if the layout of an entry changes
+CACHE_VERSION = 1
+# how long to wait after a change before writing the cache to disk
+SAVE_DELAY = 5.0
+
+#
+# Globals
+#
+
+# the shared cache, created on first use by get_cache()
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class MetaCache(object):
+    """On-disk JSON sidecar of ffprobe results, keyed by file path.
+    Each entry remembers the size and mtime of the file it was made from,
+    and is checked against the file with a single stat() when it is used."""
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self._entries = {}
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._save_event = None
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        """Read the cache file if there is one"""
+        try:
+            with open(self.cache_file, 'r') as fp:
+                data = json.load(fp)
+            if data.get('version') == CACHE_VERSION:
+                self._entries = data.get('entries', {})
+        except (IOError, ValueError):
+            self._entries = {}
+
+    def save(self):
+        """Write the cache file if anything changed. We write to a
+        temporary file and rename it so a crash never leaves half a cache."""
+        with self._lock:
+            if self._save_event:
+                self._save_event.cancel()
+                self._save_event = None
+            if not self._dirty:
+                return
+            data = {'version': CACHE_VERSION, 'entries': self._entries}
+            # our own, since the masters of other stations share the cache
+            tmp_file = self.cache_file + '.%i.tmp' % os.getpid()
+            try:
+                with open(tmp_file, 'w') as fp:
+                    json.dump(data, fp, indent=1, sort_keys=True)
+                os.rename(tmp_file, self.cache_file)
+                self._dirty = False
+            except (IOError, OSError) as e:
+                update("WARNING: Can't write metadata cache %s: %s" %
+                       (self.cache_file, e))
+                try:
+                    os.remove(tmp_file)
+                except OSError:
+                    pass
+
+    def save_later(self):
+        """Write the cache once things have been quiet for a while"""
+        with self._lock:
+            if not self._save_event:
+                self._save_event = scheduler.call_later(SAVE_DELAY, self.save)
+
+    def get(self, filename):
+        """Return the cache entry for filename if it is still valid,
+        otherwise None"""
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._entries.get(filename)
+            if (entry and entry['size'] == st.st_size and
+                    entry['mtime'] == st.st_mtime):
+                return entry
+        return None
+
+    def put(self, filename, **fields):
+        """Add fields to the entry for filename, starting a new entry if
+        the file has changed since the old one was made. Returns the entry."""
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._entries.get(filename)
+            if (not entry or entry['size'] != st.st_size or
+                    entry['mtime'] != st.st_mtime):
+                entry = {'size': st.st_size, 'mtime': st.st_mtime}
+                self._entries[filename] = entry
+            entry.update(fields)
+            self._dirty = True
+        return entry
+
+    def duration(self, filename):
+        """Return the duration of filename in seconds, or None.
+        Only runs ffprobe if we don't have a valid cache entry."""
+        entry = self.get(filename)
+        if entry and 'duration' in entry:
+            self.hits += 1
+            return entry['duration']
+        self.misses += 1
+        try:
+            length = ffprobe.duration_from_probe(ffprobe.probe(filename))
+        except (OSError, ValueError) as e:
+            debug("ffprobe failed for", filename + ":", e)
+            return None
+        if length is not None:
+            self.put(filename, duration=length)
+            self.save_later()
+        return length
+
+    def keyframes(self, filename):
+        """Return the sorted keyframe times of filename, or None.
+        Only runs ffprobe if we don't have a valid cache entry."""
+        entry = self.get(filename)
+        if entry and 'keyframes' in entry:
+            self.hits += 1
+            return entry['keyframes']
+        self.misses += 1
+        try:
+            times = ffprobe.keyframes_from_probe(ffprobe.probe_keyframes(filename))
+        except (OSError, ValueError) as e:
+            debug("ffprobe failed for", filename + ":", e)
+            return None
+        if times:
+            self.put(filename, keyframes=times)
+            self.save_later()
+        return times
+
+
+def get_cache():
+    """Return the shared metadata cache for MEDIA_BASE"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = MetaCache(MEDIA_BASE + '/' + METACACHE_FILE)
+        return _cache
+
+
+def duration(filename):
+    """Duration of filename in seconds from the shared cache, or None"""
+    return get_cache().duration(filename)
+
+
+def keyframes(filename):
+    """Keyframe times of filename from the shared cache, or None"""
+    return get_cache().keyframes(filename)
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+"""metrics.py: counters and timing histograms for the hot paths
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+Wrap a function with @timed('name'), time a block with span('name'), or
+count('name') something. Until enable() is called all of these do next to
+nothing: one check of a flag. Once enabled, every name gets a histogram
+of how long it took, which can be read as JSON from
+http://127.0.0.1:METRICS_PORT/ and is summarised in the log every
+SUMMARY_INTERVAL seconds."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import BaseHTTPServer
+import threading
+import bisect
+import json
+
+# local imports
+from common import *
+import scheduler
+
+#
+# Constants
+#
+
+METRICS_PORT = 8017
+SUMMARY_INTERVAL = 60.0
+# histogram bucket upper bounds in seconds, from 100us to 30s
+BUCKETS = tuple(0.0001 * 2 ** i for i in range(19))
+
+#
+# Globals
+#
+
+_enabled = False
+_lock = threading.Lock()
+# name -> Histogram
+histograms = {}
+# name -> count
+counters = {}
+
+
+class Histogram(object):
+    """Counts of durations in fixed, doubling buckets"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket the percentile falls in, or the
+        longest we've seen if that's less"""
+        wanted = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= wanted and count:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return 0.0
+
+    def summary(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.percentile(0.5), 'p95': self.percentile(0.95),
+                'p99': self.percentile(0.99), 'max': self.max}
+
+
+def observe(name, seconds):
+    """Add a duration to a histogram"""
+    if not _enabled:
+        return
+    with _lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.add(seconds)
+
+
+def count(name, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        counters[name] = counters.get(name, 0) + n
+
+
+class _Span(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time() - self.start)
+        if exc_type:
+            count(self.name + '.errors')
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+def span(name):
+    """Time a with block"""
+    if not _enabled:
+        return _null_span
+    return _Span(name)
+
+
+def timed(name):
+    """Decorator timing every call of a function"""
+    def decorate(func):
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                count(name + '.errors')
+                raise
+            finally:
+                observe(name, time() - start)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorate
+
+
+def snapshot():
+    """Everything we've measured, as plain data"""
+    with _lock:
+        return {'counters': dict(counters),
+                'histograms': dict((name, histogram.summary())
+                                   for name, histogram in histograms.items())}
+
+
+def summary_line():
+    data = snapshot()
+    parts = ["%s n=%i p50=%.1fms p95=%.1fms max=%.1fms" %
+             (name, h['count'], 1000 * h['p50'], 1000 * h['p95'], 1000 * h['max'])
+             for name, h in sorted(data['histograms'].items())]
+    parts += ["%s=%i" % item for item in sorted(data['counters'].items())]
+    return "metrics: " + "; ".join(parts)
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(snapshot(), indent=1, sort_keys=True)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        debug(format % args, level=2)
+
+
+def _summarise(interval):
+    report(summary_line())
+    scheduler.call_later(interval, _summarise, interval)
+
+
+def enable(port=METRICS_PORT, interval=SUMMARY_INTERVAL):
+    """Start measuring, serving the numbers on port and summarising them
+    every interval seconds. Either can be None to go without."""
+    global _enabled
+    _enabled = True
+    if port:
+        try:
+            server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), MetricsHandler)
+        except IOError as e:
+            report("WARNING: Can't serve metrics on port %s: %s" % (port, e))
+        else:
+            thread = threading.Thread(target=server.serve_forever, name="metrics")
+            thread.daemon = True
+            thread.start()
+            report("Serving metrics on http://127.0.0.1:%i/" % port)
+    if interval:
+        scheduler.call_later(interval, _summarise, interval)
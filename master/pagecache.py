@@ -0,0 +1,326 @@
+#!/usr/bin/python
+"""pagecache.py: keep the media we're about to play in the page cache
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+On an SD card the first play of a clip after boot, or after the kernel
+dropped it, stalls on cold reads. The warmer keeps the idle loops and every
+transition in the cache, and as much content as fits in MEDIA_CACHE_BUDGET,
+the clips triggered or predicted most recently first. Files are read ahead
+with posix_fadvise(WILLNEED), and read through if the kernel didn't take
+all of that advice, which newer kernels don't for big files. Ones we no
+longer keep are let go with DONTNEED. Every CHECK_INTERVAL we ask mincore()
+how much of each file is still resident and warm what isn't.
+
+Run it to see how much of each media file is in the cache:
+    python pagecache.py [--warm]"""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import ctypes
+import ctypes.util
+import threading
+import os
+import sys
+
+# local imports
+from common import *
+import scheduler
+import metrics
+
+#
+# Constants
+#
+
+# how much media we try to keep in the page cache, in bytes
+MEDIA_CACHE_BUDGET = 256 * 1024 * 1024
+# how often we check that what we keep is still there
+CHECK_INTERVAL = 300.0
+# read a file ahead again if less than this much of it is resident
+REWARM_BELOW = 0.9
+# how much we read at a time when we read a file through
+READ_SIZE = 1024 * 1024
+
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+PROT_READ = 1
+MAP_SHARED = 1
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+#
+# Globals
+#
+
+# the shared warmer, only there once start() is called
+_warmer = None
+
+
+def _load_libc():
+    """libc's fadvise, mmap, munmap and mincore, or None if we can't have them"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        # the 64 bit offset version works for big files on 32 bit Pis too
+        fadvise = getattr(libc, 'posix_fadvise64', None) or libc.posix_fadvise
+        fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+        libc.fadvise = fadvise
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int,
+                              ctypes.c_int, ctypes.c_long]
+        libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                                 ctypes.POINTER(ctypes.c_ubyte)]
+        return libc
+    except (OSError, AttributeError, TypeError):
+        return None
+
+
+_libc = _load_libc()
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+
+def advise(filename, advice):
+    """posix_fadvise() a whole file. Returns True if it worked."""
+    if not _libc:
+        return False
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError as e:
+        debug("Can't open", filename + ":", e)
+        return False
+    try:
+        return _libc.fadvise(fd, 0, 0, advice) == 0
+    finally:
+        os.close(fd)
+
+
+def warm(filename):
+    """Get a file into the page cache: ask the kernel to read it ahead,
+    and read it through ourselves if that doesn't do it"""
+    advise(filename, POSIX_FADV_WILLNEED)
+    if (residency(filename) or 0.0) >= REWARM_BELOW:
+        return True
+    try:
+        with open(filename, 'rb') as fp:
+            while fp.read(READ_SIZE):
+                pass
+    except IOError as e:
+        debug("Can't read", filename + ":", e)
+        return False
+    return True
+
+
+def residency(filename):
+    """How much of a file is in the page cache, from 0.0 to 1.0, or None
+    if we can't tell"""
+    if not _libc:
+        return None
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        size = os.fstat(fd).st_size
+        if size == 0:
+            return 1.0
+        addr = _libc.mmap(None, size, PROT_READ, MAP_SHARED, fd, 0)
+        if addr in (None, MAP_FAILED):
+            return None
+        try:
+            pages = (size + PAGE_SIZE - 1) // PAGE_SIZE
+            vec = (ctypes.c_ubyte * pages)()
+            if _libc.mincore(addr, size, vec) != 0:
+                return None
+            return float(sum(byte & 1 for byte in vec)) / pages
+        finally:
+            _libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+
+
+def file_size(filename):
+    try:
+        return os.stat(filename).st_size
+    except OSError:
+        return None
+
+
+class MediaWarmer(object):
+    """Keeps the pinned files, and the most recently used others that fit
+    the budget, warm. Everything slow runs as background work."""
+
+    def __init__(self, budget=MEDIA_CACHE_BUDGET):
+        self.budget = budget
+        # filename -> size, for the loops and transitions
+        self.pinned = OrderedDict()
+        # filename -> size, least recently used first
+        self.recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._check_event = None
+
+    def keeps(self, filename):
+        """Is filename one of the files we keep warm"""
+        return filename in self.pinned or filename in self.recent
+
+    def used(self):
+        """Bytes of the files we keep"""
+        return sum(self.pinned.values()) + sum(self.recent.values())
+
+    def use_catalog(self, catalog):
+        """Pin the catalog's loops and transitions, and keep its content,
+        behind what has been used recently. Files the catalog no longer
+        has are let go."""
+        scheduler.submit_background(self._use_catalog, catalog)
+
+    def _use_catalog(self, catalog):
+        names = lambda films: [catalog.media_dir + '/' + film['file'] for film in films]
+        pinned = names(catalog.of_type('loop') + catalog.of_type('transition'))
+        content = names(catalog.of_type('content'))
+        sizes = dict((filename, file_size(filename)) for filename in set(pinned + content))
+        with self._lock:
+            old = set(self.pinned) | set(self.recent)
+            self.pinned = OrderedDict((filename, sizes[filename]) for filename in pinned
+                                      if sizes[filename] is not None)
+            recent = OrderedDict((filename, sizes[filename]) for filename in content
+                                 if sizes[filename] is not None and filename not in self.recent
+                                 and filename not in self.pinned)
+            for filename, size in self.recent.items():
+                if filename in sizes and filename not in self.pinned:
+                    recent[filename] = size
+            self.recent = recent
+            dropped = old - set(self.pinned) - set(self.recent)
+            evicted = self._fit()
+        if sum(self.pinned.values()) > self.budget:
+            report("WARNING: Loops and transitions alone are over the media cache budget")
+        for filename in dropped | set(evicted):
+            advise(filename, POSIX_FADV_DONTNEED)
+        self.refresh()
+
+    def touch(self, filename):
+        """We just played, or are about to play, filename"""
+        scheduler.submit_background(self._touch, filename)
+
+    def _touch(self, filename):
+        with self._lock:
+            if filename in self.pinned:
+                return
+            size = self.recent.pop(filename, None)
+        if size is None:
+            size = file_size(filename)
+            if size is None:
+                return
+        with self._lock:
+            self.recent[filename] = size
+            evicted = self._fit()
+        for old in evicted:
+            debug("Letting", old, "out of the media cache", level=2)
+            advise(old, POSIX_FADV_DONTNEED)
+        if (residency(filename) or 0.0) < REWARM_BELOW:
+            warm(filename)
+            metrics.count('pagecache.warmed')
+
+    def _fit(self):
+        """Drop the least recently used files until we're in budget.
+        Returns their names. Called with _lock held."""
+        evicted = []
+        over = self.used() - self.budget
+        while over > 0 and self.recent:
+            filename, size = self.recent.popitem(last=False)
+            evicted.append(filename)
+            over -= size
+        return evicted
+
+    def refresh(self):
+        """Read ahead whatever we keep that isn't resident any more"""
+        with self._lock:
+            filenames = list(self.pinned) + list(reversed(self.recent))
+        warmed = 0
+        for filename in filenames:
+            if (residency(filename) or 0.0) < REWARM_BELOW:
+                if warm(filename):
+                    warmed += 1
+        if warmed:
+            debug("Read ahead", warmed, "media files")
+            metrics.count('pagecache.warmed', warmed)
+
+    def _check(self):
+        self._check_event = scheduler.call_later(CHECK_INTERVAL, self._check)
+        scheduler.submit_background(self.refresh)
+
+    def start(self):
+        if not self._check_event:
+            self._check_event = scheduler.call_later(CHECK_INTERVAL, self._check)
+
+    def stop(self):
+        if self._check_event:
+            self._check_event.cancel()
+            self._check_event = None
+
+    def residency(self):
+        """(filename, bytes, resident fraction or None, 'pinned' or 'recent')
+        for each file we keep, most wanted first"""
+        with self._lock:
+            kept = ([(filename, size, 'pinned') for filename, size in self.pinned.items()] +
+                    [(filename, size, 'recent') for filename, size in reversed(self.recent.items())])
+        return [(filename, size, residency(filename), kind) for filename, size, kind in kept]
+
+    def summary(self):
+        files = self.residency()
+        total = sum(size for filename, size, resident, kind in files)
+        resident = sum(size * (resident or 0.0) for filename, size, resident, kind in files)
+        return "Media cache: %i files, %.0fMB of %.0fMB budget, %.0f%% resident" % (
+            len(files), total / 1048576.0, self.budget / 1048576.0,
+            100.0 * resident / total if total else 100.0)
+
+
+def start(catalog, budget=MEDIA_CACHE_BUDGET):
+    """Start keeping catalog's media warm"""
+    global _warmer
+    if _warmer is None:
+        _warmer = MediaWarmer(budget)
+        _warmer.start()
+    _warmer.use_catalog(catalog)
+    return _warmer
+
+
+def use_catalog(catalog):
+    if _warmer:
+        _warmer.use_catalog(catalog)
+
+
+def keeps(filename):
+    """Are we keeping filename warm"""
+    return bool(_warmer) and _warmer.keeps(filename)
+
+
+def touch(filename):
+    """Note that filename was just played or is about to be, if we're
+    keeping media warm"""
+    if _warmer:
+        _warmer.touch(filename)
+
+
+def main():
+    import video
+    catalog = video.load_catalog()
+    warmer = MediaWarmer()
+    if '--warm' in sys.argv[1:]:
+        warmer._use_catalog(catalog)
+    else:
+        with warmer._lock:
+            for film in catalog.films:
+                filename = catalog.media_dir + '/' + film['file']
+                size = file_size(filename)
+                if size is not None:
+                    table = warmer.pinned if film['type'] != 'content' else warmer.recent
+                    table[filename] = size
+    print "%-40s %10s %9s %s" % ("file", "MB", "resident", "")
+    for filename, size, resident, kind in warmer.residency():
+        print "%-40s %10.1f %9s %s" % (os.path.basename(filename), size / 1048576.0,
+                                       "?" if resident is None else "%.0f%%" % (100 * resident),
+                                       kind)
+    print warmer.summary()
+
+
+if __name__ == '__main__':
+    main()
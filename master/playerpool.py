@@ -0,0 +1,291 @@
+#!/usr/bin/python
+"""playerpool.py: pre-spawned, paused players so a clip starts with one
+D-Bus command instead of a process launch and seek
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+A warm player is started hidden (--alpha 0) and silent (--vol) on its
+normal layer with its own --dbus_name, paused once its MPRIS interface
+answers, and then given its volume back, shown and unpaused when the
+clip is wanted. Any program that takes the omxplayer
+arguments and answers the same MPRIS calls can stand in for omxplayer,
+see experiments/stub-player.py."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import threading
+import subprocess
+import signal
+import os
+import pwd
+import itertools
+from distutils.spawn import find_executable
+
+# local imports
+from common import *
+import videothread
+import metacache
+import procmgr
+import scheduler
+
+#
+# Constants
+#
+
+# how many warm players we keep at once
+POOL_SIZE = 4
+# how long we give a player to answer on D-Bus before we give up on it
+READY_TIMEOUT = 5.0
+# how often we ask a starting player if it is ready
+READY_POLL = 0.05
+# how long a single D-Bus call may take
+DBUS_TIMEOUT = 500
+# what a warm player plays at until it's wanted, in millibels. It plays
+# for a moment before it answers D-Bus and we can pause it
+SILENT_VOL = -6000
+# the volume it gets back, as omxplayer's D-Bus Volume, where 1.0 is 0dB
+PLAY_VOLUME = 1.0
+
+DBUS_NAME_PREFIX = 'org.mpris.MediaPlayer2.omxplayer.warm'
+MPRIS_PATH = '/org/mpris/MediaPlayer2'
+MPRIS_ROOT = 'org.mpris.MediaPlayer2'
+MPRIS_PLAYER = 'org.mpris.MediaPlayer2.Player'
+# omxplayer takes Volume as a method here rather than as a property
+DBUS_PROPERTIES = 'org.freedesktop.DBus.Properties'
+# omxplayer leaves the address of its session bus here
+OMX_DBUS_FILE = '/tmp/omxplayerdbus.%s'
+
+#
+# Globals
+#
+
+# to give each warm player its own bus name
+_player_count = itertools.count(1)
+
+
+#
+# D-Bus control
+#
+
+def dbus_env():
+    """Environment for dbus-send pointing at the player's session bus"""
+    env = dict(os.environ)
+    try:
+        user = pwd.getpwuid(os.getuid()).pw_name
+        with open(OMX_DBUS_FILE % user, 'r') as fp:
+            env['DBUS_SESSION_BUS_ADDRESS'] = fp.read().strip()
+    except (IOError, KeyError):
+        pass
+    return env
+
+
+def dbus_call(dbus_name, method, *args, **kwargs):
+    """Call an MPRIS method on a player. args are dbus-send typed
+    arguments like 'int64:0'. Returns True if the player answered."""
+    interface = kwargs.get('interface', MPRIS_PLAYER)
+    cmd = ['dbus-send', '--print-reply=literal', '--session',
+           '--reply-timeout=%i' % DBUS_TIMEOUT,
+           '--dest=' + dbus_name, MPRIS_PATH, interface + '.' + method]
+    cmd += list(args)
+    try:
+        return subprocess.call(cmd, stdin=procmgr.nullin, stdout=procmgr.nullout,
+                               stderr=procmgr.nullout,
+                               env=kwargs.get('env') or dbus_env()) == 0
+    except OSError:
+        return False
+
+
+#
+# Pool
+#
+
+def film_key(video):
+    """What makes two playlist entries the same warm player"""
+    return (video['file'], video.get('start', 0.0), video['type'])
+
+
+class WarmPlayer(object):
+    """A player process started hidden and paused at the start of a clip"""
+
+    def __init__(self, video, filename, start=None, display=None):
+        self.video = video
+        self.key = film_key(video)
+        self.filename = filename
+        # where the clip starts in the file, None until spawn() looks
+        self.start = start
+        self.display = display
+        self.dbus_name = DBUS_NAME_PREFIX + str(next(_player_count))
+        self.pgid = None
+        self.ready = threading.Event()
+        self.failed = False
+        # started at SILENT_VOL, until unmute()
+        self.muted = True
+        # the worker pool task that runs spawn()
+        self.task = None
+        # who asked for it last, see PlayerPool.release()
+        self.owner = None
+
+    def spawn(self):
+        """Launch the player hidden and wait until it answers, then pause it.
+        Runs on a worker since this takes as long as a cold start."""
+        if self.start is None:
+            # this may run ffprobe, so it's done here rather than in prepare()
+            filelength = metacache.duration(self.filename) or 0
+            self.start, length = videothread.clip_bounds(self.video, filelength)
+        debug("Pre-spawning", self.filename, "at", self.start, level=2)
+        cmd = videothread.player_cmd(self.video, self.filename, self.start,
+                                     dbus_name=self.dbus_name, alpha=0,
+                                     display=self.display, vol=SILENT_VOL)
+        try:
+            self.pgid = procmgr.spawn(cmd, self.filename)
+        except OSError as e:
+            report("WARNING: Can't pre-spawn %s: %s" % (self.filename, e))
+            self.failed = True
+            self.ready.set()
+            return
+        env = dbus_env()
+        deadline = time() + READY_TIMEOUT
+        while time() < deadline and procmgr.is_running(self.pgid):
+            if dbus_call(self.dbus_name, 'Pause', env=env):
+                # pausing took a moment, so go back to where we started
+                dbus_call(self.dbus_name, 'SetPosition', 'objpath:/not/used',
+                          'int64:%i' % int(self.start * 1000000), env=env)
+                self.ready.set()
+                return
+            sleep(READY_POLL)
+        debug("Pre-spawned player never answered:", self.filename)
+        self.failed = True
+        self.kill()
+        self.ready.set()
+
+    def unmute(self, env=None):
+        """Give the player its volume back, before it plays"""
+        if self.muted:
+            self.muted = not dbus_call(self.dbus_name, 'Volume', 'double:%s' % PLAY_VOLUME,
+                                       interface=DBUS_PROPERTIES, env=env)
+
+    def play(self):
+        """Show, unmute and unpause the player. Returns True if it answered."""
+        env = dbus_env()
+        self.unmute(env)
+        if not dbus_call(self.dbus_name, 'Play', env=env):
+            return False
+        dbus_call(self.dbus_name, 'SetAlpha', 'objpath:/not/used', 'int64:255', env=env)
+        return True
+
+    def kill(self):
+        if self.task:
+            self.task.cancel()
+        if self.pgid:
+            procmgr.kill(self.pgid, signal.SIGTERM)
+
+
+class PlayerPool(object):
+    """Keeps up to POOL_SIZE players warm, one per distinct clip, on one
+    display"""
+
+    def __init__(self, size=POOL_SIZE, display=None):
+        self.size = size
+        self.display = display
+        # in the order they were prepared
+        self._players = OrderedDict()
+        self._lock = threading.Lock()
+        # without dbus-send we can't unpause anything, so we don't pre-spawn
+        self.enabled = find_executable('dbus-send') is not None
+        if not self.enabled:
+            report("WARNING: dbus-send not found, players won't be pre-spawned")
+
+    def __len__(self):
+        return len(self._players)
+
+    def is_warm(self, video):
+        """Is there a player waiting (or warming up) for this video"""
+        return film_key(video) in self._players
+
+    def prepare(self, video, media_dir, make_room=False, owner=None):
+        """Start warming a player for video if we have room, or if
+        make_room is set, by killing the content player we warmed first.
+        owner is who wants it, taking it over from whoever asked before.
+        Returns True if one is warm or warming."""
+        if (not self.enabled or video.get('type') == 'loop' or
+                video.get('disabled')):
+            return False
+        key = film_key(video)
+        evicted = None
+        with self._lock:
+            if key in self._players:
+                self._players[key].owner = owner
+                return True
+            if len(self._players) >= self.size:
+                if make_room:
+                    evicted = self._evict()
+                if evicted is None:
+                    return False
+            filename = media_dir + '/' + video['file']
+            player = WarmPlayer(video, filename, display=self.display)
+            player.owner = owner
+            self._players[key] = player
+        if evicted:
+            debug("Making room for", filename, "by killing", evicted.filename, level=2)
+            evicted.kill()
+        player.task = scheduler.submit_background(player.spawn)
+        return True
+
+    def _evict(self):
+        """Remove and return the oldest content player, or None.
+        Called with _lock held."""
+        for key, player in self._players.items():
+            if player.video.get('type') == 'content':
+                del self._players[key]
+                return player
+        return None
+
+    def take(self, video):
+        """Remove and return the warm player for video, or None.
+        If it is still starting we wait for it, since that will still be
+        quicker than starting a new one."""
+        with self._lock:
+            player = self._players.pop(film_key(video), None)
+        if not player:
+            return None
+        if player.task and player.task.cancel():
+            # it never got a worker, starting it cold is quicker than waiting
+            return None
+        player.ready.wait(READY_TIMEOUT)
+        if player.failed or not player.ready.is_set():
+            player.kill()
+            return None
+        return player
+
+    def play(self, player):
+        """Start a player we took. If it doesn't answer we kill it."""
+        if player.play():
+            return True
+        player.kill()
+        return False
+
+    def discard(self, video):
+        """Kill the warm player for video if there is one"""
+        with self._lock:
+            player = self._players.pop(film_key(video), None)
+        if player:
+            player.kill()
+
+    def release(self, video, owner):
+        """owner won't be playing video after all. Kill its warm player,
+        unless someone else has asked for it since."""
+        with self._lock:
+            player = self._players.get(film_key(video))
+            if player is None or player.owner is not owner:
+                return
+            del self._players[player.key]
+        player.kill()
+
+    def close(self):
+        """Kill all the warm players"""
+        with self._lock:
+            players = self._players.values()
+            self._players = OrderedDict()
+        for player in players:
+            player.kill()
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+"""procmgr.py: launch player processes without a shell and keep track of
+them so we can tear down exactly what we started
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+Each process is started in its own process group and recorded in a
+registry, which is also written to REGISTRY_FILE so killomx.sh, or the
+next run after a crash, can clean up after us."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import threading
+import subprocess
+import signal
+import fcntl
+import os
+
+# local imports
+from common import *
+import scheduler
+
+#
+# Constants
+#
+
+REGISTRY_FILE = '/tmp/truth-machine-players.pids'
+# how often we check for children that have exited
+REAP_INTERVAL = 5.0
+# how long processes get to exit on SIGTERM before we SIGKILL them
+SHUTDOWN_GRACE = 1.0
+
+#
+# Globals
+#
+
+# opened once and shared by every process we launch
+nullin = open(os.devnull, 'r')
+nullout = open(os.devnull, 'w')
+
+# running processes indexed by process group id: (Popen, name)
+_registry = {}
+_registry_lock = threading.Lock()
+_reap_event = None
+
+
+def _write_registry():
+    """Save the process groups we own, one 'pgid program' per line.
+    Called with _registry_lock held."""
+    tmp_file = REGISTRY_FILE + '.tmp'
+    try:
+        with open(tmp_file, 'w') as fp:
+            for pgid, (proc, name) in _registry.items():
+                fp.write("%i %s\n" % (pgid, os.path.basename(proc.argv0)))
+        os.rename(tmp_file, REGISTRY_FILE)
+    except (IOError, OSError) as e:
+        update("WARNING: Can't write process registry: %s" % e)
+
+
+def _schedule_reap():
+    global _reap_event
+    if _reap_event is None:
+        _reap_event = scheduler.call_later(REAP_INTERVAL, _periodic_reap)
+
+
+def _periodic_reap():
+    global _reap_event
+    _reap_event = None
+    if reap():
+        _schedule_reap()
+
+
+def spawn(argv, name=None, quiet=True):
+    """Launch argv directly in a new process group and register it.
+    Returns the process group id."""
+    proc = subprocess.Popen(argv, preexec_fn=os.setsid, stdin=nullin,
+                            stdout=nullout if quiet else None, close_fds=True)
+    proc.argv0 = argv[0]
+    # we called setsid, so the group id is the pid
+    pgid = proc.pid
+    with _registry_lock:
+        _registry[pgid] = (proc, name or argv[-1])
+        _write_registry()
+    _schedule_reap()
+    return pgid
+
+
+def is_running(pgid):
+    """Is a process group we started still running"""
+    with _registry_lock:
+        entry = _registry.get(pgid)
+    return entry is not None and entry[0].poll() is None
+
+
+def kill(pgid, sig=signal.SIGTERM):
+    """Signal one of our process groups. Returns False if it was gone."""
+    try:
+        os.killpg(pgid, sig)
+    except OSError:
+        return False
+    finally:
+        reap()
+    return True
+
+
+def reap():
+    """Collect any of our children that have exited, without blocking.
+    Returns the number still running."""
+    with _registry_lock:
+        exited = [pgid for pgid, (proc, name) in _registry.items()
+                  if proc.poll() is not None]
+        for pgid in exited:
+            debug("Reaped", pgid, _registry[pgid][1], level=2)
+            del _registry[pgid]
+        if exited:
+            _write_registry()
+        return len(_registry)
+
+
+def running():
+    """Return a list of (pgid, name) for processes still running"""
+    reap()
+    with _registry_lock:
+        return [(pgid, name) for pgid, (proc, name) in _registry.items()]
+
+
+def shutdown(grace=SHUTDOWN_GRACE):
+    """Terminate every process group we started, waiting up to grace
+    seconds before killing the stragglers"""
+    for pgid, name in running():
+        kill(pgid, signal.SIGTERM)
+    deadline = time() + grace
+    while reap() and time() < deadline:
+        sleep(0.05)
+    for pgid, name in running():
+        report("Killing %i (%s)" % (pgid, name))
+        kill(pgid, signal.SIGKILL)
+    # SIGKILL can't be ignored, so this won't take long
+    with _registry_lock:
+        for proc, name in _registry.values():
+            proc.wait()
+        _registry.clear()
+    try:
+        os.remove(REGISTRY_FILE)
+    except OSError:
+        pass
+
+
+def watch_child_exits(reactor):
+    """Reap our children from the reactor as soon as they exit.
+    Must be called from the main thread, since it installs a signal handler."""
+    r, w = os.pipe()
+    for fd in (r, w):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def child_exited():
+        try:
+            while os.read(r, 4096):
+                pass
+        except OSError:
+            pass
+        reap()
+
+    # the handler does nothing, the wakeup fd is what tells the reactor
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    # and we don't want SIGCHLD interrupting system calls elsewhere
+    signal.siginterrupt(signal.SIGCHLD, False)
+    signal.set_wakeup_fd(w)
+    reactor.add_reader(r, child_exited)
+
+
+def cleanup_stale():
+    """Kill players left over from a previous run that didn't shut down.
+    We only kill a group if its leader is still the program we started,
+    in case the id has been reused since."""
+    try:
+        with open(REGISTRY_FILE, 'r') as fp:
+            lines = fp.readlines()
+    except IOError:
+        return
+    for line in lines:
+        try:
+            pgid, program = line.split(None, 1)
+            pgid = int(pgid)
+            with open('/proc/%i/cmdline' % pgid, 'r') as fp:
+                cmdline = fp.read()
+        except (ValueError, IOError):
+            continue
+        if program.strip() in cmdline:
+            report("Killing leftover %i (%s)" % (pgid, program.strip()))
+            try:
+                os.killpg(pgid, signal.SIGKILL)
+            except OSError:
+                pass
+    try:
+        os.remove(REGISTRY_FILE)
+    except OSError:
+        pass
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+"""reactor.py: a select() based event loop for the main thread
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+The main loop waits on every source at once: the RFID reader, the chart
+recorder serial ports, stdin in debug mode and player exits. Each source
+has its own handler, and a handler that fails is reported and skipped so
+it can't take the others down with it. Other threads hand work to the
+loop with call_soon(), which is safe to call from anywhere."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import threading
+import collections
+import itertools
+import select
+import heapq
+import errno
+import fcntl
+import os
+
+# local imports
+from common import *
+from scheduler import ScheduledEvent
+
+#
+# Globals
+#
+
+# the shared reactor, created on first use by get_reactor()
+_reactor = None
+_reactor_lock = threading.Lock()
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def handler_name(func):
+    return getattr(func, '__name__', repr(func))
+
+
+class Reactor(object):
+    """Dispatches readable and writable file descriptors, timers and
+    callbacks from other threads, all on the thread that calls run()"""
+
+    def __init__(self):
+        # handlers indexed by fd: (file object, handler, args)
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._counter = itertools.count()
+        self._callbacks = collections.deque()
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        # writing a byte here wakes us out of select()
+        self._wake_r, self._wake_w = os.pipe()
+        set_nonblocking(self._wake_r)
+        set_nonblocking(self._wake_w)
+
+    def _wake(self):
+        """Interrupt select() if we're called from another thread"""
+        if self._thread is not threading.current_thread():
+            try:
+                os.write(self._wake_w, 'x')
+            except OSError as e:
+                # a full pipe will wake us just as well
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def add_reader(self, fileobj, handler, *args):
+        """Call handler(*args) whenever fileobj is readable.
+        fileobj can be anything with a fileno(), or an fd."""
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        with self._lock:
+            self._readers[fd] = (fileobj, handler, args)
+        self._wake()
+
+    def remove_reader(self, fileobj):
+        """Stop watching fileobj. It's fine if we weren't."""
+        with self._lock:
+            for fd, (obj, handler, args) in self._readers.items():
+                if obj is fileobj or fd == fileobj:
+                    del self._readers[fd]
+        self._wake()
+
+    def add_writer(self, fileobj, handler, *args):
+        """Call handler(*args) whenever fileobj is writable. Remove it
+        again once there's nothing to write, it's writable most of the time."""
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        with self._lock:
+            self._writers[fd] = (fileobj, handler, args)
+        self._wake()
+
+    def remove_writer(self, fileobj):
+        with self._lock:
+            for fd, (obj, handler, args) in self._writers.items():
+                if obj is fileobj or fd == fileobj:
+                    del self._writers[fd]
+        self._wake()
+
+    def call_soon(self, func, *args):
+        """Run func(*args) on the reactor thread as soon as we can"""
+        with self._lock:
+            self._callbacks.append((func, args))
+        self._wake()
+
+    def call_later(self, delay, func, *args):
+        """Run func(*args) on the reactor thread after delay seconds.
+        Returns an event that can be cancelled."""
+        event = ScheduledEvent(time() + max(delay, 0), func, args)
+        with self._lock:
+            heapq.heappush(self._timers, (event.when, next(self._counter), event))
+        self._wake()
+        return event
+
+    def stop(self):
+        self._running = False
+        self._wake()
+
+    def _dispatch(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            report("WARNING: Handler %s failed: %s" % (handler_name(func), e))
+
+    def _next_timeout(self):
+        with self._lock:
+            while self._timers and self._timers[0][2].cancelled:
+                heapq.heappop(self._timers)
+            if self._callbacks:
+                return 0
+            if not self._timers:
+                return None
+            return max(self._timers[0][0] - time(), 0)
+
+    def _drop_bad_fds(self):
+        """Forget about any fd that has been closed under us"""
+        with self._lock:
+            for handlers in (self._readers, self._writers):
+                for fd in handlers.keys():
+                    try:
+                        os.fstat(fd)
+                    except OSError:
+                        report("WARNING: Dropping closed fd %i (%s)" %
+                               (fd, handler_name(handlers[fd][1])))
+                        del handlers[fd]
+
+    def run_once(self, timeout=None):
+        """Wait for and dispatch one round of events"""
+        next_timeout = self._next_timeout()
+        if next_timeout is None or (timeout is not None and timeout < next_timeout):
+            next_timeout = timeout
+        with self._lock:
+            readers = dict(self._readers)
+            writers = dict(self._writers)
+        try:
+            readable, writable, x = select.select(readers.keys() + [self._wake_r],
+                                                  writers.keys(), [], next_timeout)
+        except (select.error, OSError, IOError) as e:
+            # a signal, or a closed fd, we'll go around again
+            if e.args[0] == errno.EBADF:
+                self._drop_bad_fds()
+            elif e.args[0] != errno.EINTR:
+                raise
+            return
+        for fd in readable:
+            if fd == self._wake_r:
+                try:
+                    while os.read(self._wake_r, 4096):
+                        pass
+                except OSError:
+                    pass
+            elif fd in readers:
+                # skip it if it was removed by an earlier handler this round
+                if fd in self._readers:
+                    fileobj, handler, args = readers[fd]
+                    self._dispatch(handler, args)
+        for fd in writable:
+            if fd in self._writers:
+                fileobj, handler, args = writers[fd]
+                self._dispatch(handler, args)
+        # timers that are due
+        now = time()
+        while True:
+            with self._lock:
+                if not self._timers or self._timers[0][0] > now:
+                    break
+                when, count, event = heapq.heappop(self._timers)
+            if not event.cancelled:
+                event.fired = True
+                self._dispatch(event.func, event.args)
+        # callbacks from other threads
+        with self._lock:
+            callbacks = self._callbacks
+            self._callbacks = collections.deque()
+        for func, args in callbacks:
+            self._dispatch(func, args)
+
+    def run(self):
+        """Run until stop() is called"""
+        self._thread = threading.current_thread()
+        self._running = True
+        while self._running:
+            self.run_once()
+
+
+def get_reactor():
+    """Return the shared reactor"""
+    global _reactor
+    with _reactor_lock:
+        if _reactor is None:
+            _reactor = Reactor()
+        return _reactor
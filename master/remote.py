@@ -0,0 +1,465 @@
+#!/usr/bin/python
+"""remote.py: play a station's films on another machine
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+The master reads the RFID, looks up the catalog and runs the chart
+recorders as usual. A RemoteStation then sends each thing it would do with
+its players to a worker on the Pi with the screen, which does it with a
+player pool of its own. Run a worker with:
+    python remote.py [--port=8018] [--host=ADDR] [--master=HOST] [--display=N] [--media=DIR]
+and give the station 'worker': 'host:port' in station.STATIONS. The worker
+needs the same media files in DIR. It listens on every interface unless
+--host picks one, and with --master it only takes commands from that host.
+While it has a master, a connection from another host is turned away.
+
+The protocol is one JSON object per line over TCP. The master sends
+    {"op": "play", "id": 7, "films": [["trans1.mp4", "transition", 0.0, 1.0], ...]}
+with a film as [file, type, start, length], and the worker answers every
+message with {"id": 7, "ok": true}, or "ok": false and an "error". The ops
+are loop, prepare, discard, play and ping. The answer to a prepare says
+whether the worker "started" a player for it. The time to each answer is kept
+as the command's round trip."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import socket
+import errno
+import collections
+import itertools
+import sys
+
+# local imports
+from common import *
+import station
+import playerpool
+import reactor
+import procmgr
+import metacache
+import metrics
+import scheduler
+
+#
+# Constants
+#
+
+WORKER_PORT = 8018
+# how long we give a worker to accept us
+CONNECT_TIMEOUT = 2.0
+# how often we try a worker we can't reach
+RECONNECT_INTERVAL = 5.0
+# how many round trips we remember
+ROUND_TRIPS = 1000
+RECV_SIZE = 4096
+# how much we let pile up for an end that isn't reading before we give up on it
+SEND_BUFFER = 1024 * 1024
+
+
+def film_to_wire(film):
+    return [film['file'], film['type'], film.get('start') or 0.0, film.get('length') or 0.0]
+
+
+def film_from_wire(data):
+    film = dict(zip(('file', 'type', 'start', 'length'), data))
+    # it goes on the end of our media dir, and nowhere else
+    path = film.get('file')
+    if (not isinstance(path, basestring) or os.path.isabs(path) or
+            '..' in path.split('/')):
+        raise ValueError("Bad film file %r" % (path,))
+    return film
+
+
+def parse_address(address):
+    """'host:port' or 'host' to (host, port)"""
+    host, sep, port = address.rpartition(':')
+    if not sep:
+        return (address, WORKER_PORT)
+    return (host, int(port))
+
+
+class LineSocket(object):
+    """A connected socket we send and receive JSON lines on, from the
+    reactor thread. Nothing blocks: what the socket won't take yet is sent
+    when the reactor finds it writable."""
+
+    def __init__(self, sock, loop):
+        self.sock = sock
+        self.loop = loop
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(0)
+        self._buffer = ""
+        self._out = ""
+        self._writing = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, message):
+        """Queue a message. Raises socket.error if the other end has
+        stopped reading."""
+        if len(self._out) > SEND_BUFFER:
+            raise socket.error(errno.ENOBUFS, "other end isn't reading")
+        self._out += json.dumps(message, separators=(',', ':')) + "\n"
+        self._flush()
+
+    def _flush(self):
+        try:
+            sent = self.sock.send(self._out)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            sent = 0
+        self._out = self._out[sent:]
+        if self._out and not self._writing:
+            self.loop.add_writer(self, self._writable)
+            self._writing = True
+        elif not self._out and self._writing:
+            self.loop.remove_writer(self)
+            self._writing = False
+
+    def _writable(self):
+        try:
+            self._flush()
+        except socket.error as e:
+            # the reader hears about it and gives up on us
+            debug("Can't send:", e)
+            self._out = ""
+            self.loop.remove_writer(self)
+            self._writing = False
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def receive(self):
+        """Read what has arrived. Returns the complete messages, or None
+        if the other end has gone. Call when the socket is readable."""
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise
+        if not data:
+            return None
+        self._buffer += data
+        lines = self._buffer.split("\n")
+        self._buffer = lines.pop()
+        return [json.loads(line) for line in lines if line.strip()]
+
+    def close(self):
+        if self._writing:
+            self.loop.remove_writer(self)
+            self._writing = False
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class RemoteStation(station.Station):
+    """A station whose players run on a worker. Call it from the reactor
+    thread, like a Station; a film we can't send is just not played."""
+
+    def __init__(self, name, worker, reader='rfid', charts=(), display=None,
+                 media_dir=MEDIA_BASE):
+        super(RemoteStation, self).__init__(name, reader, charts, display, media_dir)
+        self.address = parse_address(worker)
+        self.conn = None
+        self._ids = itertools.count(1)
+        # messages waiting for an answer, indexed by id: (op, time sent)
+        self._sent = {}
+        # (op, seconds) of the latest answers
+        self.round_trips = collections.deque(maxlen=ROUND_TRIPS)
+        # what we asked start_players() for, sent again on reconnecting
+        self._loop = None
+        self._retry_event = None
+        self._connecting = False
+        self._closed = False
+        # the id of the prepare we sent for our prediction, and the films of
+        # predictions withdrawn before the worker answered, indexed by id
+        self._predict_id = None
+        self._withdrawn = {}
+
+    def connect(self):
+        """Start connecting to the worker if we aren't. Looking it up and
+        waiting for it to accept can take seconds, so a background worker
+        does that and _connected() takes it from there."""
+        self._retry_event = None
+        if self.conn or self._connecting or self._closed:
+            return
+        self._connecting = True
+        scheduler.submit_background(self._connect)
+
+    def _connect(self):
+        loop = reactor.get_reactor()
+        try:
+            sock = socket.create_connection(self.address, CONNECT_TIMEOUT)
+        except (socket.error, IOError) as e:
+            loop.call_soon(self._connect_failed, e)
+        else:
+            loop.call_soon(self._connected, sock)
+
+    def _connect_failed(self, e):
+        self._connecting = False
+        if self._closed:
+            return
+        update("WARNING: %s: can't reach worker %s:%i: %s" % ((self.name,) + self.address + (e,)))
+        self._retry()
+
+    def _connected(self, sock):
+        """Tell the worker we reached about our loop and the films we have
+        lined up"""
+        self._connecting = False
+        if self._closed:
+            sock.close()
+            return
+        loop = reactor.get_reactor()
+        self.conn = LineSocket(sock, loop)
+        loop.add_reader(self.conn, self._readable)
+        report("%s: connected to worker %s:%i" % ((self.name,) + self.address))
+        if self._loop:
+            loop_film, single_file, pool_size = self._loop
+            self._send('loop', film=film_to_wire(loop_film), single_file=single_file,
+                       pool_size=pool_size)
+        for film in self.next_transitions + self.next_content.values():
+            self._send('prepare', film=film_to_wire(film))
+
+    def _retry(self):
+        if not self._retry_event:
+            self._retry_event = reactor.get_reactor().call_later(RECONNECT_INTERVAL, self.connect)
+
+    def _lost(self, why):
+        report("WARNING: %s: lost worker %s:%i: %s" % ((self.name,) + self.address + (why,)))
+        self._disconnect()
+        self._retry()
+
+    def _disconnect(self):
+        if self.conn:
+            reactor.get_reactor().remove_reader(self.conn)
+            self.conn.close()
+            self.conn = None
+        self._sent.clear()
+        self._withdrawn.clear()
+
+    def _send(self, op, **message):
+        """Send a message. Returns its id, or None if we aren't connected."""
+        if not self.conn:
+            return None
+        message['op'] = op
+        message['id'] = next(self._ids)
+        self._sent[message['id']] = (op, time())
+        try:
+            self.conn.send(message)
+        except (socket.error, IOError) as e:
+            self._lost(e)
+            return None
+        return message['id']
+
+    def _readable(self):
+        try:
+            answers = self.conn.receive()
+        except (socket.error, IOError, ValueError):
+            answers = None
+        if answers is None:
+            self._lost("connection closed")
+            return
+        now = time()
+        for answer in answers:
+            sent = self._sent.pop(answer.get('id'), None)
+            if not sent:
+                continue
+            op, sent_time = sent
+            self.round_trips.append((op, now - sent_time))
+            metrics.observe('remote.' + op, now - sent_time)
+            if not answer.get('ok'):
+                report("WARNING: %s: worker couldn't %s: %s" % (self.name, op, answer.get('error')))
+            self._predicted_answer(answer['id'], answer.get('started', False))
+
+    def start_players(self, loop_film, single_file=False, pool_size=playerpool.POOL_SIZE):
+        self._loop = (loop_film, single_file, pool_size)
+        # connecting sends the loop
+        self.connect()
+
+    def prepare(self, film, make_room=False):
+        if make_room:
+            self._send('prepare', film=film_to_wire(film), make_room=True)
+        else:
+            self._send('prepare', film=film_to_wire(film))
+
+    def discard(self, film):
+        self._send('discard', film=film_to_wire(film))
+
+    def prepare_predicted(self, film):
+        """Only the worker knows if it started a player for film, so we
+        return None and hear from it in _predicted_answer()"""
+        self._predict_id = self._send('prepare', film=film_to_wire(film), make_room=True)
+        return None if self._predict_id else False
+
+    def predict(self, trigger):
+        if trigger is None and self._predicted and self._predicted[1] is None:
+            # withdrawn before the worker told us if it started a player
+            self._withdrawn[self._predict_id] = self._predicted[0]
+            self._predicted = None
+            return
+        super(RemoteStation, self).predict(trigger)
+
+    def _predicted_answer(self, id, started):
+        """The worker answered a prepare, which may be for a prediction"""
+        film = self._withdrawn.pop(id, None)
+        if film is not None:
+            if started:
+                self.unpredict(film)
+        elif id == self._predict_id and self._predicted and self._predicted[1] is None:
+            self._predicted = (self._predicted[0], started)
+
+    def play(self, playlist):
+        if self._send('play', films=[film_to_wire(film) for film in playlist]) is None:
+            update("WARNING: %s: no worker, not playing" % self.name)
+
+    def ping(self):
+        return self._send('ping')
+
+    def close(self):
+        self._closed = True
+        if self._retry_event:
+            self._retry_event.cancel()
+        self._disconnect()
+        super(RemoteStation, self).close()
+
+
+class Worker(object):
+    """Plays what a master tells it to on one display. We keep playing
+    when the master goes, and take up with it again when it's back."""
+
+    def __init__(self, port=WORKER_PORT, display=None, media_dir=MEDIA_BASE, host='',
+                 master=None):
+        self.station = station.Station('worker', reader=None, display=display,
+                                       media_dir=media_dir)
+        # the only address we take commands from, or None for any
+        self.master = socket.gethostbyname(master) if master else None
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(1)
+        self.conn = None
+        # where conn is from
+        self.address = None
+        self.loop = None
+
+    def start(self, loop):
+        self.loop = loop
+        loop.add_reader(self.listener, self._accept)
+
+    def _accept(self):
+        sock, address = self.listener.accept()
+        if self.master and address[0] != self.master:
+            report("WARNING: Refusing %s:%i, we only take commands from %s" %
+                   (address + (self.master,)))
+            sock.close()
+            return
+        if self.conn:
+            # the same master starting again, which may not have been
+            # able to tell us it was going
+            if address[0] != self.address[0]:
+                report("WARNING: Refusing %s:%i, we have a master at %s:%i" %
+                       (address + self.address))
+                sock.close()
+                return
+            report("Master at %s:%i replaces the one we had" % address)
+            self._disconnect()
+        report("Master connected from %s:%i" % address)
+        self.conn = LineSocket(sock, self.loop)
+        self.address = address
+        self.loop.add_reader(self.conn, self._readable)
+
+    def _disconnect(self):
+        self.loop.remove_reader(self.conn)
+        self.conn.close()
+        self.conn = None
+
+    def _readable(self):
+        try:
+            messages = self.conn.receive()
+        except (socket.error, IOError, ValueError) as e:
+            debug("Bad read from master:", e)
+            messages = None
+        if messages is None:
+            report("Master went away")
+            self._disconnect()
+            return
+        for message in messages:
+            answer = {'id': message.get('id'), 'ok': True}
+            try:
+                answer.update(self.handle(message) or {})
+            except Exception as e:
+                answer.update(ok=False, error=str(e))
+            try:
+                self.conn.send(answer)
+            except (socket.error, IOError) as e:
+                report("Can't answer master: %s" % e)
+                self._disconnect()
+                return
+
+    def handle(self, message):
+        """Do what a message asks. Returns anything to add to the answer."""
+        op = message['op']
+        kiosk = self.station
+        if op == 'loop':
+            # a master that reconnects sends this again, we're already looping
+            if kiosk.player_pool is None:
+                kiosk.start_players(film_from_wire(message['film']), message['single_file'],
+                                    message['pool_size'])
+        elif op in ('prepare', 'discard', 'play') and kiosk.player_pool is None:
+            raise ValueError("%s before loop" % op)
+        elif op == 'prepare':
+            # the master needs to know if it should kill a player it
+            # made room for, should the prediction turn out wrong
+            film = film_from_wire(message['film'])
+            warm = kiosk.player_pool.is_warm(film)
+            kiosk.prepare(film, message.get('make_room', False))
+            return {'started': not warm and kiosk.player_pool.is_warm(film)}
+        elif op == 'discard':
+            kiosk.discard(film_from_wire(message['film']))
+        elif op == 'play':
+            kiosk.play([film_from_wire(film) for film in message['films']])
+        elif op != 'ping':
+            raise ValueError("Unknown op %s" % op)
+
+    def close(self):
+        if self.conn:
+            self._disconnect()
+        self.listener.close()
+        self.station.close()
+
+
+def main():
+    options = dict(arg[2:].split('=', 1) for arg in sys.argv[1:]
+                   if arg.startswith('--') and '=' in arg)
+    port = int(options.get('port', WORKER_PORT))
+    display = int(options['display']) if 'display' in options else None
+    media_dir = options.get('media', MEDIA_BASE)
+    host = options.get('host', '')
+    # keep the metadata cache with the media we were given
+    metacache.MEDIA_BASE = media_dir
+    # a worker on the same machine as a master keeps its own registry
+    procmgr.REGISTRY_FILE += '.%i' % port
+    procmgr.cleanup_stale()
+    loop = reactor.get_reactor()
+    procmgr.watch_child_exits(loop)
+    worker = Worker(port, display, media_dir, host, options.get('master'))
+    worker.start(loop)
+    report("Worker listening on %s:%i" % (host or '*', port))
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        report("")
+        report("Exiting.")
+    finally:
+        worker.close()
+        procmgr.shutdown()
+
+
+if __name__ == '__main__':
+    main()
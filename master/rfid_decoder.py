@@ -0,0 +1,225 @@
+#!/usr/bin/python
+"""rfid_decoder.py: turn the RFID reader's key events into tag IDs
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+The USB reader acts like a keyboard: it types the tag's ID as ten decimal
+digits followed by Enter. We keep the digits in a fixed-size buffer as
+they arrive, and check them as we go rather than building up a string.
+The reader doesn't send a checksum, but the ten digits are the tag's
+32-bit number, so we check that it fits in 32 bits.
+
+A tag left on the reader is read over and over. We only report a tag
+again once it has been away for the hold-off time.
+
+Given an RFIDTrie of the tags we know, the decoder also follows the digits
+down the trie as they come in. Once they can only be the start of tags
+with one trigger, it calls predict(trigger), so the content can be warmed
+up while the rest of the tag arrives. If the tag then turns out to be
+something else, or isn't reported, it calls predict(None)."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+from time import time
+
+#
+# Constants
+#
+
+# evdev event type and value for a key press
+EV_KEY = 1
+KEY_DOWN = 1
+# scancodes for the keys the reader sends
+KEY_ENTER = 28
+DIGIT_KEYS = {2: 1, 3: 2, 4: 3, 5: 4, 6: 5, 7: 6, 8: 7, 9: 8, 10: 9, 11: 0}
+
+# how many digits a tag has
+TAG_DIGITS = 10
+# the largest number a tag can have
+MAX_TAG_VALUE = 0xFFFFFFFF
+# how long a tag has to be gone before we report it again, in seconds
+HOLDOFF = 3.0
+
+# digit for each scancode, or -1, so a key press is one lookup
+_digit_table = tuple(DIGIT_KEYS.get(code, -1) for code in range(256))
+# how we format each digit in a tag ID, eg "00:00:01:01:05"
+_digit_text = tuple("%02d" % digit for digit in range(10))
+# the trigger of a trie node that leads to tags with different triggers
+AMBIGUOUS = object()
+
+
+class TrieNode(object):
+    __slots__ = ('children', 'trigger', 'is_tag')
+
+    def __init__(self):
+        # a node for each digit that comes next, or None
+        self.children = [None] * 10
+        # the one trigger of every tag under here, or AMBIGUOUS
+        self.trigger = None
+        # a whole tag ends here
+        self.is_tag = False
+
+
+class RFIDTrie(object):
+    """The tags we know, a digit per level, so a decoder can tell after
+    each digit which triggers the tag could still be"""
+
+    def __init__(self, triggers):
+        """triggers maps tag IDs like "00:00:01:01:05:03:08:05:09:02" to
+        triggers. Anything that isn't a tag ID, like 'default', is left out."""
+        self.root = TrieNode()
+        self.count = 0
+        for tag, trigger in triggers.items():
+            digits = tag.split(':')
+            if all(len(digit) == 2 and digit.isdigit() for digit in digits):
+                self.add([int(digit) for digit in digits], trigger)
+
+    def add(self, digits, trigger):
+        node = self.root
+        for digit in [None] + digits:
+            if digit is not None:
+                if node.children[digit] is None:
+                    node.children[digit] = TrieNode()
+                node = node.children[digit]
+            if node.trigger is None:
+                node.trigger = trigger
+            elif node.trigger != trigger:
+                node.trigger = AMBIGUOUS
+        node.is_tag = True
+        self.count += 1
+
+
+class RFIDDecoder(object):
+    """Collects key presses into tag IDs.
+    Call key() for each key press, or feed() with evdev events. Each returns
+    the tag ID when a new tag has been read, or None."""
+
+    __slots__ = ('digits', 'holdoff', 'clock', '_buffer', '_count', '_value',
+                 '_bad', '_last_tag', '_last_seen', 'good_reads', 'bad_reads',
+                 'repeats', 'trie', 'predict', '_node', '_predicted',
+                 '_last_trigger', 'predictions', 'mispredictions')
+
+    def __init__(self, digits=TAG_DIGITS, holdoff=HOLDOFF, clock=time, trie=None,
+                 predict=None):
+        self.digits = digits
+        self.holdoff = holdoff
+        self.clock = clock
+        self._buffer = bytearray(digits)
+        self.good_reads = 0
+        self.bad_reads = 0
+        self.repeats = 0
+        # see use_trie()
+        self.trie = trie
+        self.predict = predict
+        self.predictions = 0
+        self.mispredictions = 0
+        self._predicted = None
+        self._last_tag = None
+        self._last_trigger = None
+        self._last_seen = 0.0
+        self.reset()
+
+    def use_trie(self, trie, predict):
+        """Follow tags down trie, calling predict(trigger) as soon as we
+        know the trigger of the tag being read, and predict(None) if the
+        tag didn't turn out that way. None stops predicting."""
+        self.withdraw()
+        self.trie = trie
+        self.predict = predict
+        self.reset()
+
+    def withdraw(self):
+        """Take back our prediction for a partly read tag"""
+        if self._predicted is not None:
+            self._predicted = None
+            self.mispredictions += 1
+            self.predict(None)
+
+    def reset(self):
+        """Throw away a partly read tag"""
+        self._count = 0
+        self._value = 0
+        self._bad = False
+        self._node = self.trie.root if self.trie else None
+
+    def key(self, code):
+        """Handle one key press"""
+        digit = _digit_table[code] if code < 256 else -1
+        if digit >= 0:
+            if self._count < self.digits:
+                self._buffer[self._count] = digit
+                self._count += 1
+                self._value = self._value * 10 + digit
+                if self._value > MAX_TAG_VALUE:
+                    self._bad = True
+                if self._node is not None:
+                    self._follow(digit)
+            else:
+                # too many digits, we'll throw it away at the end
+                self._bad = True
+            return None
+        if code == KEY_ENTER:
+            return self._finish()
+        return None
+
+    def feed(self, events):
+        """Handle a batch of evdev events. Returns the last new tag, or None"""
+        tag = None
+        for event in events:
+            if event.type == EV_KEY and event.value == KEY_DOWN:
+                result = self.key(event.code)
+                if result:
+                    tag = result
+        return tag
+
+    def _follow(self, digit):
+        """Go down the trie a digit, and predict if that settles the trigger"""
+        node = self._node = self._node.children[digit]
+        if node is None:
+            # not a tag we know
+            self.withdraw()
+            return
+        trigger = node.trigger
+        if trigger is AMBIGUOUS or trigger == self._predicted:
+            return
+        if (trigger == self._last_trigger and
+                self.clock() - self._last_seen < self.holdoff):
+            # most likely the tag that's sitting on the reader, which
+            # won't be reported again
+            return
+        self._predicted = trigger
+        self.predictions += 1
+        self.predict(trigger)
+
+    def _finish(self):
+        good = not self._bad and self._count == self.digits
+        count = self._count
+        node = self._node
+        self.reset()
+        if not good:
+            self.bad_reads += 1
+            self.withdraw()
+            return None
+        self.good_reads += 1
+        tag = ":".join([_digit_text[d] for d in self._buffer[:count]])
+        now = self.clock()
+        if tag == self._last_tag and now - self._last_seen < self.holdoff:
+            # still the same tag sitting on the reader
+            self._last_seen = now
+            self.repeats += 1
+            self.withdraw()
+            return None
+        if node is None or not node.is_tag:
+            self.withdraw()
+        else:
+            # the prediction came true, the trigger takes it from here
+            self._predicted = None
+        self._last_tag = tag
+        self._last_trigger = node.trigger if node is not None and node.is_tag else None
+        self._last_seen = now
+        return tag
+
+    def partial(self):
+        """The digits read so far, formatted like a tag ID"""
+        return ":".join([_digit_text[d] for d in self._buffer[:self._count]])
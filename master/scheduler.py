@@ -0,0 +1,310 @@
+#!/usr/bin/python
+"""scheduler.py: a single shared timer thread for delayed and repeated
+events, and a small fixed pool of worker threads for everything that blocks
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+Timer callbacks run on the scheduler thread and must be quick. Anything that
+takes a while (playing a playlist, starting a player, probing files or
+ports) is submitted to the worker pool instead, so the number of threads we
+run stays the same however long we run. Both hand back handles that can be
+cancelled until the work starts."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import threading
+import heapq
+import itertools
+import collections
+import os
+import time
+
+# local imports
+from common import report
+
+#
+# Constants
+#
+
+# how many worker threads we run
+WORKERS = 6
+# how many of them only take urgent work like playlists, so a trigger
+# never waits behind a catalog scan or a player warming up
+RESERVED_WORKERS = 2
+
+#
+# Globals
+#
+
+# the shared scheduler, created on first use by get_scheduler()
+_scheduler = None
+_scheduler_lock = threading.Lock()
+# the shared worker pool, created on first use by get_workers()
+_workers = None
+_workers_lock = threading.Lock()
+
+
+class ScheduledEvent(object):
+    """Handle for a scheduled call. Can be cancelled until it fires."""
+
+    __slots__ = ('when', 'func', 'args', 'cancelled', 'fired')
+
+    def __init__(self, when, func, args):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+        self.fired = False
+
+    def cancel(self):
+        """Cancel the event. Returns True if it had not fired yet."""
+        self.cancelled = True
+        return not self.fired
+
+
+class Scheduler(threading.Thread):
+    """A timer heap serviced by one thread. The thread sleeps on a
+    condition until the earliest event is due, so it uses no CPU while
+    idle. Callbacks run on the scheduler thread and should be short."""
+
+    def __init__(self):
+        super(Scheduler, self).__init__(name="scheduler")
+        self.daemon = True
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._stop = False
+        # number of times we woke up, for measuring idle cost
+        self.wakeups = 0
+        self.fired = 0
+
+    def call_at(self, when, func, *args):
+        """Schedule func(*args) at the absolute time.time() value when"""
+        event = ScheduledEvent(when, func, args)
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._counter), event))
+            # wake the thread in case this is now the earliest event
+            self._cond.notify()
+        return event
+
+    def call_later(self, delay, func, *args):
+        """Schedule func(*args) after delay seconds"""
+        return self.call_at(time.time() + max(delay, 0), func, *args)
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._stop:
+                    # drop cancelled events off the top of the heap
+                    while self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                    else:
+                        timeout = self._heap[0][0] - time.time()
+                        if timeout <= 0:
+                            break
+                        self._cond.wait(timeout)
+                    self.wakeups += 1
+                if self._stop:
+                    return
+                when, count, event = heapq.heappop(self._heap)
+                event.fired = True
+            self.fired += 1
+            try:
+                event.func(*event.args)
+            except Exception as e:
+                report("WARNING: Scheduled event %s failed: %s" %
+                       (getattr(event.func, '__name__', event.func), e))
+
+
+class Task(object):
+    """Handle for work submitted to a WorkerPool. Can be cancelled until
+    a worker picks it up, and waited on for its result."""
+
+    __slots__ = ('pool', 'func', 'args', 'background', 'cancelled', 'started',
+                 'result', 'error', '_done')
+
+    def __init__(self, pool, func, args, background):
+        self.pool = pool
+        self.func = func
+        self.args = args
+        self.background = background
+        self.cancelled = False
+        self.started = False
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def cancel(self):
+        """Cancel the task. Returns True if it had not started yet."""
+        with self.pool._cond:
+            if self.started:
+                return False
+            self.cancelled = True
+        self._done.set()
+        return True
+
+    def done(self):
+        """Has it finished, or been cancelled"""
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the task to finish. Returns True if it has."""
+        return self._done.wait(timeout)
+
+    def get(self):
+        """Wait for the task and return its result, raising what it raised"""
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class WorkerPool(object):
+    """A fixed number of threads working through two queues. Urgent work
+    goes first and can use any worker; background work only ever gets
+    size - reserved workers at once. Background tasks mustn't wait on
+    other background tasks, or they could wait forever."""
+
+    def __init__(self, size=WORKERS, reserved=RESERVED_WORKERS, name="worker"):
+        self.size = size
+        self.reserved = min(reserved, size - 1)
+        self._cond = threading.Condition()
+        self._urgent = collections.deque()
+        self._background = collections.deque()
+        self._busy_background = 0
+        self._stop = False
+        self.completed = 0
+        self._threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self._work, name="%s-%i" % (name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args):
+        """Run func(*args) on the next free worker"""
+        return self._put(self._urgent, Task(self, func, args, False))
+
+    def submit_background(self, func, *args):
+        """Run func(*args) when a worker can be spared for it"""
+        return self._put(self._background, Task(self, func, args, True))
+
+    def map(self, func, items):
+        """func(item) for each item as background work. Returns the
+        results in the same order, or raises the first error."""
+        tasks = [self.submit_background(func, item) for item in items]
+        return [task.get() for task in tasks]
+
+    def _put(self, queue, task):
+        with self._cond:
+            if self._stop:
+                raise RuntimeError("Worker pool has been shut down")
+            queue.append(task)
+            self._cond.notify()
+        return task
+
+    def _next_task(self):
+        """Wait for the next task we can run, or None when we stop"""
+        with self._cond:
+            while True:
+                for queue in (self._urgent, self._background):
+                    while queue and queue[0].cancelled:
+                        queue.popleft()
+                if self._urgent:
+                    task = self._urgent.popleft()
+                    break
+                if self._background and self._busy_background < self.size - self.reserved:
+                    task = self._background.popleft()
+                    self._busy_background += 1
+                    break
+                if self._stop:
+                    return None
+                self._cond.wait()
+            task.started = True
+            return task
+
+    def _work(self):
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            try:
+                task.result = task.func(*task.args)
+            except Exception as e:
+                task.error = e
+                report("WARNING: Task %s failed: %s" %
+                       (getattr(task.func, '__name__', task.func), e))
+            finally:
+                with self._cond:
+                    self.completed += 1
+                    if task.background:
+                        self._busy_background -= 1
+                        self._cond.notify()
+                task._done.set()
+
+    def shutdown(self, timeout=None):
+        """Finish what is queued, then stop the workers"""
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+
+def get_scheduler():
+    """Return the shared scheduler, starting it if needed"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+            _scheduler.start()
+        return _scheduler
+
+
+def call_later(delay, func, *args):
+    """Schedule func(*args) on the shared scheduler after delay seconds"""
+    return get_scheduler().call_later(delay, func, *args)
+
+
+def call_at(when, func, *args):
+    """Schedule func(*args) on the shared scheduler at time when"""
+    return get_scheduler().call_at(when, func, *args)
+
+
+def get_workers():
+    """Return the shared worker pool, starting it if needed"""
+    global _workers
+    with _workers_lock:
+        if _workers is None:
+            _workers = WorkerPool()
+        return _workers
+
+
+def submit(func, *args):
+    """Run func(*args) on the shared worker pool as soon as we can"""
+    return get_workers().submit(func, *args)
+
+
+def submit_background(func, *args):
+    """Run func(*args) on the shared worker pool when it can be spared"""
+    return get_workers().submit_background(func, *args)
+
+
+def map_background(func, items):
+    """func(item) for each item on the shared worker pool, in order"""
+    return get_workers().map(func, items)
+
+
+def cpu_time():
+    """Return user+system CPU seconds used by this process so far,
+    used to check that idle waiting really is idle"""
+    t = os.times()
+    return t[0] + t[1]
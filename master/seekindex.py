@@ -0,0 +1,96 @@
+#!/usr/bin/python
+"""seekindex.py: where the keyframes are, and what a film's start costs
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+A film that starts part way into its file (like content-remote1.mp4 at 45,
+90 and 135s) makes the player decode from the keyframe before the start
+before it can show anything. We find each file's keyframes once, keep them
+in the metadata cache, and give every such film a 'seek_cost': how many
+seconds of video have to be decoded before its first frame. Starts that
+cost more than MAX_SEEK_COST are reported with the keyframe to use instead,
+or moved back to it if SNAP_STARTS is set.
+
+Run it to see the seek cost of every film:
+    python seekindex.py"""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import bisect
+
+# local imports
+from common import *
+import metacache
+import scheduler
+
+#
+# Constants
+#
+
+# how many seconds of decoding before the first frame we put up with
+MAX_SEEK_COST = 0.5
+# move a costly start back to the keyframe before it, rather than just
+# suggesting it. Each film then starts a little earlier than in the database
+SNAP_STARTS = False
+
+
+def keyframe_before(keyframes, start):
+    """The last keyframe at or before start"""
+    i = bisect.bisect_right(keyframes, start)
+    if i == 0:
+        return 0.0
+    return keyframes[i - 1]
+
+
+def seek_cost(keyframes, start):
+    """Seconds of video the player decodes before it can show start"""
+    return start - keyframe_before(keyframes, start)
+
+
+def index_catalog(catalog):
+    """Find the keyframes of every file a film starts part way into, and
+    give each of those films its seek_cost. Only files that aren't in the
+    metadata cache are probed. Returns the films that cost too much."""
+    films = [film for film in catalog.films if film.start]
+    filenames = sorted(set(catalog.media_dir + '/' + film.file for film in films))
+    if not filenames:
+        return []
+    keyframes = dict(zip(filenames, scheduler.map_background(metacache.keyframes, filenames)))
+    costly = []
+    for film in films:
+        times = keyframes[catalog.media_dir + '/' + film.file]
+        if not times:
+            continue
+        keyframe = keyframe_before(times, film.start)
+        film['seek_cost'] = film.start - keyframe
+        if film['seek_cost'] <= MAX_SEEK_COST:
+            continue
+        costly.append(film)
+        name = film.name or film.file
+        if SNAP_STARTS:
+            debug("Moving start of %s from %.2fs to keyframe at %.2fs" %
+                  (name, film.start, keyframe))
+            film.start = keyframe
+            film['seek_cost'] = 0.0
+        else:
+            update("%s starts %.2fs after a keyframe, a start of %.2f would be quicker" %
+                   (name, film['seek_cost'], keyframe))
+    return costly
+
+
+def main():
+    import video
+    catalog = video.load_catalog()
+    index_catalog(catalog)
+    metacache.get_cache().save()
+    print "%-32s %8s %8s %8s" % ("film", "start", "keyframe", "cost")
+    for film in catalog.films:
+        if 'seek_cost' in film:
+            print "%-32s %8.2f %8.2f %8.2f" % (film.name or film.file, film.start,
+                                               film.start - film['seek_cost'],
+                                               film['seek_cost'])
+
+
+if __name__ == '__main__':
+    main()
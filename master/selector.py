@@ -0,0 +1,156 @@
+#!/usr/bin/python
+"""selector.py: choose which loop, transition and content film plays next
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+Every trigger, and each film type, gets a shuffle bag: its films in a
+random order, dealt out one at a time and shuffled again once they have
+all come up. So a trigger plays each of its clips before it plays any of
+them twice. A film with "weight": 3 in the database goes in the bag three
+times, and "weight": 0 leaves it out unless that's all there is.
+
+A pick looks at the next few films in the bag and takes the cheapest,
+where the station's cost says what's warm: a film with a player waiting
+is cheaper than one in the page cache, which is cheaper than one that
+has to come off the card. A film we just played costs more than any of
+them. Films we pass over stay in the bag, so they still come up this
+round. Looking at a fixed number of films keeps each pick O(1), and a
+seed makes the whole sequence repeatable:
+    python selector.py [trigger] [picks] [seed]"""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+import random
+import sys
+
+# local imports
+from common import *
+
+#
+# Constants
+#
+
+# how many films in the bag we compare for each pick
+LOOKAHEAD = 3
+# what playing the film we just played again costs
+REPEAT_COST = 100
+# seed for the stations' selectors, None to seed from the clock
+SELECTION_SEED = None
+
+
+def film_weight(film):
+    """How many times a film goes in its bag, from its "weight" field"""
+    weight = film.get('weight')
+    if weight is None:
+        return 1
+    try:
+        return max(0, int(round(float(weight))))
+    except (TypeError, ValueError):
+        debug("Bad weight", repr(weight), "for", film['file'] + ", using 1")
+        return 1
+
+
+class ShuffleBag(object):
+    """The films of one list, dealt out in shuffled rounds"""
+
+    __slots__ = ('films', 'rng', 'bag', 'last')
+
+    def __init__(self, films, rng):
+        # the list we were made from, so we can tell when it's replaced
+        self.films = films
+        self.rng = rng
+        self.bag = []
+        self.last = None
+
+    def _refill(self):
+        bag = []
+        for film in self.films:
+            bag.extend([film] * film_weight(film))
+        if not bag:
+            bag = list(self.films)
+        self.rng.shuffle(bag)
+        self.bag = bag
+
+    def pick(self, cost=None):
+        """Deal the next film, or the cheapest of the next LOOKAHEAD
+        films if we're given a cost function"""
+        if not self.bag:
+            if not self.films:
+                return None
+            self._refill()
+        bag = self.bag
+        # we deal from the end
+        best = len(bag) - 1
+        if cost or self.last is not None:
+            best_cost = None
+            for i in range(len(bag) - 1, max(len(bag) - 1 - LOOKAHEAD, -1), -1):
+                film = bag[i]
+                this_cost = cost(film) if cost else 0
+                if film is self.last:
+                    this_cost += REPEAT_COST
+                if best_cost is None or this_cost < best_cost:
+                    best, best_cost = i, this_cost
+            bag[best], bag[-1] = bag[-1], bag[best]
+        self.last = bag.pop()
+        return self.last
+
+
+class Selector(object):
+    """Shuffle bags for a catalog's triggers and film types. A bag is
+    kept as long as the catalog hands us the same list for it, so a
+    reloaded catalog only starts over the lists that changed."""
+
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+        # ('trigger' or 'type', key) -> ShuffleBag
+        self.bags = {}
+
+    def _bag(self, key, films):
+        bag = self.bags.get(key)
+        if bag is None or bag.films is not films:
+            bag = self.bags[key] = ShuffleBag(films, self.rng)
+        return bag
+
+    def content(self, catalog, trigger, cost=None):
+        """The next content film for trigger, or None if it has none"""
+        films = catalog.content_for(trigger)
+        if not films:
+            return None
+        return self._bag(('trigger', trigger), films).pick(cost)
+
+    def of_type(self, catalog, type, cost=None):
+        """The next film of a type, eg 'loop' or 'transition', or None"""
+        return self._bag(('type', type), catalog.of_type(type)).pick(cost)
+
+    def forget(self, catalog):
+        """Drop the bags for triggers and types catalog no longer has"""
+        for kind, key in self.bags.keys():
+            index = catalog.by_trigger if kind == 'trigger' else catalog.by_type
+            if key not in index:
+                del self.bags[(kind, key)]
+
+
+def main():
+    import video
+    args = sys.argv[1:]
+    catalog = video.load_catalog()
+    trigger = args[0] if args else sorted(catalog.triggers())[0]
+    picks = int(args[1]) if len(args) > 1 else 20
+    seed = int(args[2]) if len(args) > 2 else None
+    if not catalog.content_for(trigger):
+        print "No content for trigger %r, we have %s" % (trigger, ", ".join(sorted(catalog.triggers())))
+        return
+    selector = Selector(seed)
+    counts = {}
+    for i in range(picks):
+        film = selector.content(catalog, trigger)
+        print film['file']
+        counts[film['file']] = counts.get(film['file'], 0) + 1
+    print ""
+    for filename, count in sorted(counts.items()):
+        print "%-40s %i" % (filename, count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/python
+"""station.py: one kiosk's reader, chart recorders, screen and playlists
+Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
+Copyright: 2017, MIT
+
+One master can run several stations. Each has its own RFID reader and
+chart recorders from devices.devices, plays on its own display, and keeps
+its own playlists, warm players and films lined up for the next trigger.
+They share the film catalog, the reactor and the worker pool. A trigger
+takes the reactor a few milliseconds and the players are processes of
+their own, so one master keeps up with several stations. To spread them
+over cores anyway, run one master per station with --station=NAME."""
+
+# -*- coding: iso-8859-15 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# local imports
+from common import *
+import devices
+import videothread
+import playerpool
+import bigfilm
+import scheduler
+import metrics
+import pagecache
+import selector
+from rfid_decoder import RFIDTrie
+
+#
+# Constants
+#
+
+# The stations we run. reader and charts are keys in devices.devices, each
+# reader needs a 'fixed' port and each station's charts a distinct ID.
+# display is omxplayer's --display, None for its default screen. A station
+# whose screen is on another machine names the remote.py worker there.
+STATIONS = [
+    {'name': 'main', 'reader': 'rfid', 'charts': ['chart1', 'chart2'], 'display': None},
+    # {'name': 'east', 'reader': 'rfid2', 'charts': ['chart3'], 'display': 7},
+    # {'name': 'west', 'reader': 'rfid3', 'charts': [], 'worker': 'pi-west:8018'},
+]
+
+
+class Station(object):
+    """A reader, its chart recorders and the screen that answers them"""
+
+    def __init__(self, name, reader='rfid', charts=(), display=None, media_dir=MEDIA_BASE):
+        self.name = name
+        self.reader = reader
+        self.charts = list(charts)
+        self.display = display
+        self.media_dir = media_dir
+        # pre-spawned players for the films we expect to play next
+        self.player_pool = None
+        # the warm player on the big film in single-file mode
+        self.big_film = None
+        self.loop_thread = None
+        # playlists we started that may still be playing
+        self.video_threads = []
+        # the transitions we chose (and warmed up) for the next trigger
+        self.next_transitions = []
+        # the content film we chose (and warmed up) for each trigger
+        self.next_content = {}
+        self.chart_timer = None
+        # the catalog we predict triggers from, and the content we warmed
+        # for the prediction: (film, whether we started its player)
+        self.catalog = None
+        self._predicted = None
+        # shuffle bags for our triggers, transitions and loops. Each
+        # station gets its own seed so they don't all play the same order
+        seed = selector.SELECTION_SEED
+        self.selector = selector.Selector(None if seed is None else "%s:%s" % (seed, name))
+
+    def __repr__(self):
+        return "<Station %s>" % self.name
+
+    def device_keys(self):
+        return ([self.reader] if self.reader else []) + self.charts
+
+    def start(self, catalog, single_file=False, pool_size=playerpool.POOL_SIZE):
+        """Start the idle loop and warm up players for the first trigger"""
+        report("%s: starting idle video" % self.name)
+        self.start_players(self.selector.of_type(catalog, 'loop'), single_file, pool_size)
+        self.use_catalog(catalog)
+
+    # start_players(), prepare(), discard() and play() are all we do with
+    # the players. A RemoteStation sends them on to the worker with the
+    # screen instead, see remote.py
+
+    def start_players(self, loop_film, single_file=False, pool_size=playerpool.POOL_SIZE):
+        """Start the idle loop, the big film player and the player pool"""
+        self.loop_thread = videothread.VideoThread([loop_film], media_dir=self.media_dir,
+                                                   debug=DEBUG, display=self.display)
+        self.loop_thread.start()
+        if single_file:
+            report("%s: starting big film player" % self.name)
+            self.big_film = bigfilm.open_big_film(self.media_dir, self.display)
+        # the big film plays what we'd otherwise pre-spawn
+        self.player_pool = playerpool.PlayerPool(size=0 if self.big_film else pool_size,
+                                                 display=self.display)
+
+    def prepare(self, film, make_room=False):
+        """Warm up a player for a film we expect to play. make_room
+        puts it ahead of the content we've already warmed."""
+        self.player_pool.prepare(film, self.media_dir, make_room)
+
+    def discard(self, film):
+        """We won't be playing film after all"""
+        self.player_pool.discard(film)
+
+    def play(self, playlist):
+        """Stop what we're playing and play playlist instead"""
+        # Each old playlist finishes on its worker in a moment, and we
+        # forget it once it has
+        for thread in self.video_threads:
+            thread.stop()
+        self.video_threads[:] = [thread for thread in self.video_threads if thread.is_alive()]
+        content_thread = videothread.VideoThread(playlist, media_dir=self.media_dir, debug=DEBUG,
+                                                 pool=self.player_pool, big_film=self.big_film,
+                                                 display=self.display)
+        content_thread.start()
+        self.video_threads.append(content_thread)
+
+    def cost(self, film):
+        """What playing film next costs us: 0 if a player is waiting for
+        it, 1 if it's in the page cache, 2 if it has to come off the card"""
+        if self.player_pool is not None and self.player_pool.is_warm(film):
+            return 0
+        if pagecache.keeps(self.media_dir + '/' + film['file']):
+            return 1
+        return 2
+
+    def prepare_next_films(self, catalog):
+        """Choose the films for the next trigger ahead of time and
+        pre-spawn players for as many of them as the pool has room for"""
+        self.next_transitions = [self.selector.of_type(catalog, 'transition', self.cost),
+                                 self.selector.of_type(catalog, 'transition', self.cost)]
+        for film in self.next_transitions:
+            self.prepare(film)
+        for trigger in catalog.triggers():
+            if trigger not in self.next_content:
+                self.next_content[trigger] = self.selector.content(catalog, trigger, self.cost)
+            self.prepare(self.next_content[trigger])
+
+    def use_catalog(self, catalog):
+        """Start using a new catalog: line up films from it, and predict
+        triggers from its RFIDs as our reader reads them"""
+        self.forget_removed(catalog)
+        self.selector.forget(catalog)
+        self.catalog = catalog
+        if self.reader:
+            trie = RFIDTrie(catalog.by_rfid)
+            devices.decoder_for(self.reader).use_trie(trie if trie.count else None, self.predict)
+        self.prepare_next_films(catalog)
+
+    def predict(self, trigger):
+        """Our reader has read enough of a tag to know its trigger: warm up
+        the content we'd play for it. With None the tag turned out to be
+        something else, and we kill the player if we started it for this.
+        Called from the reactor thread, by the RFID decoder."""
+        if trigger is None:
+            if self._predicted:
+                film, started = self._predicted
+                self._predicted = None
+                if started:
+                    self.unpredict(film)
+            return
+        if not self.catalog.content_for(trigger):
+            return
+        if trigger not in self.next_content:
+            self.next_content[trigger] = self.selector.content(self.catalog, trigger, self.cost)
+        film = self.next_content[trigger]
+        debug(self.name, "predicting", trigger, "warming", film['file'], level=2)
+        started = self.prepare_predicted(film)
+        pagecache.touch(self.media_dir + '/' + film['file'])
+        self._predicted = (film, started)
+        metrics.count('rfid.predicted')
+
+    def prepare_predicted(self, film):
+        """Warm up film ahead of the content we've already warmed.
+        Returns whether we started a player for it."""
+        pool = self.player_pool
+        started = pool is not None and not pool.is_warm(film)
+        self.prepare(film, make_room=True)
+        return started
+
+    def unpredict(self, film):
+        """Kill the player we started for a prediction that was wrong"""
+        self.discard(film)
+        # and warm up what it may have pushed out again
+        for film in self.next_content.values():
+            self.prepare(film)
+
+    def forget_removed(self, catalog):
+        """Drop the films we had lined up that are no longer in catalog"""
+        films = set(id(film) for film in catalog.films)
+        for trigger, film in self.next_content.items():
+            if id(film) not in films or trigger not in catalog.by_trigger:
+                del self.next_content[trigger]
+                self.discard(film)
+        for film in self.next_transitions:
+            if id(film) not in films:
+                self.discard(film)
+
+    def start_chart(self, duration):
+        """Start our chart recorders, and stop them after duration.
+        Returns the list of queued commands without waiting for answers."""
+        if self.chart_timer and self.chart_timer.cancel():
+            debug(self.name + ": canceling old chart timer")
+        commands = devices.tell_charts(devices.REQ_START, self.charts)
+        self.chart_timer = scheduler.call_later(duration, devices.tell_charts,
+                                                devices.REQ_STOP, self.charts)
+        return commands
+
+    @metrics.timed('trigger_actions')
+    def trigger(self, trigger, catalog):
+        """Trigger all of the actions specified by the database"""
+        if not catalog.content_for(trigger):
+            return
+        trigger_time = time()
+        self._predicted = None
+        if trigger in self.next_content:
+            content_film = self.next_content.pop(trigger)
+        else:
+            content_film = self.selector.content(catalog, trigger, self.cost)
+        debug('Content:', content_film)
+        pagecache.touch(self.media_dir + '/' + content_film['file'])
+        # start chart recorder. This only queues the commands, the
+        # recorders answer through the reactor while the video starts
+        debug("Starting chart recorder")
+        self.start_chart(content_film['length'])
+        # start films
+        if self.next_transitions:
+            trans1_film, trans2_film = self.next_transitions
+        else:
+            trans1_film = self.selector.of_type(catalog, 'transition', self.cost)
+            trans2_film = self.selector.of_type(catalog, 'transition', self.cost)
+        self.play([trans1_film, content_film, trans2_film])
+        report("%s: trigger %s handled in %.3fs" % (self.name, trigger, time() - trigger_time))
+        # and get ready for the next one
+        self.prepare_next_films(catalog)
+
+    def watch_reader(self, loop, on_rfid):
+        """Listen to our reader if it is live. Call from the reactor thread."""
+        devices.watch_rfid_reader(loop, on_rfid, self.reader)
+
+    def reader_live(self):
+        return devices.devices[self.reader]['status'] == 'live'
+
+    def close(self):
+        """Stop our playlists and kill our warm players"""
+        for thread in self.video_threads:
+            thread.stop()
+            thread.join(1.0)
+        if self.chart_timer:
+            self.chart_timer.cancel()
+        if self.player_pool:
+            self.player_pool.close()
+        if self.big_film:
+            self.big_film.close()
+
+
+def configured_stations(names=None):
+    """Stations from STATIONS, only the ones named if names are given"""
+    import remote
+    stations = [remote.RemoteStation(**config) if config.get('worker') else Station(**config)
+                for config in STATIONS if not names or config['name'] in names]
+    if names and len(stations) != len(set(names)):
+        known = [config['name'] for config in STATIONS]
+        raise ValueError("Unknown station in %s, we have %s" % (", ".join(names), ", ".join(known)))
+    return stations
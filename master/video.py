@@ -9,41 +9,34 @@ Copyright: 2017, MIT """
 from random import choice
 import threading
 import os
-from subprocess import call
+import cPickle
 import json
 
 # local modules
 import videothread
 from common import *
-import ffprobe
+import metacache
+import filmdb
+import seekindex
+import procmgr
+import scheduler
+from catalog import Catalog, FILM_FIELDS
 
 #
 # Constants
 #
 
-
-#
-# Globals
-#
-
-# # A list of film records 
-# # (each record of which is a film dict)
-# film_list = []
-# # A dictionary of lists of films, indexed by type 
-# # (each record of which is a film dict)
-# film_dict = {}
-# # A dictionary of content types, indexed by trigger
-# # (each record of which is a film dict)
-# content_film_dict = {}
+# bump this if Catalog or Film change in a way that breaks old snapshots
+SNAPSHOT_VERSION = 1
 
 #
 # Preparatory
 #
 
 def read_film_file(filename):
-    """Get JSON film file. File """
-    with open(filename, 'r') as fp:
-        return json_load_byteified(fp)
+    """Get JSON film file, checking each record as it's read.
+    Raises ValueError if the file or a record isn't right."""
+    return filmdb.load_film_file(filename)
 
 # json returns unicode objects, but for our purposes byte format is fine
 # http://stackoverflow.com/questions/956867/how-to-get-string-objects-instead-of-unicode-ones-from-json-in-python
@@ -81,52 +74,156 @@ def _byteify(data, ignore_dicts = False):
     return data
 
 
-def create_film_lists_dict(film_list):
-    """Iterate through imported database and sort list by type"""
-    film_dict = {}
+def scan_media_file(filename):
+    """Check that a media file exists and get its duration.
+    Returns (filename, length, seconds taken), length is None if the file
+    is missing. Runs on the worker pool."""
+    start_time = time()
+    if not os.path.isfile(filename):
+        length = None
+    else:
+        # this also warms the metadata cache, so the player doesn't probe
+        length = get_duration(filename)
+    return (filename, length, time() - start_time)
+
+
+def scan_media_files(filenames):
+    """Scan a list of media files on the shared worker pool.
+    Returns a dictionary of lengths indexed by filename"""
+    start_time = time()
+    results = scheduler.map_background(scan_media_file, filenames)
+    lengths = {}
+    for filename, length, seconds in results:
+        debug("Scanned", filename, "in", seconds, level=2)
+        lengths[filename] = length
+    report("Scanned %i media files in %.2fs" % (len(filenames), time() - start_time))
+    return lengths
+
+
+def media_filenames(film_list):
+    """The distinct media files of the enabled films, in order"""
+    filenames = []
     for film in film_list:
         filename = MEDIA_BASE + '/' + film['file']
-        if 'name' in film:
-            name = film['name']
-        else:
-            name = film['file']
-        if 'disabled' in film and film['disabled']:
-            debug("%s disabled. Removed from database" % name)
-        elif not os.path.isfile(filename):
-            debug("File %s not found. Removed from database" % filename)
-        else:
-            # first let's fill in necessary but missing fields
-            if ('length' not in film or film['length'] == 0):
-                film['length'] = get_duration(filename)
-                debug("Getting duration for %s: %f" % (name, film['length']))
-            # make lists of film types
-            # Note, that this means a film can be in several lists
-            if 'type' in film:
-                type = film['type']
-                if type not in film_dict: 
-                    film_dict[type] = [film]
-                else:
-                    film_dict[type].append(film)
-    return film_dict
-
-
-def create_content_dict(content_list):
-    """Iterate through content db and create dict keyed by trigger"""
-    # look through all films in the content list
-    content_dict = {}
-    for film in content_list:
-        # if a film has a trigger key
-        if 'trigger' in film:
-            # get the film's trigger value
-            trigger_value = film['trigger']
-            # if we have not already created an entry for this trigger_value
-            if trigger_value not in content_dict:
-                # create a new list entry in the content dictionary with key trigger
-                content_dict[trigger_value] = [film]
-            else:
-                # otherwise, append film to the existing list
-                content_dict[trigger_value].append(film)
-    return content_dict
+        if not film.get('disabled') and filename not in filenames:
+            filenames.append(filename)
+    return filenames
+
+
+def create_catalog(film_list):
+    """Scan the media files for the imported database and build a
+    Catalog of everything we can play"""
+    # scan each distinct file once, all at the same time
+    lengths = scan_media_files(media_filenames(film_list))
+    catalog = Catalog(film_list, lengths, media_dir=MEDIA_BASE)
+    # films that start part way into a file need to know their keyframes
+    seekindex.index_catalog(catalog)
+    metacache.get_cache().save()
+    return catalog
+
+
+def update_catalog(catalog, film_list):
+    """Build a new Catalog from a changed database, scanning only the
+    files of new and changed records. The metadata cache means only
+    files that changed on disk are probed again.
+    Returns None if nothing changed."""
+    removed, added = catalog.changes(film_list)
+    if not removed and not added:
+        return None
+    report("Database changed: %i films removed, %i records added" %
+           (len(removed), len(added)))
+    lengths = scan_media_files(media_filenames(added))
+    catalog = catalog.updated(removed, added, lengths)
+    seekindex.index_catalog(catalog)
+    metacache.get_cache().save()
+    save_snapshot(catalog, snapshot_stamps(MEDIA_BASE + '/' + FILMDB_FILE, film_list))
+    return catalog
+
+
+#
+# Snapshot
+#
+# The resolved catalog is pickled next to the media, along with the size
+# and mtime of the database and of every media file it was built from.
+# If none of them have changed we can start from the snapshot, without
+# parsing the database or looking at the media beyond a stat().
+
+def file_stamp(filename):
+    """(size, mtime) of a file, or None if it's missing"""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime)
+
+
+def snapshot_stamps(db_file, film_list, db_stamp=None):
+    """The stamps of everything a catalog was built from"""
+    stamps = dict((filename, file_stamp(filename))
+                  for filename in media_filenames(film_list))
+    stamps[db_file] = db_stamp or file_stamp(db_file)
+    return stamps
+
+
+def save_snapshot(catalog, stamps, snapshot_file=None):
+    """Write the catalog and its stamps in one pickle"""
+    snapshot_file = snapshot_file or MEDIA_BASE + '/' + SNAPSHOT_FILE
+    data = cPickle.dumps((SNAPSHOT_VERSION, FILM_FIELDS, stamps, catalog),
+                         cPickle.HIGHEST_PROTOCOL)
+    # our own, since the masters of other stations share the snapshot
+    tmp_file = snapshot_file + '.%i.tmp' % os.getpid()
+    try:
+        with open(tmp_file, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmp_file, snapshot_file)
+    except (IOError, OSError) as e:
+        update("WARNING: Can't write catalog snapshot %s: %s" % (snapshot_file, e))
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+
+
+def load_snapshot(snapshot_file=None):
+    """Return the catalog from the snapshot if nothing it was built from
+    has changed, otherwise None"""
+    snapshot_file = snapshot_file or MEDIA_BASE + '/' + SNAPSHOT_FILE
+    try:
+        with open(snapshot_file, 'rb') as fp:
+            data = fp.read()
+        version, fields, stamps, catalog = cPickle.loads(data)
+    except IOError:
+        return None
+    except Exception as e:
+        # a snapshot from some other version of us
+        debug("Can't read catalog snapshot:", e)
+        return None
+    if version != SNAPSHOT_VERSION or fields != FILM_FIELDS:
+        debug("Catalog snapshot is from another version")
+        return None
+    for filename, stamp in stamps.iteritems():
+        if file_stamp(filename) != stamp:
+            debug(filename, "has changed since the catalog snapshot")
+            return None
+    return catalog
+
+
+def load_catalog():
+    """Return the catalog from the snapshot if it's still good, otherwise
+    read the database, scan the media and save a new snapshot"""
+    start_time = time()
+    catalog = load_snapshot()
+    if catalog is not None:
+        report("Loaded catalog snapshot, %i films in %.3fs" %
+               (len(catalog), time() - start_time))
+        return catalog
+    db_file = MEDIA_BASE + '/' + FILMDB_FILE
+    # before we read it, so a change while we're reading isn't missed
+    db_stamp = file_stamp(db_file)
+    film_list = read_film_file(db_file)
+    catalog = create_catalog(film_list)
+    save_snapshot(catalog, snapshot_stamps(db_file, film_list, db_stamp))
+    return catalog
 
 
 #
@@ -134,8 +231,8 @@ def create_content_dict(content_list):
 #
 
 def get_duration(filename):
-    debug("Getting duration of %s" % filename)
-    length = ffprobe.duration(filename)
+    debug("Getting duration of", filename)
+    length = metacache.duration(filename)
     if length == None:
         length = 0
     return length
@@ -147,13 +244,13 @@ def get_duration(filename):
 
 
 def main():
-    global film_db
-    film_db = read_film_file(MEDIA_BASE + '/' + FILMDB_FILE)
-    create_film_lists()
-    create_content_dict()
+    catalog = load_catalog()
+    content_film_list = catalog.of_type('content')
+    transition_film_list = catalog.of_type('transition')
     try:
-        loop_film = choice(loop_film_list)
+        loop_film = choice(catalog.of_type('loop'))
         loop_thread = videothread.VideoThread([loop_film], media_dir=MEDIA_BASE, debug=DEBUG)
+        loop_thread.start()
 
         while True:
             max_content = len(content_film_list)-1
@@ -163,23 +260,20 @@ def main():
                 break
             if (str.isdigit(next_film) and int(next_film) >= 0 and int(next_film) <= max_content):
                 content_film = content_film_list[int(next_film)]
-            elif (next_film in content_film_dict):
-                content_film = choice(content_film_dict[next_film])
+            elif catalog.content_for(next_film):
+                content_film = choice(catalog.content_for(next_film))
             else:
                 continue
             trans1_film = choice(transition_film_list)
             trans2_film = choice(transition_film_list)
             content_thread = videothread.VideoThread([trans1_film, content_film, trans2_film], 
                         media_dir=MEDIA_BASE, debug=DEBUG)
+            content_thread.start()
 
     except KeyboardInterrupt:
         print ""
         print "Done."
-        nullin = open(os.devnull, 'r')
-        nullout = open(os.devnull, 'w')
-        call(["killall", "-9", "omxplayer", "omxplayer.bin"], stdout=nullout, stderr=nullout)
-        nullin.close()
-        nullout.close()
+    procmgr.shutdown()
 
 
 if __name__ == "__main__":
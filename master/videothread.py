@@ -1,5 +1,5 @@
 #!/usr/bin/python
-"""videothread.py: Threaded, stopable video player class
+"""videothread.py: Stopable video player class, run on the shared workers
 Author: Wes Modes (wmodes@gmail.com) & SL Benz (slbenzy@gmail.com)
 Copyright: 2017, MIT """
 
@@ -7,29 +7,74 @@ Copyright: 2017, MIT """
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 
 import threading
-import subprocess
 import sys
 import signal
 import os
 import time
 
 # local imports
-import ffprobe
+import metacache
+import procmgr
+import scheduler
+import metrics
 
 INTER_VIDEO_DELAY = 0.75
 
-OMX_CMD = ['omxplayer', '--no-osd', '--no-keys', '--refresh', '--aspect-mode stretch']
-CONTENT_CMD = OMX_CMD + ['--layer 4', '--dbus_name', 'org.mpris.MediaPlayer2.omxplayer1']
-TRANSITION_CMD = OMX_CMD + ['--layer 5', '--dbus_name', 'org.mpris.MediaPlayer2.omxplayer2']
-LOOP_CMD = OMX_CMD + ['--layer 1', '--loop', '--dbus_name', 'org.mpris.MediaPlayer2.omxplayer3']
+OMX_CMD = ['omxplayer', '--no-osd', '--no-keys', '--refresh', '--aspect-mode', 'stretch']
+CONTENT_CMD = OMX_CMD + ['--layer', '4', '--dbus_name', 'org.mpris.MediaPlayer2.omxplayer1']
+TRANSITION_CMD = OMX_CMD + ['--layer', '5', '--dbus_name', 'org.mpris.MediaPlayer2.omxplayer2']
+LOOP_CMD = OMX_CMD + ['--layer', '1', '--loop', '--dbus_name', 'org.mpris.MediaPlayer2.omxplayer3']
 
-nullin = open(os.devnull, 'r')
-nullout = open(os.devnull, 'w')
 
+def clip_bounds(video, filelength):
+    """Return (start, length) to play of a video, clipped to the file"""
+    if ('length' not in video or video['length'] == 0.0):
+        length = filelength
+    else:
+        length = video['length']
+    # get start
+    if 'start' in video:
+        start = video['start']
+    else:
+        start = 0.0
+    # if start is too large, set it to 0
+    if (start >= filelength):
+        start = 0.0
+    # if length is too large, scale it back
+    if (start + length >= filelength):
+        length = filelength - start
+    return (start, length)
 
-class VideoThread(threading.Thread):
-    """Thread class with a stop() method. The thread itself checks
-    regularly for the stopped() condition."""
+
+def player_cmd(video, filename, start=0.0, dbus_name=None, alpha=None, display=None, vol=None):
+    """Construct the player command for a video, as a list.
+    dbus_name, alpha and vol (in millibels) override the defaults for the
+    video's type.
+    display picks the screen, and keeps the default D-Bus names of the
+    players on different screens apart."""
+    if (video['type'] == 'loop'):
+        cmd = list(LOOP_CMD)
+    elif (video['type'] == 'transition'):
+        cmd = TRANSITION_CMD + ['--pos', str(start)]
+    else:
+        cmd = CONTENT_CMD + ['--pos', str(start)]
+    if dbus_name:
+        cmd[cmd.index('--dbus_name') + 1] = dbus_name
+    elif display is not None:
+        cmd[cmd.index('--dbus_name') + 1] += '.display%i' % display
+    if display is not None:
+        cmd += ['--display', str(display)]
+    if alpha is not None:
+        cmd += ['--alpha', str(alpha)]
+    if vol is not None:
+        cmd += ['--vol', str(vol)]
+    return cmd + [filename]
+
+
+class VideoThread(object):
+    """Playlist player with a stop() method. Despite the name it has no
+    thread of its own: start() runs it on the shared worker pool, where it
+    checks regularly for the stopped() condition."""
     _example = """
         The class takes a list containing one or more dictionaries containing
         data about the videos to be played:
@@ -43,16 +88,43 @@ class VideoThread(threading.Thread):
              },]
         """
 
-    def __init__(self, playlist=None, media_dir=".", debug=0):
-        super(VideoThread, self).__init__()
+    def __init__(self, playlist=None, media_dir=".", debug=0, pool=None, big_film=None,
+                 display=None):
+        self._task = None
         self._stop = threading.Event()
         self.media_dir = media_dir
         self.playlist = playlist
+        # optional PlayerPool of pre-spawned, paused players
+        self.pool = pool
+        # optional BigFilmPlayer we seek in instead of starting players
+        self.big_film = big_film
+        self._big_film_token = None
+        # the screen we play on, or None for the player's default
+        self.display = display
         self._debug_flag = debug
         self._last_debug_caller = None
         self._current_video = None
         self._player_pgid = None
 
+    def start(self):
+        """Play the playlist on the next free worker"""
+        # get players for the rest of the playlist warming up. We ask for
+        # them here rather than on the worker, so whoever asks for one of
+        # the same films after we're started takes it over from us
+        if self.pool is not None and isinstance(self.playlist, list):
+            for video in self.playlist[1:]:
+                if not (self.big_film and self.big_film.covers(video)):
+                    self.pool.prepare(video, self.media_dir, owner=self)
+        self._task = scheduler.submit(self.run)
+
+    def join(self, timeout=None):
+        """Wait until the playlist is over or stopped"""
+        if self._task:
+            self._task.wait(timeout)
+
+    def is_alive(self):
+        return self._task is not None and not self._task.done()
+
     def set_sequence(self, playlist=None):
         self.playlist = playlist
 
@@ -88,14 +160,67 @@ class VideoThread(threading.Thread):
         if not isinstance(self.playlist, list):
             raise ValueError(self._example)
         for video in self.playlist:
-            if not self.stopped():
-                self._start_video(video)
+            if self.stopped():
+                break
+            # in single-file mode we just seek to the clip
+            if self.big_film and self._seek_video(video):
+                continue
+            self._hide_big_film()
+            started = self._start_video(video)
+            if started:
+                pgid, name, length = started
+                self._wait_and_kill(pgid, name, length)
+        self._hide_big_film()
+        # we took the players for the films we got to, so what's left
+        # warming is for films we were stopped before
+        if self.pool is not None:
+            for video in self.playlist[1:]:
+                self.pool.release(video, self)
+
+    def _wait(self, length):
+        """Sleep on the stop event, so a stop() wakes us at once"""
+        deadline = time.time() + length
+        while not self.stopped():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self._stop.wait(remaining)
+
+    def _wait_and_kill(self, pgid, name, length):
+        """Sleep until it is time to overlap the next video, then schedule
+        the kill."""
+        self._debug("Waiting %.2fs and setting kill timer for %i (%s)" %
+                    (length - INTER_VIDEO_DELAY, pgid, name))
+        self._wait(length - INTER_VIDEO_DELAY)
+        scheduler.call_later(INTER_VIDEO_DELAY, self._stop_video, pgid, name)
+
+    def _seek_video(self, video):
+        """Play a video by seeking the big film to it, and wait for it to
+        finish. There's nothing to overlap, the next clip is one seek away.
+        Returns False if the big film can't play it."""
+        shown = self.big_film.show(video)
+        if not shown:
+            return False
+        self._big_film_token, length = shown
+        self._current_video = video
+        self._debug("Seeked big film to %s for %.1fs" % (video['file'], length))
+        self._wait(length)
+        return True
+
+    def _hide_big_film(self):
+        if self._big_film_token is not None:
+            self.big_film.hide(self._big_film_token)
+            self._big_film_token = None
 
+    @metrics.timed('start_video')
     def _start_video(self, video):
-        """Starts a video. Takes a video object """
-        filename = self.media_dir + '/' + video['file']
-        if not isinstance(video, dict):
+        """Starts a video. Takes a video object.
+        Returns (pgid, name, length) if the video needs to be killed after
+        length seconds, or None if it loops or was not started."""
+        # a dict, or a catalog Film which reads like one
+        if not hasattr(video, 'get'):
             raise ValueError(self._example)
+        filename = self.media_dir + '/' + video['file']
         if 'name' in video:
             name = video['name']
         else:
@@ -107,21 +232,7 @@ class VideoThread(threading.Thread):
         self._debug("Video data:", video)
         # get length
         filelength = self._get_length(filename)
-        if ('length' not in video or video['length'] == 0.0):
-            length = filelength
-        else:
-            length = video['length']
-        # get start
-        if 'start' in video:
-            start = video['start']
-        else:
-            start = 0.0
-        # if start is too large, set it to 0
-        if (start >= filelength):
-            start = 0.0
-        # if length is too large, scale it back
-        if (start + length >= filelength):
-            length = filelength - start
+        start, length = clip_bounds(video, filelength)
         # store this for later
         self._current_video = video
         # debugging output
@@ -129,57 +240,46 @@ class VideoThread(threading.Thread):
         self._debug("type: %s, start: %.1fs, end: %.1fs, len: %.1fs" %
                       (video['type'], start, start+length, length))
         # construct the player command
-        if (video['type'] == 'loop'):
-            my_cmd = " ".join(LOOP_CMD + [filename])
-        elif (video['type'] == 'transition'):
-            my_cmd = " ".join(TRANSITION_CMD + ['--pos', str(start), filename])
-        else: 
-            my_cmd = " ".join(CONTENT_CMD + ['--pos', str(start), filename])
-        self._debug("cmd:", my_cmd, l=2)
+        my_cmd = player_cmd(video, filename, start, display=self.display)
+        self._debug("cmd:", " ".join(my_cmd), l=2)
         # launch the player, saving the process handle
         # TODO: after debugging, replace 'if True' with 'try' and enable 'except'
         if True:
         # try:
-            proc = None
-            if (self._debug_flag >= 3):
-                proc = subprocess.Popen(my_cmd, shell=True, preexec_fn=os.setsid, stdin=nullin)
-            else:
-                proc = subprocess.Popen(my_cmd, shell=True, preexec_fn=os.setsid, stdin=nullin, stdout=nullout)
-            # save this process group id
-            pgid = os.getpgid(proc.pid)
+            pgid = None
+            # if we have a pre-spawned player waiting, we just unpause it
+            if self.pool:
+                player = self.pool.take(video)
+                if player and self.pool.play(player):
+                    pgid = player.pgid
+                    self._debug("Playing pre-spawned %i (%s)" % (pgid, name))
+            if pgid is None:
+                # launch it in its own process group, saving the group id
+                pgid = procmgr.spawn(my_cmd, name, quiet=(self._debug_flag < 3))
             self._player_pgid = pgid
             self._debug("Starting process: %i (%s)" % (pgid, name))
             # If type=loop and length=0, loop forever
             if (video['type'] == 'loop'):
                 self._debug("Looping indefinitely for %i (%s)" %
                               (pgid, name))
-            # otherwise, wait and kill it
-            else:
-                self._debug("Waiting %.2fs and setting kill timer for %i (%s)" %
-                            (length - INTER_VIDEO_DELAY, pgid, name))
-                # wait in a tight loop, checking if we've received stop event or time is over
-                start_time = time.time()
-                while (not self.stopped() and
-                       (time.time() <= start_time + length - INTER_VIDEO_DELAY)):
-                    pass
-                threading.Timer(INTER_VIDEO_DELAY, 
-                                self._stop_video, [pgid, name]).start()
+                return None
+            # otherwise, our caller waits and kills it
+            return (pgid, name, length)
         # except:
         #     self._debug("Unable to start video", name, l=0)
 
+    @metrics.timed('stop_video')
     def _stop_video(self, pgid, name):
-        try:
-            self._debug("Killing process %i (%s)" % (pgid, name))
-            os.killpg(pgid, signal.SIGTERM)
+        self._debug("Killing process %i (%s)" % (pgid, name))
+        if procmgr.kill(pgid, signal.SIGTERM):
             self._player_pgid = None
             self._current_video = None
-        except OSError:
+        else:
             self._debug("Couldn't terminate %i (%s)" % (pgid, name))
-            pass
 
     def _get_length(self, filename):
         self._debug("Getting duration of %s" % filename)
-        length = ffprobe.duration(filename)
+        length = metacache.duration(filename)
         if length == None:
             length = 0
         return length